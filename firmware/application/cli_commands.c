@@ -5,6 +5,7 @@
 
 #include <avr/io.h>
 #include <avr/interrupt.h>
+#include <util/crc16.h>
 
 #include <cli.h>
 #include <cli_commands.h>
@@ -17,6 +18,7 @@
 #include "debug.h"
 #include "eeprom_config.h"
 #include "veml6040.h"
+#include "timestamp.h"
 
 //==================================================================================================
 static uint16_t xtou16(char *s){
@@ -51,6 +53,110 @@ static uint8_t hex2nibble(char c){
     }
 }
 
+//--------------------------------------------------------------------------------------------------
+// Base64 transfer of config pages
+// A page is sent as its 32 data bytes followed by their CRC-8 (CCITT, init 0).
+// 33 bytes encode to exactly 44 characters with no padding.
+//--------------------------------------------------------------------------------------------------
+#define B64_PAGE_BYTES  (EEPROM_PAGE_SIZE + 1)
+#define B64_PAGE_CHARS  (B64_PAGE_BYTES/3*4)
+
+static const char b64_chars[] = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/";
+
+static int8_t b64_sextet(char c){
+    if((c >= 'A') && (c <= 'Z')){
+        return(c-'A');
+    }else if((c >= 'a') && (c <= 'z')){
+        return(c-'a'+26);
+    }else if((c >= '0') && (c <= '9')){
+        return(c-'0'+52);
+    }else if(c == '+'){
+        return(62);
+    }else if(c == '/'){
+        return(63);
+    }else{
+        return(-1);
+    }
+}
+
+/**
+ * \brief Decodes base64 text
+ * \param s Text to decode. Must be len/3*4 characters. No padding.
+ * \param dst Output buffer
+ * \param len Number of bytes to decode. Must be a multiple of 3
+ * \retval 0 Success
+ * \retval 1 Invalid character
+**/
+static uint8_t b64_decode(char *s, uint8_t *dst, uint8_t len){
+    uint32_t group;
+    
+    for(uint8_t i=0; i<len; i+=3){
+        group = 0;
+        for(uint8_t j=0; j<4; j++){
+            int8_t sextet = b64_sextet(*s++);
+            if(sextet < 0) return(1);
+            group <<= 6;
+            group |= sextet;
+        }
+        dst[i]   = group >> 16;
+        dst[i+1] = group >> 8;
+        dst[i+2] = group;
+    }
+    return(0);
+}
+
+/**
+ * \brief Outputs bytes as base64 text
+ * \param src Bytes to encode
+ * \param len Number of bytes. Must be a multiple of 3
+**/
+static void b64_put(uint8_t *src, uint8_t len){
+    uint32_t group;
+    
+    for(uint8_t i=0; i<len; i+=3){
+        group = src[i];
+        group <<= 8;
+        group |= src[i+1];
+        group <<= 8;
+        group |= src[i+2];
+        for(int8_t shift=18; shift>=0; shift-=6){
+            uart_putc(b64_chars[(group >> shift) & 0x3F]);
+        }
+    }
+}
+
+static uint8_t page_crc(uint8_t *data){
+    uint8_t crc = 0;
+    for(uint8_t i=0; i<EEPROM_PAGE_SIZE; i++){
+        crc = _crc8_ccitt_update(crc, data[i]);
+    }
+    return(crc);
+}
+
+//--------------------------------------------------------------------------------------------------
+// <DOW> <year> <month> <day> <hour> <minute> <second>
+static void put_calendar_time(calendar_time_t *T){
+    uart_put_x8(T->dayofweek);
+    uart_putc(' ');
+    
+    uart_put_x16(T->year);
+    uart_putc(' ');
+    
+    uart_put_x8(T->month);
+    uart_putc(' ');
+    
+    uart_put_x8(T->day);
+    uart_putc(' ');
+    
+    uart_put_x8(T->hour);
+    uart_putc(' ');
+    
+    uart_put_x8(T->minute);
+    uart_putc(' ');
+    
+    uart_put_x8(T->second);
+}
+
 //==================================================================================================
 // Device-specific output functions
 //==================================================================================================
@@ -125,25 +231,7 @@ int cmd_get_time(uint8_t argc, char *argv[]){
     
     calendar_get_time(&T);
     
-    uart_put_x8(T.dayofweek);
-    uart_putc(' ');
-    
-    uart_put_x16(T.year);
-    uart_putc(' ');
-    
-    uart_put_x8(T.month);
-    uart_putc(' ');
-    
-    uart_put_x8(T.day);
-    uart_putc(' ');
-    
-    uart_put_x8(T.hour);
-    uart_putc(' ');
-    
-    uart_put_x8(T.minute);
-    uart_putc(' ');
-    
-    uart_put_x8(T.second);
+    put_calendar_time(&T);
     
     return(0);
 }
@@ -154,25 +242,7 @@ int cmd_get_ref_time(uint8_t argc, char *argv[]){
     
     calendar_get_last_set_timestamp(&T);
     
-    uart_put_x8(T.dayofweek);
-    uart_putc(' ');
-    
-    uart_put_x16(T.year);
-    uart_putc(' ');
-    
-    uart_put_x8(T.month);
-    uart_putc(' ');
-    
-    uart_put_x8(T.day);
-    uart_putc(' ');
-    
-    uart_put_x8(T.hour);
-    uart_putc(' ');
-    
-    uart_put_x8(T.minute);
-    uart_putc(' ');
-    
-    uart_put_x8(T.second);
+    put_calendar_time(&T);
     
     return(0);
 }
@@ -185,6 +255,33 @@ int cmd_get_ttl_clk_correct(uint8_t argc, char *argv[]){
     return(0);
 }
 
+//--------------------------------------------------------------------------------------------------
+int cmd_status(uint8_t argc, char *argv[]){
+    calendar_time_t T;
+    
+    // Everything is sampled in one command so that the host can timestamp it with a single
+    // round trip
+    calendar_get_time(&T);
+    put_calendar_time(&T);
+    cli_puts("\r\n");
+    
+    calendar_get_last_set_timestamp(&T);
+    put_calendar_time(&T);
+    cli_puts("\r\n");
+    
+    uart_put_x32((uint32_t)calendar_get_total_correction());
+    cli_puts("\r\n");
+    
+    // Config header
+    uart_put_x32(eeConfig.timestamp);
+    uart_putc(' ');
+    uart_put_x32((uint32_t)eeConfig.clock_correction_interval);
+    uart_putc(' ');
+    uart_put_x32(Build_Timestamp);
+    
+    return(0);
+}
+
 //--------------------------------------------------------------------------------------------------
 void stop_error_led(void);
 
@@ -242,6 +339,33 @@ int cmd_cfg_write(uint8_t argc, char *argv[]){
     return(0);
 }
 
+//--------------------------------------------------------------------------------------------------
+int cmd_cfg_write64(uint8_t argc, char *argv[]){
+    uint8_t page;
+    uint8_t data[B64_PAGE_BYTES];
+    
+    if(argc != 3) return(1);
+    
+    page = xtou16(argv[1]);
+    if(page >= EEPROM_PAGE_COUNT) return(1);
+    
+    if(strlen(argv[2]) != B64_PAGE_CHARS) return(1);
+    if(b64_decode(argv[2], data, B64_PAGE_BYTES)) return(1);
+    
+    // Reject corrupted pages
+    if(page_crc(data) != data[EEPROM_PAGE_SIZE]) return(1);
+    
+    eecfg_write_page(page, data);
+    
+    return(0);
+}
+
+//--------------------------------------------------------------------------------------------------
+int cmd_cfg_unload(uint8_t argc, char *argv[]){
+    eecfg_unload_cfg();
+    return(0);
+}
+
 //--------------------------------------------------------------------------------------------------
 int cmd_cfg_reload(uint8_t argc, char *argv[]){
     eecfg_reload_cfg();
@@ -270,6 +394,27 @@ int cmd_cfg_read(uint8_t argc, char *argv[]){
     return(0);
 }
 
+//--------------------------------------------------------------------------------------------------
+int cmd_cfg_read64(uint8_t argc, char *argv[]){
+    uint16_t address;
+    uint8_t page;
+    uint8_t data[B64_PAGE_BYTES];
+    
+    if(argc != 2) return(1);
+    
+    page = xtou16(argv[1]);
+    if(page >= EEPROM_PAGE_COUNT) return(1);
+    address = page;
+    address *= EEPROM_PAGE_SIZE;
+    address += MAPPED_EEPROM_START;
+    
+    memcpy(data, (uint8_t*) address, EEPROM_PAGE_SIZE);
+    data[EEPROM_PAGE_SIZE] = page_crc(data);
+    b64_put(data, B64_PAGE_BYTES);
+    
+    return(0);
+}
+
 //--------------------------------------------------------------------------------------------------
 int cmd_chroma(uint8_t argc, char *argv[]){
     uint8_t sampletime;
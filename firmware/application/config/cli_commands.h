@@ -20,8 +20,11 @@
 // Command words MUST be in alphabetical (ascii) order!! (A-Z then a-z) if using binary search
 #define CMDTABLE    {"cfg_erase"        , cmd_cfg_erase       },\
                     {"cfg_read"         , cmd_cfg_read        },\
+                    {"cfg_read64"       , cmd_cfg_read64      },\
                     {"cfg_reload"       , cmd_cfg_reload      },\
+                    {"cfg_unload"       , cmd_cfg_unload      },\
                     {"cfg_write"        , cmd_cfg_write       },\
+                    {"cfg_write64"      , cmd_cfg_write64     },\
                     {"chroma"           , cmd_chroma          },\
                     {"echo"             , cmd_echo            },\
                     {"get_ttl_clk_correct"  , cmd_get_ttl_clk_correct },\
@@ -32,7 +35,8 @@
                     {"reset"            , cmd_reset           },\
                     {"rgbw"             , cmd_rgbw            },\
                     {"set_dst"          , cmd_set_dst         },\
-                    {"set_time"         , cmd_set_time        }
+                    {"set_time"         , cmd_set_time        },\
+                    {"status"           , cmd_status          }
 
 // Custom command function prototypes:
 
@@ -53,6 +57,14 @@ int cmd_get_ref_time(uint8_t argc, char *argv[]);
 
 int cmd_get_ttl_clk_correct(uint8_t argc, char *argv[]);
 
+// status
+// Responds with the following lines:
+// <get_time response>
+// <get_ref_time response>
+// <get_ttl_clk_correct response>
+// <config header timestamp> <config clock correction interval> <firmware build timestamp>
+int cmd_status(uint8_t argc, char *argv[]);
+
 // set_time <year> <month> <day> <hour> <minute> <second>
 int cmd_set_time(uint8_t argc, char *argv[]);
 
@@ -62,8 +74,19 @@ int cmd_set_dst(uint8_t argc, char *argv[]);
 int cmd_cfg_erase(uint8_t argc, char *argv[]);
 int cmd_cfg_write(uint8_t argc, char *argv[]);
 int cmd_cfg_read(uint8_t argc, char *argv[]);
+
+// Same as cfg_write/cfg_read, but the page is base64 encoded and followed by a CRC-8
+// cfg_write64 <page> <base64 data+crc>
+// cfg_read64 <page>
+int cmd_cfg_write64(uint8_t argc, char *argv[]);
+int cmd_cfg_read64(uint8_t argc, char *argv[]);
 int cmd_cfg_reload(uint8_t argc, char *argv[]);
 
+// cfg_unload
+// Stops using the config until the next cfg_reload, so that its pages can be rewritten in
+// place. Firmware that has this command erases each page as part of cfg_write/cfg_write64.
+int cmd_cfg_unload(uint8_t argc, char *argv[]);
+
 int cmd_chroma(uint8_t argc, char *argv[]);
 
 int cmd_print_cfg(uint8_t argc, char *argv[]);
@@ -157,7 +157,7 @@ void eecfg_write_page(uint8_t page, void *data){
 	NVM.ADDR0 = address & 0xFF;
 	NVM.ADDR1 = (address >> 8) & 0x1F;
 	NVM.ADDR2 = 0x00;
-	NVM.CMD = NVM_CMD_WRITE_EEPROM_PAGE_gc;
+	NVM.CMD = NVM_CMD_ERASE_WRITE_EEPROM_PAGE_gc;
 	NVM_EXEC();
     
     while(NVM.STATUS & NVM_NVMBUSY_bm);
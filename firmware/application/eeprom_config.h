@@ -117,7 +117,8 @@ void eecfg_erase(void);
 
 /**
  * \brief Write a 32-byte page to EEPROM
- * Assumes the page has already been erased
+ * The page is erased as part of the write so that individual pages can be
+ * rewritten without erasing the entire EEPROM first.
  **/
 void eecfg_write_page(uint8_t page, void *data);
 
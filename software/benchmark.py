@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+import threading
+import time
+import json
+import random
+import statistics
+import subprocess
+
+import py_modules.skylight.btLink as btLink
+import py_modules.skylight.ihex as ihex
+import py_modules.skylight.eeprom_config as eecfg
+from py_modules.skylight.emulator import DeviceEmulator
+from py_modules.skylight.colors import Color_raw
+from py_modules.python_modules.app import App
+
+#---------------------------------------------------------------------------------------------------
+class EchoStandIn(threading.Thread):
+    """
+    Minimal stand-in for a device on the far end of a socketpair.
+    Answers every command line with a fixed-size hex payload followed by the prompt.
+    Used to measure the host's response parsing without any device timing.
+    """
+    def __init__(self, sock, resp_len):
+        threading.Thread.__init__(self, daemon=True)
+        self.S = sock
+        self.resp = (b"A5" * (resp_len//2)) + b"\r\n>"
+    
+    def run(self):
+        buf = b""
+        while(True):
+            try:
+                data = self.S.recv(4096)
+            except OSError:
+                return
+            if(len(data) == 0):
+                return
+            buf += data
+            n_lines = buf.count(b"\n")
+            if(n_lines):
+                buf = buf[buf.rfind(b"\n")+1:]
+                self.S.sendall(self.resp * n_lines)
+
+#---------------------------------------------------------------------------------------------------
+def legacy_cmd(S, cmd_string):
+    """
+    Original byte-at-a-time response reader. Kept only as a benchmark reference.
+    """
+    S.send(cmd_string.encode("ascii"))
+    resp = []
+    resp_line = ""
+    c = S.recv(1).decode("ascii")
+    while(c != '>'):
+        if(c == '\r'):
+            pass
+        elif(c == '\n'):
+            if(len(resp_line) != 0):
+                resp.append(resp_line)
+                resp_line = ""
+        else:
+            resp_line += c
+        c = S.recv(1).decode("ascii")
+    if(len(resp_line) != 0):
+        resp.append(resp_line)
+    return(resp)
+
+#---------------------------------------------------------------------------------------------------
+class CountingSocket:
+    """
+    Wraps the host end of the link and counts what goes over it.
+    A round trip is counted each time the host starts waiting for data after having sent some.
+    """
+    def __init__(self, sock):
+        self.S = sock
+        self.reset()
+    
+    def reset(self):
+        self.bytes_tx = 0
+        self.bytes_rx = 0
+        self.round_trips = 0
+        self.sent_since_recv = False
+    
+    def sendall(self, data):
+        self.bytes_tx += len(data)
+        self.sent_since_recv = True
+        self.S.sendall(data)
+    
+    def send(self, data):
+        n = self.S.send(data)
+        self.bytes_tx += n
+        self.sent_since_recv = True
+        return(n)
+    
+    def recv(self, n):
+        if(self.sent_since_recv):
+            self.round_trips += 1
+            self.sent_since_recv = False
+        data = self.S.recv(n)
+        self.bytes_rx += len(data)
+        return(data)
+    
+    def settimeout(self, timeout):
+        self.S.settimeout(timeout)
+    
+    def setblocking(self, flag):
+        self.S.setblocking(flag)
+    
+    def close(self):
+        self.S.close()
+
+#---------------------------------------------------------------------------------------------------
+def make_ihex_image(n_bytes, seed = 0):
+    """
+    Returns a list of ihex.Record of pseudo-random data, laid out the way avr-objcopy does
+    """
+    rnd = random.Random(seed)
+    records = []
+    for addr in range(0, n_bytes, 16):
+        data = bytes([rnd.randrange(256) for i in range(min(16, n_bytes - addr))])
+        records.append(ihex.Record(ihex.DATA, addr, data))
+    records.append(ihex.Record(ihex.EOF, 0, b""))
+    return(records)
+
+#---------------------------------------------------------------------------------------------------
+def make_config_image(n_bytes, seed = 0):
+    rnd = random.Random(seed)
+    return(bytes([rnd.randrange(256) for i in range(n_bytes)]))
+
+#---------------------------------------------------------------------------------------------------
+def make_large_config(n_objects, n_variants = 2, seed = 0):
+    """
+    Returns an eeConfig with about n_objects cfgObjects that still compiles into 2 kB.
+    Modeset change alarms each reference their own ModeSet built from fresh transition objects,
+    but there are only n_variants distinct ModeSets, so nearly everything is a duplicate.
+    """
+    n_alarms = 100
+    modes_per_set = min(max(n_objects // (n_alarms * 2), 1), 150)
+    
+    palette = [Color_raw(i * 0x2000, 0xFFFF - i * 0x2000, i * 0x1000, 0) for i in range(8)]
+    
+    def make_modeset(variant):
+        rnd = random.Random(seed * 1000 + variant)
+        ms = eecfg.ModeSet()
+        for i in range(modes_per_set):
+            t_on = eecfg.trans_Fade()
+            t_on.color = rnd.choice(palette)
+            t_on.duration = rnd.choice([1.0, 5.0])
+            t_off = eecfg.trans_Immediate()
+            t_off.color = rnd.choice(palette)
+            ms.modes.append((t_on, t_off))
+        return(ms)
+    
+    cfg = eecfg.eeConfig()
+    for i in range(n_alarms):
+        alarm = eecfg.AlarmEntry()
+        alarm.dow_list = [i % 7]
+        alarm.hour = i % 24
+        alarm.data = make_modeset(i % n_variants)
+        cfg.modeset_change_table.alarms.append(alarm)
+    cfg.default_modeset = make_modeset(0)
+    return(cfg)
+
+#---------------------------------------------------------------------------------------------------
+def get_revision():
+    try:
+        rev = subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd = os.path.dirname(os.path.abspath(__file__)),
+            stderr = subprocess.DEVNULL
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return(None)
+    return(rev.decode("ascii").strip())
+
+#---------------------------------------------------------------------------------------------------
+class Benchmark(App):
+    def set_cmdline_args(self, parser):
+        App.set_cmdline_args(self, parser)
+        
+        parser.description = "Skylight LED host-side transport benchmark suite"
+        parser.add_argument("--rtt", dest="rtt", type=float, default=0.03,
+                            help="Round trip time of the emulated Bluetooth link in seconds")
+        parser.add_argument("--baud", dest="baud", type=int, default=115200,
+                            help="UART bit rate of the emulated device. 0 disables pacing")
+        parser.add_argument("-r", "--repeat", dest="repeat", type=int, default=3,
+                            help="Number of runs of each benchmark. The median is reported")
+        parser.add_argument("--only", dest="only", action="append", default=[],
+                            help="Only run the named benchmark. Can be given multiple times")
+        parser.add_argument("--cfg-size", dest="cfg_size", type=int, default=1024,
+                            help="Size of the config image in bytes")
+        parser.add_argument("--ihex-size", dest="ihex_size", type=int, default=8192,
+                            help="Size of the firmware image in bytes")
+        parser.add_argument("-n", dest="n_cmds", type=int, default=5000,
+                            help="Number of commands for the response parser benchmark")
+        parser.add_argument("--resp-len", dest="resp_len", type=int, default=64,
+                            help="Number of payload bytes in each response for the response parser benchmark")
+        parser.add_argument("--cfg-objects", dest="cfg_objects", type=int, default=4000,
+                            help="Approximate number of config objects for the config compiler benchmark")
+        parser.add_argument("--edits", dest="edits", type=int, default=20,
+                            help="Number of edits in the compile_session benchmark")
+        parser.add_argument("-o", "--output", dest="output", default=None,
+                            help="Write results to this JSON file")
+        parser.add_argument("--compare", dest="compare", default=None,
+                            help="JSON file of an earlier run to compare against")
+    
+    #-----------------------------------------------------------------------------------------------
+    # Benchmarks
+    # Each is a tuple of (setup, run). Both are called with a btLink connected to a fresh emulator.
+    # Only run is measured.
+    #-----------------------------------------------------------------------------------------------
+    def get_benchmarks(self):
+        cfg_image = make_config_image(self.options.cfg_size)
+        
+        # Same image with one byte changed
+        cfg_image_mod = bytearray(cfg_image)
+        cfg_image_mod[len(cfg_image_mod)//2] ^= 0xFF
+        cfg_image_mod = bytes(cfg_image_mod)
+        
+        ihex_image = make_ihex_image(self.options.ihex_size)
+        
+        def setup_none(S):
+            pass
+        
+        def setup_cfg(S):
+            S.send_config(cfg_image)
+        
+        def setup_bl(S):
+            S.enter_bootloader()
+        
+        def setup_light(S):
+            # Bright enough for the sensor to settle on a short integration time
+            S.set_rgbw(Color_raw(0x8000, 0x8000, 0x8000, 0))
+        
+        return({
+            "send_config": (setup_none, lambda S: S.send_config(cfg_image)),
+            "send_config_diff": (setup_cfg, lambda S: S.send_config(cfg_image_mod, diff=True)),
+            "send_ihex": (setup_bl, lambda S: S.send_ihex(ihex_image)),
+            "set_rgbw": (setup_none, lambda S: [S.set_rgbw(Color_raw(i, i, i, i)) for i in range(50)]),
+            "measure_chroma": (setup_light, lambda S: S.measure_chroma(4)),
+        })
+    
+    #-----------------------------------------------------------------------------------------------
+    def run_once(self, setup, run):
+        E = DeviceEmulator(baud = self.options.baud, rtt = self.options.rtt)
+        C = CountingSocket(E.connect())
+        S = btLink.btLink(None, sock=C)
+        S.open()
+        setup(S)
+        
+        C.reset()
+        overflows = E.overflows
+        t_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        run(S)
+        cpu = time.thread_time() - cpu_start
+        wall = time.perf_counter() - t_start
+        
+        S.close()
+        E.stop()
+        
+        return({
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "round_trips": C.round_trips,
+            "bytes_tx": C.bytes_tx,
+            "bytes_rx": C.bytes_rx,
+            "overflows": E.overflows - overflows
+        })
+    
+    #-----------------------------------------------------------------------------------------------
+    def run_parser(self, legacy = False):
+        """
+        Raw response parsing throughput. No device timing
+        If legacy is set, the original byte-at-a-time reader is measured instead, for reference
+        """
+        a, b = socket.socketpair()
+        EchoStandIn(b, self.options.resp_len).start()
+        C = CountingSocket(a)
+        if(legacy):
+            cmd_func = lambda cmd_string: legacy_cmd(C, cmd_string)
+        else:
+            cmd_func = btLink.btLink(None, sock=C).cmd
+        
+        t_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        for i in range(self.options.n_cmds):
+            cmd_func("cfg_read %X\r\n" % (i & 0x3F))
+        cpu = time.thread_time() - cpu_start
+        wall = time.perf_counter() - t_start
+        
+        a.close()
+        b.close()
+        
+        return({
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "round_trips": C.round_trips,
+            "bytes_tx": C.bytes_tx,
+            "bytes_rx": C.bytes_rx,
+            "overflows": 0
+        })
+    
+    #-----------------------------------------------------------------------------------------------
+    def run_compile(self, edit = False):
+        """
+        Config compiler throughput. No link involved
+        If edit is set, measures a recompile after changing one transition instead
+        """
+        cfg = make_large_config(self.options.cfg_objects)
+        if(edit):
+            cfg.compile()
+            t = cfg.modeset_change_table.alarms[0].data.modes[0][0]
+            t.duration += 1.0
+        
+        t_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        cfg.compile()
+        cpu = time.thread_time() - cpu_start
+        wall = time.perf_counter() - t_start
+        
+        return({
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "round_trips": 0,
+            "bytes_tx": 0,
+            "bytes_rx": 0,
+            "overflows": 0
+        })
+    
+    #-----------------------------------------------------------------------------------------------
+    def run_compile_session(self):
+        """
+        Config compiler as used while editing: builds the config and compiles it, then changes
+        one transition and compiles again, --edits times. Unlike the compile benchmark, this
+        includes building the config, and the one-off cost of tracking changes to it that
+        makes each recompile cheaper.
+        """
+        t_start = time.perf_counter()
+        cpu_start = time.thread_time()
+        cfg = make_large_config(self.options.cfg_objects)
+        cfg.compile()
+        modes = cfg.modeset_change_table.alarms[0].data.modes
+        for i in range(self.options.edits):
+            t = modes[i % len(modes)][0]
+            t.duration += 1.0
+            cfg.compile()
+        cpu = time.thread_time() - cpu_start
+        wall = time.perf_counter() - t_start
+        
+        return({
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "round_trips": 0,
+            "bytes_tx": 0,
+            "bytes_rx": 0,
+            "overflows": 0
+        })
+    
+    #-----------------------------------------------------------------------------------------------
+    def median_result(self, runs):
+        result = dict(runs[0])
+        for key in ("wall_s", "cpu_s"):
+            result[key] = statistics.median([r[key] for r in runs])
+        result["overflows"] = max([r["overflows"] for r in runs])
+        return(result)
+    
+    #-----------------------------------------------------------------------------------------------
+    def compare(self, results, filename):
+        with open(filename, 'r') as f:
+            baseline = json.load(f)
+        
+        self.log.info("Compared to %s (revision %s):" % (filename, baseline.get("revision")))
+        for name, result in results.items():
+            if(name not in baseline["results"]):
+                continue
+            old = baseline["results"][name]
+            if(old["wall_s"] == 0):
+                continue
+            self.log.info("  %-18s wall %8.3f s -> %8.3f s (%+6.1f%%)  bytes %7d -> %7d" % (
+                name, old["wall_s"], result["wall_s"],
+                100 * (result["wall_s"] - old["wall_s"]) / old["wall_s"],
+                old["bytes_tx"] + old["bytes_rx"], result["bytes_tx"] + result["bytes_rx"]
+            ))
+    
+    #-----------------------------------------------------------------------------------------------
+    def main(self):
+        App.main(self)
+        
+        benchmarks = self.get_benchmarks()
+        names = ["parser", "parser_legacy", "compile", "recompile", "compile_session"] + list(benchmarks.keys())
+        if(len(self.options.only)):
+            names = [n for n in names if(n in self.options.only)]
+        
+        results = {}
+        for name in names:
+            runs = []
+            for i in range(self.options.repeat):
+                if(name == "parser"):
+                    runs.append(self.run_parser())
+                elif(name == "parser_legacy"):
+                    runs.append(self.run_parser(legacy=True))
+                elif(name == "compile"):
+                    runs.append(self.run_compile())
+                elif(name == "recompile"):
+                    runs.append(self.run_compile(edit=True))
+                elif(name == "compile_session"):
+                    runs.append(self.run_compile_session())
+                else:
+                    runs.append(self.run_once(*benchmarks[name]))
+            results[name] = self.median_result(runs)
+            
+            r = results[name]
+            self.log.info("%-18s %8.3f s wall %8.3f s cpu %6d round trips %7d bytes tx %7d bytes rx" % (
+                name, r["wall_s"], r["cpu_s"], r["round_trips"], r["bytes_tx"], r["bytes_rx"]
+            ))
+            if(name in ("parser", "parser_legacy")):
+                self.log.info("%-18s %10.0f bytes/sec %10.0f cmds/sec" % (
+                    "", r["bytes_rx"] / r["wall_s"], self.options.n_cmds / r["wall_s"]
+                ))
+            if(r["overflows"]):
+                self.log.warning("%s: %d bytes were dropped by the device's RX FIFO" % (name, r["overflows"]))
+        
+        if(self.options.compare):
+            self.compare(results, self.options.compare)
+        
+        if(self.options.output):
+            D = {
+                "revision": get_revision(),
+                "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "params": {
+                    "rtt": self.options.rtt,
+                    "baud": self.options.baud,
+                    "repeat": self.options.repeat,
+                    "cfg_size": self.options.cfg_size,
+                    "ihex_size": self.options.ihex_size,
+                    "n_cmds": self.options.n_cmds,
+                    "resp_len": self.options.resp_len,
+                    "cfg_objects": self.options.cfg_objects,
+                    "edits": self.options.edits
+                },
+                "results": results
+            }
+            with open(self.options.output, 'w') as f:
+                json.dump(D, f, indent=2, sort_keys = True)
+
+####################################################################################################
+if __name__ == '__main__':
+    A = Benchmark()
+    A.main()
@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+import time
+from py_modules.skylight.emulator import DeviceEmulator
+from py_modules.python_modules.app import App
+
+class DeviceEmulatorApp(App):
+    def set_cmdline_args(self, parser):
+        App.set_cmdline_args(self, parser)
+        
+        parser.description = "Skylight LED controller emulator. Serves the firmware CLI on a pseudo-terminal"
+        parser.add_argument("--baud", dest="baud", type=int, default=115200,
+                            help="UART bit rate to pace bytes at. 0 disables pacing")
+        parser.add_argument("--rtt", dest="rtt", type=float, default=0.0,
+                            help="Round trip time of the emulated Bluetooth link in seconds")
+        parser.add_argument("--bootloader", dest="bootloader", action="store_true", default=False,
+                            help="Start in the bootloader")
+    
+    def main(self):
+        App.main(self)
+        
+        E = DeviceEmulator(
+            baud = self.options.baud,
+            rtt = self.options.rtt,
+            bootloader = self.options.bootloader
+        )
+        path = E.open_pty()
+        self.log.info("Emulator listening on %s. Press Ctrl-C to exit" % path)
+        
+        try:
+            while(True):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+        
+        E.stop()
+        self.log.info("%d commands, %d RX FIFO overflows" % (len(E.cmd_log), E.overflows))
+
+####################################################################################################
+if __name__ == '__main__':
+    A = DeviceEmulatorApp()
+    A.main()
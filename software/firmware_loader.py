@@ -1,9 +1,16 @@
 #!/usr/bin/env python3
 
+import os
 import sys
+import time
 import argparse
 import logging
+import concurrent.futures
 import py_modules.skylight.btLink as btLink
+import py_modules.skylight.ihex as ihex
+import py_modules.skylight.discovery as discovery
+from py_modules.skylight.metrics import LinkMetrics
+from py_modules.skylight.capture import Capture
 from py_modules.python_modules.app import App
 
 class FirmwareLoader(App):
@@ -11,30 +18,198 @@ class FirmwareLoader(App):
         App.set_cmdline_args(self, parser)
         
         parser.description = "Skylight LED Firmware Loader"
-        parser.add_argument("-a --addr", dest="addr", default=None,
-                            help="Bluetooth Hardware Address")
+        parser.add_argument("-a", "--addr", dest="addr", action="append", default=[],
+                            help="Bluetooth Hardware Address. Can be given multiple times")
+        parser.add_argument("--all", dest="all", action="store_true", default=False,
+                            help="Flash all discovered devices")
+        parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=4,
+                            help="Maximum number of devices to flash at the same time")
+        parser.add_argument("--retries", dest="retries", type=int, default=2,
+                            help="Number of times to retry a device if its link drops")
+        parser.add_argument("--dry-run", dest="dry_run", action="store_true", default=False,
+                            help="Validate and pack the image, report the record count, then exit")
+        parser.add_argument("--metrics", dest="metrics", default=None,
+                            help="Write per-command latency and throughput statistics to this JSON file")
+        parser.add_argument("--capture", dest="capture", default=None,
+                            help="Record the traffic of each connection attempt into a capture file in this directory")
         parser.add_argument("filename",
                             help="Source Intel-Hex file")
-  
+    
+    def flash_device(self, addr, records, n_retries = 0):
+        """
+        Flashes a single device. Runs in a worker thread.
+        If this is a retry, resumes from the last record the device acknowledged.
+        Returns the number of seconds spent sending the image
+        """
+        n_bytes = sum([len(r.data) for r in records])
+        last_report = [0]
+        
+        def progress(n_done, n_total):
+            self.acked[addr] = n_done
+            
+            # Report every 10%
+            pct = (100 * n_done) // n_total
+            if((pct >= last_report[0] + 10) or (n_done == n_total)):
+                last_report[0] = pct
+                elapsed = max(time.time() - t_start, 0.001)
+                self.log.info("%s: %3d%% (%d/%d records, %.0f bytes/s)" % (
+                    addr, pct, n_done, n_total, (n_bytes * n_done / n_total) / elapsed
+                ))
+        
+        if(self.options.capture):
+            capture = Capture()
+        else:
+            capture = None
+        
+        try:
+            with btLink.btLink(addr, metrics=self.metrics, capture=capture) as S:
+                resume_from = self.acked.get(addr, 0)
+                if(resume_from and (S.cmd("id\r\n") != "BL")):
+                    # Device left the bootloader since. Its flash contents are unknown
+                    self.log.warning("%s: Device was reset. Restarting upload" % addr)
+                    resume_from = 0
+                elif(resume_from):
+                    self.log.info("%s: Resuming upload at record %d" % (addr, resume_from))
+                
+                S.enter_bootloader()
+                t_start = time.time()
+                S.send_ihex(records, progress=progress, coalesce=False, resume_from=resume_from)
+                t_elapsed = time.time() - t_start
+                S.exit_bootloader()
+                S.set_time()
+        finally:
+            if(capture != None):
+                # One file per attempt, so that a retry does not overwrite the capture of the
+                # attempt that failed
+                filename = os.path.join(
+                    self.options.capture, "%s.%d.cap" % (addr.replace(":", "-"), n_retries)
+                )
+                try:
+                    capture.save(filename)
+                except OSError as e:
+                    # Don't mask the outcome of the upload itself
+                    self.log.error("%s: Could not save capture to %s: %s" % (addr, filename, e))
+                else:
+                    self.log.info("%s: Traffic captured to %s" % (addr, filename))
+        
+        return(t_elapsed)
+    
     def main(self):
         App.main(self)
         
-        # Autodiscover device if necessary
-        if(self.options.addr == None):
-            self.log.info("Bluetooth address not specified. Searching for matching device...")
-            devs = btLink.discover()
-            if(len(devs) == 0):
-                self.log.error("No devices found")
+        # Parse, validate and pack the image once. It is shared by all workers
+        file_records = ihex.read_file(self.options.filename)
+        records = ihex.coalesce(file_records)
+        self.log.info("Image: %d records to send (%d in file)" % (len(records), len(file_records)))
+        if(self.options.dry_run):
+            return
+        
+        if(self.options.capture):
+            try:
+                os.makedirs(self.options.capture, exist_ok=True)
+            except OSError as e:
+                self.log.error("Cannot use capture directory %s: %s" % (self.options.capture, e))
                 sys.exit(1)
+        
+        # Drop duplicates, keeping order
+        addrs = []
+        for addr in self.options.addr:
+            if(addr not in addrs):
+                addrs.append(addr)
+        
+        # Autodiscover devices if necessary
+        if(self.options.all or (len(addrs) == 0)):
+            self.log.info("Searching for matching devices...")
+            if(self.options.all):
+                # Known devices may not be the only ones around. Always do an inquiry
+                for addr, name in discovery.discover(full_inquiry=True):
+                    self.log.info("Using device: %s - %s" % (addr, name))
+                    if(addr not in addrs):
+                        addrs.append(addr)
             else:
-                self.log.info("Using device: %s - %s" % (devs[0][0], devs[0][1]))
-                self.options.addr = devs[0][0]
-        
-        with btLink.btLink(self.options.addr) as S:
-            S.enter_bootloader()
-            S.send_ihex(self.options.filename)
-            S.exit_bootloader()
-            S.set_time()
+                for addr, name in discovery.discover():
+                    self.log.info("Using device: %s - %s" % (addr, name))
+                    addrs = [addr]
+                    break
+            
+            if(len(addrs) == 0):
+                self.log.error("No devices found")
+                sys.exit(1)
+        
+        if(self.options.metrics):
+            # Shared by all workers
+            self.metrics = LinkMetrics()
+        else:
+            self.metrics = None
+        
+        results = {}
+        self.acked = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.options.jobs) as executor:
+            pending = {}
+            for addr in addrs:
+                pending[executor.submit(self.flash_device, addr, records)] = (addr, 0)
+            
+            # Retries that are backing off to give the link time to recover, as
+            # (due time, address, retry number). They are only submitted once due, so that
+            # they don't hold up a worker that another device could use in the meantime
+            backing_off = []
+            
+            while((len(pending) != 0) or (len(backing_off) != 0)):
+                now = time.monotonic()
+                for retry in [r for r in backing_off if(r[0] <= now)]:
+                    backing_off.remove(retry)
+                    _, addr, n_retries = retry
+                    pending[executor.submit(self.flash_device, addr, records, n_retries)] = (addr, n_retries)
+                
+                if(len(backing_off) != 0):
+                    timeout = max(min([r[0] for r in backing_off]) - now, 0)
+                else:
+                    timeout = None
+                
+                if(len(pending) == 0):
+                    time.sleep(timeout)
+                    continue
+                
+                done, _ = concurrent.futures.wait(pending, timeout=timeout, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    addr, n_retries = pending.pop(f)
+                    try:
+                        t_elapsed = f.result()
+                    except btLink.CMDError as e:
+                        self.log.error("%s: %s" % (addr, e))
+                        results[addr] = "FAIL (%s)" % e
+                    except OSError as e:
+                        # Connect failure or dropped link
+                        if(n_retries < self.options.retries):
+                            delay = min(2**(n_retries+1), 30)
+                            self.log.warning("%s: Link error (%s). Retrying in %d s after %d/%d records." % (
+                                addr, e, delay, self.acked.get(addr, 0), len(records)
+                            ))
+                            backing_off.append((time.monotonic() + delay, addr, n_retries+1))
+                        else:
+                            self.log.error("%s: Link error (%s). Giving up." % (addr, e))
+                            results[addr] = "FAIL (%s)" % e
+                    except Exception as e:
+                        self.log.exception("%s: Unexpected error" % addr)
+                        results[addr] = "FAIL (%s)" % e
+                    else:
+                        results[addr] = "PASS (%.1f s)" % t_elapsed
+        
+        # Summary
+        n_failed = 0
+        self.log.info("Summary:")
+        for addr in addrs:
+            self.log.info("  %s: %s" % (addr, results[addr]))
+            if(not results[addr].startswith("PASS")):
+                n_failed += 1
+        self.log.info("%d passed, %d failed" % (len(addrs) - n_failed, n_failed))
+        
+        if(self.metrics != None):
+            with open(self.options.metrics, 'w') as f:
+                f.write(self.metrics.to_json())
+        
+        if(n_failed):
+            sys.exit(1)
 
 ####################################################################################################
 if __name__ == '__main__':
@@ -0,0 +1,344 @@
+import asyncio
+import socket
+import logging
+
+from . import btLink as bt
+from . import ihex as ihex_file
+from .btLink import CMDError
+
+#---------------------------------------------------------------------------------------------------
+class AsyncBtLink:
+    """
+    asyncio counterpart of btLink.
+    Offers the same command surface as coroutines so that one event loop can drive many devices.
+    
+    Every command is bounded by a timeout. If a command times out, the link may still
+    deliver its late response, so the link should be closed and reopened.
+    """
+    def __init__(self, addr, timeout = 10, sock = None):
+        """
+        addr: Bluetooth address of the device
+        timeout: Default timeout in seconds for each command
+        sock: Optional socket that is already connected to a device.
+            If not provided, an RFCOMM socket is created and connected to addr in open()
+        """
+        self.addr = addr
+        self.timeout = timeout
+        self.sock = sock
+        self.log = logging.getLogger("skylight")
+        self.connected = False
+        
+        self.reader = None
+        self.writer = None
+        
+        # Size of the RX FIFO of the firmware that is currently running.
+        self.rx_buf_size = bt.APP_RX_BUF_SIZE
+        
+        # Whether the running firmware has the base64 config commands. None until probed
+        self.cfg64 = None
+    
+    #-----------------------------------------------------------------------------------------------
+    async def __aenter__(self):
+        await self.open()
+        return(self)
+    
+    #-----------------------------------------------------------------------------------------------
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+    
+    #-----------------------------------------------------------------------------------------------
+    async def open(self):
+        if(self.sock == None):
+            # Linux's native RFCOMM sockets can be driven by the event loop. pybluez's can not.
+            sock = socket.socket(socket.AF_BLUETOOTH, socket.SOCK_STREAM, socket.BTPROTO_RFCOMM)
+            sock.setblocking(False)
+            loop = asyncio.get_running_loop()
+            try:
+                await asyncio.wait_for(loop.sock_connect(sock, (self.addr, 1)), self.timeout)
+            except:
+                sock.close()
+                raise
+        else:
+            sock = self.sock
+            sock.setblocking(False)
+        
+        self.reader, self.writer = await asyncio.open_connection(sock=sock)
+        
+        await self.initialize_link()
+        
+        self.connected = True
+    
+    #-----------------------------------------------------------------------------------------------
+    async def initialize_link(self):
+        # flush out any partial commands
+        try:
+            await self.cmd("\r\n")
+        except CMDError:
+            # ignore.
+            pass
+        
+        try:
+            await self.cmd("echo 0\r\n")
+        except CMDError:
+            # ignore.
+            pass
+    
+    #-----------------------------------------------------------------------------------------------
+    async def close(self):
+        if(self.writer != None):
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.writer = None
+            self.reader = None
+        self.connected = False
+    
+    #-----------------------------------------------------------------------------------------------
+    async def drain(self, timeout = None):
+        """
+        Waits until the link has accepted everything written to it.
+        Raises asyncio.TimeoutError if that takes longer than timeout seconds.
+        """
+        if(timeout == None):
+            timeout = self.timeout
+        await asyncio.wait_for(self.writer.drain(), timeout)
+    
+    #-----------------------------------------------------------------------------------------------
+    async def read_response(self, timeout = None):
+        """
+        Receives until the next '>' prompt and returns the list of response lines
+        """
+        if(timeout == None):
+            timeout = self.timeout
+        
+        try:
+            raw = await asyncio.wait_for(self.reader.readuntil(b">"), timeout)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError("Link was closed while waiting for a response")
+        return(bt.split_response(raw[:-1]))
+    
+    #-----------------------------------------------------------------------------------------------
+    async def cmd(self, cmd_string, timeout = None):
+        """
+        Sends command string and waits for response. See btLink.cmd()
+        Raises asyncio.TimeoutError if the link does not accept the command, or no response
+        arrives, within timeout seconds.
+        """
+        self.log.debug("cmd: %s" % cmd_string.strip())
+        self.writer.write(cmd_string.encode("ascii"))
+        await self.drain(timeout)
+        
+        resp = await self.read_response(timeout)
+        for resp_line in resp:
+            self.log.debug("resp_line: %s" % resp_line)
+        
+        if(bt.is_error_response(resp)):
+            raise CMDError("Command responded with an error", cmd_string)
+        
+        return(bt.collapse_response(resp))
+    
+    #-----------------------------------------------------------------------------------------------
+    async def cmd_pipelined(self, cmd_list, rx_buf_size = None, timeout = None):
+        """
+        Sends a list of command strings, keeping several in flight at once.
+        See btLink.cmd_pipelined(). The timeout applies to each individual response.
+        """
+        if(rx_buf_size == None):
+            rx_buf_size = self.rx_buf_size
+        
+        P = bt.CmdPipeline(cmd_list, rx_buf_size)
+        while(not P.done()):
+            chunk = P.get_tx_chunk()
+            if(len(chunk) != 0):
+                self.writer.write(chunk)
+                continue
+            
+            await self.drain(timeout)
+            resp = await self.read_response(timeout)
+            idx = P.got_response(resp)
+            self.log.debug("cmd: %s -> %s" % (cmd_list[idx].strip(), resp))
+        
+        if(P.error_index != None):
+            raise CMDError(
+                "Command #%d responded with an error: %s" % (P.error_index, cmd_list[P.error_index].strip()),
+                cmd_list[P.error_index], P.error_index
+            )
+        
+        return([bt.collapse_response(resp) for resp in P.responses])
+    
+    #-----------------------------------------------------------------------------------------------
+    async def enter_bootloader(self):
+        """
+        Check if in bootloader. If not, enter it
+        """
+        if(await self.cmd("id\r\n") != "BL"):
+            await self.cmd("reset\r\n")
+            
+            if(await self.cmd("id\r\n") != "BL"):
+                raise CMDError("Failed to enter bootloader")
+        
+        self.rx_buf_size = bt.BL_RX_BUF_SIZE
+    
+    #-----------------------------------------------------------------------------------------------
+    async def exit_bootloader(self):
+        """
+        Check if in bootloader. If so, exit it
+        """
+        if(await self.cmd("id\r\n") == "BL"):
+            await self.cmd("boot\r\n")
+            
+            if(await self.cmd("id\r\n") == "BL"):
+                raise CMDError("Failed to exit bootloader")
+        
+        self.rx_buf_size = bt.APP_RX_BUF_SIZE
+        
+        # Application may have been replaced
+        self.cfg64 = None
+    
+    #-----------------------------------------------------------------------------------------------
+    async def send_ihex(self, ihex, coalesce = True):
+        """
+        Sends an Intel-Hex image to the bootloader. See btLink.send_ihex()
+        Returns a tuple: (records sent, records in file)
+        """
+        if(type(ihex) == str):
+            self.log.info("Sending file: %s" % ihex)
+            ihex = ihex_file.read_file(ihex)
+        
+        n_file = len(ihex)
+        if(coalesce):
+            ihex = ihex_file.coalesce(ihex)
+        
+        cmd_list = []
+        for record in ihex:
+            cmd_list.append("ihex %s\r\n" % record.to_string())
+        
+        await self.cmd_pipelined(cmd_list, bt.BL_RX_BUF_SIZE)
+        return((len(ihex), n_file))
+    
+    #-----------------------------------------------------------------------------------------------
+    async def set_time(self):
+        for cmd_string in bt.set_time_cmds():
+            await self.cmd(cmd_string)
+    
+    #-----------------------------------------------------------------------------------------------
+    async def get_time(self):
+        return(bt.parse_time(await self.cmd("get_time\r\n")))
+    
+    #-----------------------------------------------------------------------------------------------
+    async def get_ref_time(self):
+        return(bt.parse_time(await self.cmd("get_ref_time\r\n")))
+    
+    #-----------------------------------------------------------------------------------------------
+    async def get_ttl_clk_correct(self):
+        return(bt.parse_clk_correct(await self.cmd("get_ttl_clk_correct\r\n")))
+    
+    #-----------------------------------------------------------------------------------------------
+    async def set_rgbw(self, color):
+        await self.cmd(bt.rgbw_cmd(color))
+    
+    #-----------------------------------------------------------------------------------------------
+    async def supports_cfg64(self):
+        """
+        See btLink.supports_cfg64()
+        """
+        if(self.cfg64 == None):
+            try:
+                bt.decode_page64(await self.cmd("cfg_read64 0\r\n"))
+                self.cfg64 = True
+            except CMDError:
+                self.cfg64 = False
+        return(self.cfg64)
+    
+    #-----------------------------------------------------------------------------------------------
+    async def unload_config(self):
+        """
+        See btLink.unload_config()
+        """
+        try:
+            await self.cmd("cfg_unload\r\n")
+        except CMDError:
+            return(False)
+        return(True)
+    
+    #-----------------------------------------------------------------------------------------------
+    async def read_config(self, n_pages):
+        b64 = await self.supports_cfg64()
+        resp = await self.cmd_pipelined(bt.config_read_cmds(n_pages, b64), bt.APP_RX_BUF_SIZE)
+        return(bt.decode_config_pages(resp, b64))
+    
+    #-----------------------------------------------------------------------------------------------
+    async def send_config(self, image, diff = False, prev_image = None):
+        """
+        Uploads a compiled configuration image and reloads it. See btLink.send_config()
+        Returns a tuple: (pages written, pages skipped)
+        """
+        image = bt.pad_config(image)
+        n_pages = len(image)//bt.EE_PAGE_SIZE
+        
+        if(diff and not await self.unload_config()):
+            self.log.warning("%s: Firmware cannot rewrite config pages in place. Sending all pages." % self.addr)
+            diff = False
+        
+        if(diff):
+            if(prev_image == None):
+                prev_image = await self.read_config(n_pages)
+            pages = bt.diff_config_pages(image, prev_image)
+        else:
+            pages = range(n_pages)
+        
+        cmd_list = bt.config_write_cmds(image, pages, not diff, await self.supports_cfg64())
+        await self.cmd_pipelined(cmd_list, bt.APP_RX_BUF_SIZE)
+        
+        if(diff):
+            try:
+                bt.compare_config(image, await self.read_config(n_pages))
+            except CMDError:
+                # The copy that the diff was based on did not match what the device held
+                self.log.warning("%s: Config readback mismatch after differential upload. Resending all pages." % self.addr)
+                pages = range(n_pages)
+                cmd_list = bt.config_write_cmds(image, pages, True, await self.supports_cfg64())
+                await self.cmd_pipelined(cmd_list, bt.APP_RX_BUF_SIZE)
+                bt.compare_config(image, await self.read_config(n_pages))
+        
+        n_written = len(pages)
+        n_skipped = n_pages - n_written
+        self.log.info("%s: Config upload: %d pages written, %d skipped" % (self.addr, n_written, n_skipped))
+        return((n_written, n_skipped))
+    
+    #-----------------------------------------------------------------------------------------------
+    async def sample_chroma(self, T_i):
+        return(bt.parse_chroma(await self.cmd("chroma %X\r\n" % T_i)))
+    
+    #-----------------------------------------------------------------------------------------------
+    async def find_chroma_T_i(self):
+        """
+        See btLink.find_chroma_T_i()
+        """
+        search = bt.chroma_T_i_search()
+        T_i, delay = next(search)
+        while(True):
+            await asyncio.sleep(delay)
+            sample = await self.sample_chroma(T_i)
+            self.log.debug("Sampled at T_i=%d, Max=0x%04X" % (T_i, max(sample)))
+            try:
+                T_i, delay = search.send(sample)
+            except StopIteration as e:
+                return(e.value)
+    
+    #-----------------------------------------------------------------------------------------------
+    async def measure_chroma(self, n_average = 1):
+        """
+        Takes a color measurement from the VEML6040 sensor. See btLink.measure_chroma()
+        """
+        T_i, sample = await self.find_chroma_T_i()
+        
+        # Do additional samples to average
+        sample_list = [sample]
+        if(n_average > 1):
+            resp = await self.cmd_pipelined(["chroma %X\r\n" % T_i] * (n_average-1))
+            sample_list += [bt.parse_chroma(r) for r in resp]
+        
+        return(bt.average_chroma(sample_list, T_i))
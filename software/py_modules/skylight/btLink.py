@@ -1,30 +1,569 @@
 
 import sys
-import re
 
 try:
     import bluetooth
 except ImportError:
-    print("Missing 3rd party package 'pybluez'. Install using:")
-    print("  sudo pip3 install pybluez")
-    sys.exit(1)
+    # Only required when talking to real hardware. See require_pybluez()
+    bluetooth = None
 
 import logging
 import time
 import datetime
 import binascii
+import base64
+import struct
+import socket
+
+from . import ihex as ihex_file
+from .metrics import cmd_verb
+from .capture import CaptureSocket
+from . import chroma
+
+# Max number of bytes requested from the socket per recv() call
+RX_CHUNK_SIZE = 1024
+
+# Size of the UART receive FIFO in each firmware image (RX_BUF_SIZE in config/uart_io_config.h)
+APP_RX_BUF_SIZE = 32
+BL_RX_BUF_SIZE = 64
+
+# Size of an EEPROM page, as used by the cfg_write and cfg_read commands
+EE_PAGE_SIZE = 32
 
 class CMDError(Exception):
+    def __init__(self, msg, cmd_string = None, cmd_index = None):
+        Exception.__init__(self, msg)
+        
+        # Command that responded with the error
+        self.cmd_string = cmd_string
+        
+        # Position of the failing command within a pipelined batch
+        self.cmd_index = cmd_index
+
+class Cancelled(Exception):
+    """
+    Raised when an operation is stopped through btLink.cancel_event.
+    The link remains usable.
+    """
     pass
 
+#---------------------------------------------------------------------------------------------------
+def require_pybluez():
+    if(bluetooth == None):
+        print("Missing 3rd party package 'pybluez'. Install using:")
+        print("  sudo pip3 install pybluez")
+        sys.exit(1)
+
+#---------------------------------------------------------------------------------------------------
+def is_timeout(e):
+    # pybluez reports a socket timeout as a BluetoothError rather than socket.timeout
+    return(isinstance(e, socket.timeout) or (str(e) == "timed out"))
+
+#---------------------------------------------------------------------------------------------------
+def split_response(raw):
+    """
+    Splits the raw bytes of a response (prompt excluded) into a list of lines.
+    Carriage returns are discarded and empty lines are dropped.
+    """
+    lines = raw.replace(b"\r", b"").decode("ascii").split("\n")
+    return([line for line in lines if(len(line) != 0)])
+
+#---------------------------------------------------------------------------------------------------
+def is_error_response(resp):
+    """
+    Returns True if the list of response lines ends with an error
+    """
+    return((len(resp) != 0) and (resp[-1] == "ERR"))
+
+#---------------------------------------------------------------------------------------------------
+def collapse_response(resp):
+    """
+    Converts a list of response lines into the value returned by btLink.cmd()
+    No response becomes "", and a single line is returned as a plain string
+    """
+    if(len(resp) == 0):
+        return("")
+    elif(len(resp) == 1):
+        return(resp[0])
+    return(resp)
+
+#---------------------------------------------------------------------------------------------------
+# Command encoding and response decoding
+# Shared by the blocking btLink and AsyncBtLink
+#---------------------------------------------------------------------------------------------------
+def set_time_cmds():
+    """
+    Returns the commands that set the device clock to the current local time
+    """
+    now = time.localtime()
+    return([
+        "set_time %x %x %x %x %x %x\r\n" % (
+            now.tm_year,
+            now.tm_mon,
+            now.tm_mday,
+            now.tm_hour,
+            now.tm_min,
+            now.tm_sec
+        ),
+        "set_dst %d %d\r\n" % (time.daylight, now.tm_isdst)
+    ])
+
+#---------------------------------------------------------------------------------------------------
+def parse_time(resp):
+    """
+    Decodes the response of get_time or get_ref_time
+    Returns None if the time was never set
+    """
+    resp = resp.split()
+    
+    year = int(resp[1], 16)
+    month = int(resp[2], 16)
+    day = int(resp[3], 16)
+    hour = int(resp[4], 16)
+    minute = int(resp[5], 16)
+    second = int(resp[6], 16)
+    
+    if(year == 0):
+        return(None)
+    
+    T = datetime.datetime(year, month, day, hour, minute, second)
+    return(T)
+
+#---------------------------------------------------------------------------------------------------
+def parse_clk_correct(resp):
+    """
+    Decodes the signed 32-bit response of get_ttl_clk_correct
+    """
+    resp = int(resp,16)
+    if(resp > 0x7FFFFFFF):
+        resp -= 0x100000000
+        
+    return(resp)
+
+#---------------------------------------------------------------------------------------------------
+class DeviceStatus:
+    """
+    Snapshot of the device clock and config header, as returned by btLink.get_status()
+    
+    time: Device time. None if the time was never set
+    ref_time: Time at which the device clock was last set. None if never set
+    ttl_clk_correct: Minutes that clock correction has added/subtracted since ref_time
+    config_timestamp: Build timestamp stamped into the config header
+    clock_correction_interval: Clock correction interval from the config header
+    build_timestamp: Build timestamp of the running firmware. None if not reported
+    host_time: Local time at the midpoint of the round trip that sampled the device time
+    rtt: Duration of that round trip in seconds
+    """
+    def __init__(self):
+        self.time = None
+        self.ref_time = None
+        self.ttl_clk_correct = 0
+        self.config_timestamp = None
+        self.clock_correction_interval = None
+        self.build_timestamp = None
+        self.host_time = None
+        self.rtt = None
+    
+    #-----------------------------------------------------------------------------------------------
+    def config_loaded(self):
+        """
+        Returns True if the firmware accepted the config. None if unknown
+        """
+        if(self.build_timestamp == None):
+            return(None)
+        return(self.config_timestamp == self.build_timestamp)
+
+#---------------------------------------------------------------------------------------------------
+def parse_status(resp):
+    """
+    Decodes the response of the status command into a DeviceStatus
+    """
+    if((type(resp) != list) or (len(resp) != 4)):
+        raise CMDError("Malformed status response: %s" % resp)
+    
+    S = DeviceStatus()
+    S.time = parse_time(resp[0])
+    S.ref_time = parse_time(resp[1])
+    S.ttl_clk_correct = parse_clk_correct(resp[2])
+    header = resp[3].split()
+    S.config_timestamp = int(header[0], 16)
+    # Same signed 32-bit encoding as get_ttl_clk_correct
+    S.clock_correction_interval = parse_clk_correct(header[1])
+    S.build_timestamp = int(header[2], 16)
+    return(S)
+
+#---------------------------------------------------------------------------------------------------
+def rgbw_cmd(color):
+    rgbw = color.get_rgbw()
+    return("rgbw %x %x %x %x\r\n" % rgbw)
+
+#---------------------------------------------------------------------------------------------------
+def pad_config(image):
+    """
+    Pad image to be a multiple of the page size (32-bytes)
+    """
+    if((len(image)%EE_PAGE_SIZE) != 0):
+        image += b"\xFF" * (EE_PAGE_SIZE - len(image)%EE_PAGE_SIZE)
+    return(image)
+
+#---------------------------------------------------------------------------------------------------
+def crc8(data):
+    """
+    CRC-8 with polynomial 0x07 and initial value 0.
+    Matches avr-libc's _crc8_ccitt_update()
+    """
+    crc = 0
+    for b in data:
+        crc ^= b
+        for i in range(8):
+            if(crc & 0x80):
+                crc = ((crc << 1) ^ 0x07) & 0xFF
+            else:
+                crc = (crc << 1) & 0xFF
+    return(crc)
+
+#---------------------------------------------------------------------------------------------------
+def encode_page64(data):
+    """
+    Encodes a config page for cfg_write64: Base64 of the page data followed by its CRC-8
+    """
+    return(base64.b64encode(data + bytes([crc8(data)])).decode('ascii'))
+
+#---------------------------------------------------------------------------------------------------
+def decode_page64(resp):
+    """
+    Decodes the response of cfg_read64
+    """
+    try:
+        b = base64.b64decode(resp, validate=True)
+    except (binascii.Error, ValueError):
+        raise CMDError("Malformed cfg_read64 response: %s" % resp)
+    
+    if((len(b) != EE_PAGE_SIZE + 1) or (crc8(b[:-1]) != b[-1])):
+        raise CMDError("cfg_read64 response failed CRC check: %s" % resp)
+    return(b[:-1])
+
+#---------------------------------------------------------------------------------------------------
+def config_read_cmds(n_pages, b64 = False):
+    cmd_list = []
+    for page in range(n_pages):
+        if(b64):
+            cmd_list.append("cfg_read64 %X\r\n" % page)
+        else:
+            cmd_list.append("cfg_read %X\r\n" % page)
+    return(cmd_list)
+
+#---------------------------------------------------------------------------------------------------
+def decode_config_pages(resp, b64 = False):
+    """
+    Joins the responses of the commands from config_read_cmds() into an image
+    """
+    if(b64):
+        return(b"".join([decode_page64(r) for r in resp]))
+    return(binascii.unhexlify("".join(resp)))
+
+#---------------------------------------------------------------------------------------------------
+def config_write_cmds(image, pages, erase, b64 = False):
+    """
+    Returns the commands that write the selected pages of image and reload the config.
+    If erase is set, the whole EEPROM is erased first.
+    If b64 is set, pages are sent with the denser cfg_write64 command.
+    """
+    if(erase):
+        cmd_list = ["cfg_erase\r\n"]
+    else:
+        cmd_list = []
+    
+    for page in pages:
+        addr = page * EE_PAGE_SIZE
+        data = image[addr:addr+EE_PAGE_SIZE]
+        if(b64):
+            cmd_list.append("cfg_write64 %X %s\r\n" % (page, encode_page64(data)))
+        else:
+            hex_str = binascii.hexlify(data).decode('ascii')
+            cmd_list.append("cfg_write %X %s\r\n" % (page, hex_str))
+    
+    cmd_list.append("cfg_reload\r\n")
+    return(cmd_list)
+
+#---------------------------------------------------------------------------------------------------
+def diff_config_pages(image, prev_image):
+    """
+    Returns the list of pages of image that need to be written over prev_image.
+    The header page is always included since the firmware stamps it with its build
+    timestamp, which cannot be known in advance.
+    """
+    pages = [0]
+    for page in range(1, len(image)//EE_PAGE_SIZE):
+        addr = page * EE_PAGE_SIZE
+        if(image[addr:addr+EE_PAGE_SIZE] != prev_image[addr:addr+EE_PAGE_SIZE]):
+            pages.append(page)
+    return(pages)
+
+#---------------------------------------------------------------------------------------------------
+def parse_config_timestamp(header):
+    return(struct.unpack("<I", header[:4])[0])
+
+#---------------------------------------------------------------------------------------------------
+def compare_config(image, readback):
+    """
+    Compares a readback of the configuration EEPROM against image.
+    The header timestamp is excluded since the firmware replaces it.
+    Raises CMDError on mismatch. Otherwise returns the header timestamp.
+    """
+    readback = readback[:len(image)]
+    if(readback[4:] != image[4:]):
+        raise CMDError("Config readback does not match the uploaded image")
+    return(parse_config_timestamp(readback))
+
+#---------------------------------------------------------------------------------------------------
+def parse_chroma(resp):
+    resp = resp.split()
+    for i,v in enumerate(resp):
+        resp[i] = int(v,16)
+    return(resp)
+
+#---------------------------------------------------------------------------------------------------
+def next_chroma_T_i(T_i, sample):
+    """
+    Picks the VEML6040 integration time to use after a sample taken at T_i.
+    Returns None if T_i is already the best possible setting.
+    """
+    if(max(sample) > (0x10000*0.90)):
+        # T_i is too long for the brightness
+        if(T_i == 0):
+            # T_i is already at the lowest setting.
+            return(None)
+        
+        return(T_i - 1)
+    elif(max(sample) < (0x8000*0.90)):
+        # Could use a longer T_i
+        if(T_i == 5):
+            # T_i is already at the highest setting.
+            return(None)
+        
+        return(T_i + 1)
+    else:
+        # Sample is within decent range
+        return(None)
+
+#---------------------------------------------------------------------------------------------------
+def chroma_T_i_search():
+    """
+    Samples at different integration times to find the one that gives the best resolution
+    without clipping. Does not do any I/O, so that btLink and AsyncBtLink share it.
+    Generator. Yields (T_i, delay) tuples. For each, wait delay seconds, then take a sample at
+    T_i and send it in. Once done, returns a tuple: (T_i, sample taken at T_i)
+    """
+    T_i = 3
+    delay = 0
+    retry_count = 3
+    while(True):
+        sample = yield((T_i, delay))
+        
+        if(retry_count == 0):
+            # Out of retries. Settle for the last T_i, which sample was taken at
+            return((T_i, sample))
+        
+        T_i_next = next_chroma_T_i(T_i, sample)
+        if(T_i_next == None):
+            return((T_i, sample))
+        
+        retry_count -= 1
+        
+        # VEML6040 seems to need some time between switching integration times
+        delay = 0.040 * (2**T_i)
+        T_i = T_i_next
+
+#---------------------------------------------------------------------------------------------------
+def average_chroma(sample_list, T_i):
+    """
+    Post process samples
+    - Take average
+    - Normalize scale based on T_i used
+    Uses numpy if it is installed
+    """
+    if(chroma.numpy != None):
+        return(chroma.analyze_chroma(sample_list, T_i, None).mean)
+    
+    result = [0,0,0,0]
+    for s in sample_list:
+        for i,c in enumerate(s):
+            result[i] += c
+    for i,c in enumerate(result):
+        c *= 2**(5-T_i)
+        result[i] = c/len(sample_list)
+        
+    return(result)
+
+#---------------------------------------------------------------------------------------------------
+class CmdPipeline:
+    """
+    Keeps track of a batch of commands that are sent without waiting for each prompt.
+    Responses are matched to commands in FIFO order.
+    
+    While the device executes a command, anything sent after it piles up in the firmware's
+    UART RX FIFO. To guarantee that FIFO never overflows, the number of bytes in flight past
+    the end of the oldest unacknowledged command is limited to rx_buf_size.
+    The CLI executes a command as soon as it reads the '\r', so the trailing '\n' of the
+    executing command also occupies a FIFO slot. It is accounted for by reserving one byte.
+    
+    This class does no I/O. The owner repeatedly sends whatever get_tx_chunk() returns and,
+    when it returns nothing, waits for the next response and passes it to got_response().
+    """
+    def __init__(self, cmd_list, rx_buf_size):
+        self.cmds = [c.encode("ascii") for c in cmd_list]
+        self.rx_buf_size = rx_buf_size - 1
+        
+        # List of response line lists, in command order
+        self.responses = []
+        
+        # Index of the first command that responded with ERR
+        self.error_index = None
+        
+        # Set once abort() was called
+        self.aborted = False
+        
+        # Command currently being transmitted, and how much of it was sent already
+        self.tx_index = 0
+        self.tx_offset = 0
+        
+        # Bytes sent past the end of the oldest unacknowledged command
+        self.queued = 0
+    
+    #-----------------------------------------------------------------------------------------------
+    def n_acked(self):
+        return(len(self.responses))
+    
+    #-----------------------------------------------------------------------------------------------
+    def n_started(self):
+        if(self.tx_offset):
+            return(self.tx_index + 1)
+        return(self.tx_index)
+    
+    #-----------------------------------------------------------------------------------------------
+    def done(self):
+        """
+        Returns True once there is nothing left to send and every sent command has responded
+        """
+        if(self.stopping()):
+            return(self.n_acked() == self.n_started())
+        if(self.tx_index < len(self.cmds)):
+            return(False)
+        return(self.n_acked() == self.n_started())
+    
+    #-----------------------------------------------------------------------------------------------
+    def abort(self):
+        """
+        Stops starting new commands. Commands that were started still need their response.
+        """
+        self.aborted = True
+    
+    #-----------------------------------------------------------------------------------------------
+    def stopping(self):
+        return(self.aborted or (self.error_index != None))
+    
+    #-----------------------------------------------------------------------------------------------
+    def get_tx_chunk(self):
+        """
+        Returns the next bytes that may be sent without risking an overflow.
+        Returns b"" if the next response needs to be received first.
+        """
+        if(self.tx_index >= len(self.cmds)):
+            return(b"")
+        
+        if(self.stopping() and (self.tx_offset == 0)):
+            # A command failed or the batch was aborted.
+            # Finish what was started but do not start anything new
+            return(b"")
+        
+        cmd = self.cmds[self.tx_index]
+        n = len(cmd) - self.tx_offset
+        if(self.tx_index != self.n_acked()):
+            # Device may be busy executing an earlier command. Anything sent will be buffered
+            n = min(n, self.rx_buf_size - self.queued)
+            if(n <= 0):
+                return(b"")
+            self.queued += n
+        
+        chunk = cmd[self.tx_offset:self.tx_offset+n]
+        self.tx_offset += n
+        if(self.tx_offset == len(cmd)):
+            self.tx_index += 1
+            self.tx_offset = 0
+        return(chunk)
+    
+    #-----------------------------------------------------------------------------------------------
+    def got_response(self, resp):
+        """
+        Attributes a response (list of lines) to the oldest unacknowledged command.
+        Returns the index of that command.
+        """
+        idx = self.n_acked()
+        if(idx >= self.n_started()):
+            raise CMDError("Received a response without a pending command")
+        
+        self.responses.append(resp)
+        if(is_error_response(resp) and (self.error_index == None)):
+            self.error_index = idx
+        
+        # The next command becomes the oldest one. Its bytes no longer count as queued
+        idx += 1
+        if(idx < self.tx_index):
+            self.queued -= len(self.cmds[idx])
+        elif(idx == self.tx_index):
+            self.queued -= self.tx_offset
+        
+        return(idx - 1)
+
+#---------------------------------------------------------------------------------------------------
 class btLink:
-    def __init__(self, addr, timeout = 10):
-        self.S = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+    def __init__(self, addr, timeout = 10, sock = None, metrics = None, capture = None):
+        """
+        addr: Bluetooth address of the device
+        timeout: Socket timeout in seconds
+        sock: Optional socket-like object that is already connected to a device.
+            If not provided, an RFCOMM socket is created and connected to addr in open()
+        metrics: Optional metrics.LinkMetrics object that collects per-command statistics
+        capture: Optional capture.Capture ring buffer that records all traffic on the link
+        """
+        if(sock == None):
+            require_pybluez()
+            self.S = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+            self.connect_sock = True
+        else:
+            self.S = sock
+            self.connect_sock = False
+        
+        self.capture = capture
+        if(capture != None):
+            self.S = CaptureSocket(self.S, capture)
         self.timeout = timeout
         self.addr = addr
         self.log = logging.getLogger("skylight")
         self.connected = False
         
+        # Bytes received from the device that have not been consumed yet.
+        # Anything past the end of a response is kept here for the next one.
+        self.rx_buf = bytearray()
+        
+        # Size of the RX FIFO of the firmware that is currently running.
+        # Bounds how many bytes a pipelined batch may have in flight.
+        self.rx_buf_size = APP_RX_BUF_SIZE
+        
+        # Statistics are only collected if set
+        self.metrics = metrics
+        
+        # Whether the running firmware has the base64 config commands. None until probed
+        self.cfg64 = None
+        
+        # Whether the running firmware has the status command. None until probed
+        self.status_cmd = None
+        
+        # Optional threading.Event. Once set, commands raise Cancelled instead of being sent.
+        # Commands that are already in flight are allowed to complete first.
+        self.cancel_event = None
+    
     #-----------------------------------------------------------------------------------------------
     def __enter__(self):
         self.open()
@@ -36,7 +575,8 @@ class btLink:
     
     #-----------------------------------------------------------------------------------------------
     def open(self):
-        self.S.connect((self.addr, 1))
+        if(self.connect_sock):
+            self.S.connect((self.addr, 1))
         
         self.initialize_link()
         
@@ -45,6 +585,7 @@ class btLink:
     #-----------------------------------------------------------------------------------------------
     def initialize_link(self):
         self.S.settimeout(self.timeout)
+        self.rx_buf.clear()
         
         # flush out any partial commands
         try:
@@ -74,48 +615,129 @@ class btLink:
         If timeout, raises TimeoutError
         If last line of response is "ERR", raises IOError 
         """
+        self.check_cancelled()
         self.log.debug("cmd: %s" % cmd_string.strip())
         cmd_string = cmd_string.encode("ascii")
-        self.S.send(cmd_string)
+        if(self.metrics != None):
+            t_start = time.perf_counter()
+        self.S.sendall(cmd_string)
         
         # Collect response
-        resp = []
-        resp_line = ""
-        
-        c = self.S.recv(1).decode("ascii")
-        while(c != '>'):
-            if(c == '\r'):
-                # discard
-                pass
-            elif(c == '\n'):
-                # Got newline
-                if(len(resp_line) != 0):
-                    self.log.debug("resp_line: %s" % resp_line)
-                    resp.append(resp_line)
-                    resp_line = ""
-            else:
-                resp_line += c
-            
-            c = self.S.recv(1).decode("ascii")
-        
-        if(len(resp_line) != 0):
+        try:
+            raw = self.read_response()
+        except OSError as e:
+            if((self.metrics != None) and is_timeout(e)):
+                self.metrics.record_timeout(cmd_verb(cmd_string), len(cmd_string))
+            raise
+        resp = split_response(raw)
+        for resp_line in resp:
             self.log.debug("resp_line: %s" % resp_line)
-            resp.append(resp_line)
-            resp_line = ""
         
-        # if no response, fill with empty
-        if(len(resp) == 0):
-            resp = [""]
-            
+        if(self.metrics != None):
+            self.metrics.record(
+                cmd_verb(cmd_string), len(cmd_string), len(raw) + 1,
+                time.perf_counter() - t_start, is_error_response(resp)
+            )
+        
         # Check if last line is error response
-        if(resp[len(resp)-1] == "ERR"):
-            raise CMDError("Command responded with an error")
+        if(is_error_response(resp)):
+            raise CMDError("Command responded with an error", cmd_string.decode("ascii"))
         
-        # If one response line, collapse
-        elif(len(resp) == 1):
-            resp = resp[0]
+        return(collapse_response(resp))
+    
+    #-----------------------------------------------------------------------------------------------
+    def check_cancelled(self):
+        if((self.cancel_event != None) and self.cancel_event.is_set()):
+            raise Cancelled("Operation was cancelled")
+    
+    #-----------------------------------------------------------------------------------------------
+    def cmd_pipelined(self, cmd_list, rx_buf_size = None, progress = None):
+        """
+        Sends a list of command strings, keeping several in flight at once.
+        Returns the list of responses, in the same form that cmd() returns them.
+        
+        The number of bytes in flight is bounded by the firmware's RX FIFO size. If not
+        specified, the size of the currently running firmware image is used.
+        
+        If any command responds with "ERR", no further commands are started and a
+        CMDError is raised once the commands already in flight have completed.
+        The exception's cmd_index and cmd_string identify the failing command.
+        
+        If provided, progress(n_done, n_total) is called after each response.
+        
+        If cancel_event is set, no further commands are started and Cancelled is raised once
+        the commands already in flight have completed.
+        """
+        if(rx_buf_size == None):
+            rx_buf_size = self.rx_buf_size
+        
+        P = CmdPipeline(cmd_list, rx_buf_size)
+        
+        # Time at which each command started to be sent. Only kept if collecting metrics
+        t_sent = []
+        
+        while(not P.done()):
+            if((self.cancel_event != None) and self.cancel_event.is_set()):
+                P.abort()
+            
+            chunk = P.get_tx_chunk()
+            if(len(chunk) != 0):
+                if(self.metrics != None):
+                    while(len(t_sent) < P.n_started()):
+                        t_sent.append(time.perf_counter())
+                self.S.sendall(chunk)
+                continue
+            
+            try:
+                raw = self.read_response()
+            except OSError as e:
+                if((self.metrics != None) and is_timeout(e)):
+                    pending = cmd_list[P.n_acked()]
+                    self.metrics.record_timeout(cmd_verb(pending), len(pending))
+                raise
+            resp = split_response(raw)
+            idx = P.got_response(resp)
+            self.log.debug("cmd: %s -> %s" % (cmd_list[idx].strip(), resp))
+            
+            if(self.metrics != None):
+                self.metrics.record(
+                    cmd_verb(cmd_list[idx]), len(cmd_list[idx]), len(raw) + 1,
+                    time.perf_counter() - t_sent[idx], is_error_response(resp)
+                )
+            
+            if(progress != None):
+                progress(idx+1, len(cmd_list))
+        
+        if(P.error_index != None):
+            raise CMDError(
+                "Command #%d responded with an error: %s" % (P.error_index, cmd_list[P.error_index].strip()),
+                cmd_list[P.error_index], P.error_index
+            )
+        
+        if(P.aborted):
+            raise Cancelled("Operation was cancelled after %d of %d commands" % (P.n_acked(), len(cmd_list)))
+        
+        return([collapse_response(resp) for resp in P.responses])
+    
+    #-----------------------------------------------------------------------------------------------
+    def read_response(self):
+        """
+        Receives until the next '>' prompt and returns the raw bytes that preceded it.
+        Reads from the socket in bulk. Bytes received after the prompt are kept in rx_buf.
+        """
+        idx = self.rx_buf.find(b">")
+        while(idx < 0):
+            # Only scan newly received bytes
+            search_start = len(self.rx_buf)
+            chunk = self.S.recv(RX_CHUNK_SIZE)
+            if(len(chunk) == 0):
+                raise ConnectionError("Link was closed while waiting for a response")
+            self.rx_buf += chunk
+            idx = self.rx_buf.find(b">", search_start)
         
-        return(resp)
+        raw = bytes(self.rx_buf[:idx])
+        del self.rx_buf[:idx+1]
+        return(raw)
     
     #-----------------------------------------------------------------------------------------------
     def enter_bootloader(self):
@@ -124,12 +746,15 @@ class btLink:
         """
         
         if(self.cmd("id\r\n") == "BL"):
+            self.rx_buf_size = BL_RX_BUF_SIZE
             return
         
         self.cmd("reset\r\n")
             
         if(self.cmd("id\r\n") != "BL"):
             raise CMDError("Failed to enter bootloader")
+        
+        self.rx_buf_size = BL_RX_BUF_SIZE
 
     #-----------------------------------------------------------------------------------------------
     def exit_bootloader(self):
@@ -138,192 +763,397 @@ class btLink:
         """
         
         if(self.cmd("id\r\n") != "BL"):
+            self.rx_buf_size = APP_RX_BUF_SIZE
             return
         
         self.cmd("boot\r\n")
             
         if(self.cmd("id\r\n") == "BL"):
             raise CMDError("Failed to exit bootloader")
+        
+        self.rx_buf_size = APP_RX_BUF_SIZE
+        
+        # Application may have been replaced
+        self.cfg64 = None
+        self.status_cmd = None
     
     #-----------------------------------------------------------------------------------------------
-    def send_ihex(self, filename):
-        self.log.info("Sending file: %s" % filename)
-        with open(filename, 'r') as f:
-            for line in f:
-                line = line.strip()
-                self.cmd("ihex %s\r\n" % line)
+    def send_ihex(self, ihex, pipelined = True, progress = None, coalesce = True, dry_run = False,
+                  resume_from = 0):
+        """
+        Sends an Intel-Hex image to the bootloader.
+        ihex is either a filename, or a list of ihex.Record objects.
+        The whole image is validated before anything is sent.
+        
+        If coalesce is set, contiguous data records are merged into the largest records the
+        bootloader accepts, which reduces the number of round trips.
+        If provided, progress(n_acked, n_total) is called as records are acknowledged.
+        If dry_run is set, nothing is sent.
+        
+        To resume an interrupted upload, pass the last n_acked reported by progress as
+        resume_from. The same image and coalesce setting must be used. The bootloader must
+        not have been reset in the meantime.
+        
+        Returns a tuple: (records sent, records in file)
+        """
+        if(type(ihex) == str):
+            self.log.info("Sending file: %s" % ihex)
+            ihex = ihex_file.read_file(ihex)
+        
+        n_file = len(ihex)
+        if(coalesce):
+            ihex = ihex_file.coalesce(ihex)
+        n_records = len(ihex)
+        
+        start, to_send = ihex_file.resume(ihex, resume_from)
+        if(resume_from):
+            self.log.info("Intel-Hex: resuming at record %d of %d" % (start, n_records))
+        self.log.info("Intel-Hex: sending %d records (%d in file)" % (len(to_send), n_file))
+        
+        if(dry_run):
+            return((len(to_send), n_file))
+        
+        # Any extended address record that was prepended does not count towards progress
+        n_prefix = len(to_send) - (n_records - start)
+        def report_progress(n_done, n_total):
+            if(progress != None):
+                progress(start + max(0, n_done - n_prefix), n_records)
+        
+        cmd_list = []
+        for record in to_send:
+            cmd_list.append("ihex %s\r\n" % record.to_string())
+        
+        if(pipelined):
+            # Only the bootloader accepts ihex records
+            self.cmd_pipelined(cmd_list, BL_RX_BUF_SIZE, report_progress)
+        else:
+            for i,cmd_string in enumerate(cmd_list):
+                self.cmd(cmd_string)
+                report_progress(i+1, len(cmd_list))
+        
+        return((len(to_send), n_file))
         
     #-----------------------------------------------------------------------------------------------
     def set_time(self):
-        now = time.localtime()
-        self.cmd("set_time %x %x %x %x %x %x\r\n" % (
-            now.tm_year,
-            now.tm_mon,
-            now.tm_mday,
-            now.tm_hour,
-            now.tm_min,
-            now.tm_sec
-        ))
-        
-        self.cmd("set_dst %d %d\r\n" % (time.daylight, now.tm_isdst))
+        for cmd_string in set_time_cmds():
+            self.cmd(cmd_string)
     
     #-----------------------------------------------------------------------------------------------
     def get_time(self):
-        resp = self.cmd("get_time\r\n")
-        resp = resp.split()
+        return(parse_time(self.cmd("get_time\r\n")))
         
-        year = int(resp[1], 16)
-        month = int(resp[2], 16)
-        day = int(resp[3], 16)
-        hour = int(resp[4], 16)
-        minute = int(resp[5], 16)
-        second = int(resp[6], 16)
+    #-----------------------------------------------------------------------------------------------
+    def get_ref_time(self):
+        return(parse_time(self.cmd("get_ref_time\r\n")))
         
-        if(year == 0):
-            return(None)
+    #-----------------------------------------------------------------------------------------------
+    def get_ttl_clk_correct(self):
+        """
+        Gets the number of minutes that have been added/subtracted to date.
+        """
+        return(parse_clk_correct(self.cmd("get_ttl_clk_correct\r\n")))
+    
+    #-----------------------------------------------------------------------------------------------
+    def timed_cmd(self, cmd_string):
+        """
+        Same as cmd(), but also returns when the device most likely executed the command.
+        Returns a tuple: (response, local time at the midpoint of the round trip, round trip time)
+        """
+        t_start = time.perf_counter()
+        resp = self.cmd(cmd_string)
+        rtt = time.perf_counter() - t_start
+        host_time = datetime.datetime.now() - datetime.timedelta(seconds=rtt/2)
+        return((resp, host_time, rtt))
+    
+    #-----------------------------------------------------------------------------------------------
+    def get_status(self):
+        """
+        Reads the device time, reference time, total clock correction and config header.
+        Returns a DeviceStatus.
         
-        T = datetime.datetime(year, month, day, hour, minute, second)
-        return(T)
+        Firmware with the status command samples everything in one round trip.
+        Otherwise, the slow-changing values are read with pipelined commands and get_time is
+        sent on its own so that its round trip can be timed.
+        """
+        if(self.status_cmd != False):
+            try:
+                resp, host_time, rtt = self.timed_cmd("status\r\n")
+                self.status_cmd = True
+            except CMDError:
+                self.status_cmd = False
+                self.log.debug("status command not supported. Using individual commands")
+            else:
+                S = parse_status(resp)
+                S.host_time = host_time
+                S.rtt = rtt
+                return(S)
         
-    #-----------------------------------------------------------------------------------------------
-    def get_ref_time(self):
-        resp = self.cmd("get_ref_time\r\n")
-        resp = resp.split()
+        resp = self.cmd_pipelined([
+            "get_ref_time\r\n",
+            "get_ttl_clk_correct\r\n",
+            "cfg_read 0\r\n"
+        ], APP_RX_BUF_SIZE)
         
-        year = int(resp[1], 16)
-        month = int(resp[2], 16)
-        day = int(resp[3], 16)
-        hour = int(resp[4], 16)
-        minute = int(resp[5], 16)
-        second = int(resp[6], 16)
+        S = DeviceStatus()
+        S.ref_time = parse_time(resp[0])
+        S.ttl_clk_correct = parse_clk_correct(resp[1])
+        header = decode_config_pages(resp[2:])
+        S.config_timestamp = parse_config_timestamp(header)
+        S.clock_correction_interval = struct.unpack("<i", header[4:8])[0]
         
-        if(year == 0):
-            return(None)
+        resp, S.host_time, S.rtt = self.timed_cmd("get_time\r\n")
+        S.time = parse_time(resp)
+        return(S)
+    
+    #-----------------------------------------------------------------------------------------------
+    def set_rgbw(self, color):
+        self.cmd(rgbw_cmd(color))
         
-        T = datetime.datetime(year, month, day, hour, minute, second)
-        return(T)
+    #-----------------------------------------------------------------------------------------------
+    def supports_cfg64(self):
+        """
+        Returns True if the firmware has the cfg_write64 and cfg_read64 commands.
+        Older firmware does not, and the hex commands are used instead.
+        """
+        if(self.cfg64 == None):
+            try:
+                decode_page64(self.cmd("cfg_read64 0\r\n"))
+                self.cfg64 = True
+            except CMDError:
+                self.cfg64 = False
+            self.log.debug("Base64 config transfer supported: %s" % self.cfg64)
+        return(self.cfg64)
+    
+    #-----------------------------------------------------------------------------------------------
+    def unload_config(self):
+        """
+        Makes the firmware stop using its config until the next cfg_reload, so that pages can
+        be rewritten in place without the alarms or transitions reading a half-written config.
         
+        Returns False if the firmware does not have the cfg_unload command. Such firmware
+        predates in-place page rewrites: cfg_write does not erase the page first, so only a
+        full upload after cfg_erase is safe.
+        """
+        try:
+            self.cmd("cfg_unload\r\n")
+        except CMDError:
+            self.log.debug("cfg_unload command not supported")
+            return(False)
+        return(True)
+    
     #-----------------------------------------------------------------------------------------------
-    def get_ttl_clk_correct(self):
+    def read_config(self, n_pages):
         """
-        Gets the number of minutes that have been added/subtracted to date.
+        Reads back the first n_pages of the configuration EEPROM
         """
-        resp = self.cmd("get_ttl_clk_correct\r\n")
-        resp = int(resp,16)
-        if(resp > 0x7FFFFFFF):
-            resp -= 0x100000000
-            
-        return(resp)
+        b64 = self.supports_cfg64()
+        resp = self.cmd_pipelined(config_read_cmds(n_pages, b64), APP_RX_BUF_SIZE)
+        return(decode_config_pages(resp, b64))
+    
+    #-----------------------------------------------------------------------------------------------
+    def get_config_timestamp(self):
+        """
+        Returns the build timestamp that the firmware stamped into the config header.
+        The firmware only loads the config if this matches its own build timestamp.
+        """
+        return(parse_config_timestamp(self.read_config(1)))
+    
+    #-----------------------------------------------------------------------------------------------
+    def get_config_timestamps(self):
+        """
+        Returns a tuple: (timestamp in the config header, build timestamp of the running firmware)
+        The firmware only loads the config if the two match.
+        The build timestamp is None if the firmware does not have the status command.
+        """
+        if(self.status_cmd != False):
+            try:
+                resp = self.cmd("status\r\n")
+                self.status_cmd = True
+            except CMDError:
+                self.status_cmd = False
+                self.log.debug("status command not supported. Using individual commands")
+            else:
+                S = parse_status(resp)
+                return((S.config_timestamp, S.build_timestamp))
         
+        return((self.get_config_timestamp(), None))
+    
     #-----------------------------------------------------------------------------------------------
-    def set_rgbw(self, color):
-        rgbw = color.get_rgbw()
-        self.cmd("rgbw %x %x %x %x\r\n" % rgbw)
+    def verify_config(self, image):
+        """
+        Reads back the configuration EEPROM and compares it against image.
+        The header timestamp is excluded since the firmware replaces it.
+        Raises CMDError on mismatch. Otherwise returns the header timestamp.
+        """
+        n_pages = (len(image) + EE_PAGE_SIZE - 1)//EE_PAGE_SIZE
+        return(compare_config(image, self.read_config(n_pages)))
+    
+    #-----------------------------------------------------------------------------------------------
+    def write_config_pages(self, image, pages, erase, pipelined = True, progress = None):
+        """
+        Writes the selected pages of image to the configuration EEPROM and reloads it.
+        If erase is set, the whole EEPROM is erased first.
+        If provided, progress(n_written, n_pages) is called as pages are written.
+        """
+        cmd_list = config_write_cmds(image, pages, erase, self.supports_cfg64())
+        
+        # Erase and reload commands do not count as pages
+        if(erase):
+            n_before = 1
+        else:
+            n_before = 0
+        def report_progress(n_done, n_total):
+            if(progress != None):
+                progress(min(max(n_done - n_before, 0), len(pages)), len(pages))
         
+        if(pipelined):
+            self.cmd_pipelined(cmd_list, APP_RX_BUF_SIZE, report_progress)
+        else:
+            for i,cmd_string in enumerate(cmd_list):
+                self.cmd(cmd_string)
+                report_progress(i+1, len(cmd_list))
+    
     #-----------------------------------------------------------------------------------------------
-    def send_config(self, image):
+    def send_config(self, image, pipelined = True, diff = False, prev_image = None, cache = None,
+                    progress = None):
+        """
+        Uploads a compiled configuration image and reloads it.
         
-        # Pad image to be a multiple of the page size (32-bytes)
-        if((len(image)%32) != 0):
-            image += b"\xFF" * (32 - len(image)%32)
+        If diff is set, the EEPROM is not erased. Instead, the config is unloaded and only pages
+        that differ from the image currently on the device are rewritten. The current image is
+        read back from the device, unless a copy of it is provided in prev_image.
+        The result is read back, and if it does not match, all pages are sent again.
+        Firmware that cannot rewrite pages in place always gets all pages.
         
-        self.cmd("cfg_erase\r\n")
+        If a ConfigCache is provided, nothing is sent if the device is known to hold an
+        identical image already and its running firmware accepts it. Otherwise, the cached copy
+        of the device's image is used for a differential upload. After uploading, the image is
+        verified and the cache is updated. If the header was stamped by a different firmware
+        build than the one running, the cache entry is discarded.
         
-        for addr in range(0, len(image), 32):
-            page = addr//32
-            hex_str = binascii.hexlify(image[addr:addr+32]).decode('ascii')
-            self.cmd("cfg_write %X %s\r\n" % (page, hex_str))
+        If provided, progress(n_written, n_pages) is called as pages are written.
         
-        self.cmd("cfg_reload\r\n")
+        Returns a tuple: (pages written, pages skipped)
+        """
+        image = pad_config(image)
+        n_pages = len(image)//EE_PAGE_SIZE
+        
+        if(cache != None):
+            header_timestamp, build_timestamp = self.get_config_timestamps()
+            if((build_timestamp != None) and (header_timestamp != build_timestamp)):
+                # Firmware was reflashed since the config was written and no longer loads it.
+                # Whatever the cache knows about this device is stale
+                self.log.info("Config upload: device firmware does not accept its current config")
+                cache.invalidate(self.addr)
+            else:
+                # Without the running firmware's build timestamp, there is no telling whether
+                # the device loaded its config, so the upload is never skipped
+                if((build_timestamp != None) and cache.matches(self.addr, image, build_timestamp)):
+                    self.log.info("Config upload: device already holds this image. %d pages skipped" % n_pages)
+                    return((0, n_pages))
+                
+                if(prev_image == None):
+                    prev_image = cache.lookup(self.addr, header_timestamp)
+                    if(prev_image != None):
+                        diff = True
+        
+        if(diff and not self.unload_config()):
+            self.log.warning("Firmware cannot rewrite config pages in place. Sending all pages.")
+            diff = False
+        
+        if(diff):
+            if(prev_image == None):
+                prev_image = self.read_config(n_pages)
+            pages = diff_config_pages(image, prev_image)
+        else:
+            pages = range(n_pages)
+        
+        self.write_config_pages(image, pages, not diff, pipelined, progress)
+        
+        if(diff or (cache != None)):
+            try:
+                timestamp = self.verify_config(image)
+            except CMDError:
+                if(cache != None):
+                    cache.invalidate(self.addr)
+                if(not diff):
+                    raise
+                
+                # The copy that the diff was based on did not match what the device held
+                self.log.warning("Config readback mismatch after differential upload. Resending all pages.")
+                pages = range(n_pages)
+                self.write_config_pages(image, pages, True, pipelined, progress)
+                timestamp = self.verify_config(image)
+            
+            if(cache != None):
+                cache.update(self.addr, image, timestamp)
+        
+        n_written = len(pages)
+        n_skipped = n_pages - n_written
+        self.log.info("Config upload: %d pages written, %d skipped" % (n_written, n_skipped))
+        return((n_written, n_skipped))
     
     #-----------------------------------------------------------------------------------------------
     def sample_chroma(self, T_i):
         """
         Takes a single color sample from the VEML6040 sensor.
         """
-        resp = self.cmd("chroma %X\r\n" % T_i)
-        resp = resp.split()
-        for i,v in enumerate(resp):
-            resp[i] = int(v,16)
-        return(resp)
-        
+        return(parse_chroma(self.cmd("chroma %X\r\n" % T_i)))
+    
+    def find_chroma_T_i(self):
+        """
+        Samples at different integration times to find the one that gives the best resolution
+        without clipping.
+        Returns a tuple: (T_i, sample taken at T_i)
+        """
+        search = chroma_T_i_search()
+        T_i, delay = next(search)
+        while(True):
+            time.sleep(delay)
+            sample = self.sample_chroma(T_i)
+            self.log.debug("Sampled at T_i=%d, Max=0x%04X" % (T_i, max(sample)))
+            try:
+                T_i, delay = search.send(sample)
+            except StopIteration as e:
+                return(e.value)
+    
+    #-----------------------------------------------------------------------------------------------
+    def collect_chroma(self, T_i, n_samples, progress = None):
+        """
+        Takes n_samples color samples at T_i as one pipelined stream.
+        Returns an N x 4 numpy array of raw readings.
+        If provided, progress(n_done, n_total) is called after each sample.
+        """
+        chroma.require_numpy()
+        resp = self.cmd_pipelined(["chroma %X\r\n" % T_i] * n_samples, APP_RX_BUF_SIZE, progress)
+        return(chroma.parse_chroma_batch(resp))
+    
+    #-----------------------------------------------------------------------------------------------
     def measure_chroma(self, n_average = 1):
         """
         Takes a color measurement from the VEML6040 sensor using the best possible integration time
          1. Takes several samples to determine ideal integration time for maximum resolution
          2. Takes additional samples as necessary to get an average
         """
-        
-        # Determine best T_i
-        T_i = 3
-        retry_count = 3
-        while(retry_count > 0):
-            sample = self.sample_chroma(T_i)
-            print(sample)
-            print("Sampled at T_i=%d, Max=0x%04X" % (T_i, max(sample)))
-            
-            T_i_prev = T_i
-            
-            if(max(sample) > (0x10000*0.90)):
-                # T_i is too long for the brightness
-                if(T_i == 0):
-                    # T_i is already at the lowest setting.
-                    break
-                
-                T_i -= 1
-            elif(max(sample) < (0x8000*0.90)):
-                # Could use a longer T_i
-                if(T_i == 5):
-                    # T_i is already at the highest setting.
-                    break
-                
-                T_i += 1
-            else:
-                # Sample is within decent range
-                break
-                
-            retry_count -= 1
-            
-            # VEML6040 seems to need some time between switching integration times
-            time.sleep(0.040 * (2**T_i_prev))
+        T_i, sample = self.find_chroma_T_i()
         
         # Do additional samples to average
-        extra_samples = n_average-1
         sample_list = [sample]
-        while(extra_samples > 0):
-            sample_list.append(self.sample_chroma(T_i))
-            extra_samples -= 1
-        
-        # Post process samples
-        # - Take average
-        # - Normalize scale based on T_i used
-        result = [0,0,0,0]
-        for s in sample_list:
-            for i,c in enumerate(s):
-                result[i] += c
-        for i,c in enumerate(result):
-            c *= 2**(5-T_i)
-            result[i] = c/n_average
-            
-        return(result)
-    
-#---------------------------------------------------------------------------------------------------
-def discover():
-    """
-    Discovers any BT devices that have a name that matches "SkylightLED-####"
-    Returns list of (address, name) tuples
-    """
-    discovered_devs = bluetooth.discover_devices(
-        duration=8,
-        lookup_names=True,
-        flush_cache=True,
-        lookup_class=False
-    )
-    
-    devs = []
-    for addr, name in discovered_devs:
-        if(re.match(r'SkylightLED-[0-9a-fA-F]{4}', name)):
-            devs.append((addr, name))
+        if(n_average > 1):
+            resp = self.cmd_pipelined(["chroma %X\r\n" % T_i] * (n_average-1), APP_RX_BUF_SIZE)
+            sample_list += [parse_chroma(r) for r in resp]
+        
+        return(average_chroma(sample_list, T_i))
     
-    return(devs)
-    
\ No newline at end of file
+    #-----------------------------------------------------------------------------------------------
+    def measure_chroma_stats(self, n_samples = 16, reject_sigma = chroma.DEFAULT_REJECT_SIGMA,
+                             progress = None):
+        """
+        Same as measure_chroma(), but returns a chroma.ChromaStats with the mean, variance and
+        saturation flags of n_samples samples. Outliers further than reject_sigma robust
+        standard deviations from the median are discarded. Requires numpy.
+        """
+        chroma.require_numpy()
+        T_i, _ = self.find_chroma_T_i()
+        samples = self.collect_chroma(T_i, n_samples, progress)
+        return(chroma.analyze_chroma(samples, T_i, reject_sigma))
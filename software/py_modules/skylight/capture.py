@@ -0,0 +1,288 @@
+import time
+import gzip
+import struct
+import threading
+import collections
+
+# Direction of a captured chunk
+TX = 0  # Host to device
+RX = 1  # Device to host
+
+# Chunk without data that marks where a capture starts if earlier traffic was discarded.
+# The chunk after it is the first command of a complete exchange
+TRIMMED = 2
+
+FILE_MAGIC = b"SKYCAP1\n"
+
+# Per-chunk header: Seconds since the start of the capture, direction, length
+_CHUNK_HDR = struct.Struct("<dBH")
+
+# Default memory budget of a capture, in bytes of payload
+DEFAULT_MAX_BYTES = 256 * 1024
+
+class ReplayError(Exception):
+    pass
+
+#---------------------------------------------------------------------------------------------------
+class Capture:
+    """
+    Ring buffer of the bytes that went over a link, with timestamps.
+    Once the buffer holds more than max_bytes of payload, the oldest exchanges are discarded,
+    so it can be left enabled indefinitely.
+    
+    Traffic is kept in exchanges. An exchange starts with a command sent while the device had
+    answered every earlier command with its '>' prompt. Discarding whole exchanges means
+    that a capture always starts at a command, so it can still be replayed. The exchange in
+    progress is never discarded, so a single exchange can exceed max_bytes.
+    """
+    def __init__(self, max_bytes = DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.t_start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.clear()
+    
+    #-----------------------------------------------------------------------------------------------
+    def record(self, direction, data):
+        if(len(data) == 0):
+            return
+        t = time.perf_counter() - self.t_start
+        with self.lock:
+            if(direction == TX):
+                if((self.n_unanswered == 0) and (len(self.exchanges[-1]) != 0)):
+                    self.exchanges.append([])
+                # Each command is terminated by a newline
+                self.n_unanswered += data.count(b"\n")
+            else:
+                # Each command is answered with a prompt
+                self.n_unanswered = max(self.n_unanswered - data.count(b">"), 0)
+            
+            self.exchanges[-1].append((t, direction, bytes(data)))
+            self.n_bytes += len(data)
+            while((self.n_bytes > self.max_bytes) and (len(self.exchanges) > 1)):
+                self.n_bytes -= sum([len(chunk[2]) for chunk in self.exchanges.popleft()])
+                self.trimmed = True
+    
+    #-----------------------------------------------------------------------------------------------
+    def clear(self):
+        with self.lock:
+            # Lists of chunks. The last one is in progress
+            self.exchanges = collections.deque([[]])
+            self.n_bytes = 0
+            
+            # Number of commands sent that the device did not answer yet
+            self.n_unanswered = 0
+            
+            # Whether any exchanges were discarded
+            self.trimmed = False
+    
+    #-----------------------------------------------------------------------------------------------
+    def save(self, filename):
+        """
+        Writes the buffered chunks to a gzip compressed capture file
+        """
+        with self.lock:
+            chunks = [chunk for exchange in self.exchanges for chunk in exchange]
+            if(self.trimmed and len(chunks)):
+                chunks.insert(0, (chunks[0][0], TRIMMED, b""))
+        
+        with gzip.open(filename, 'wb') as f:
+            f.write(FILE_MAGIC)
+            for t, direction, data in chunks:
+                # Chunk length is limited to 16 bits
+                for i in range(0, max(len(data), 1), 0xFFFF):
+                    part = data[i:i+0xFFFF]
+                    f.write(_CHUNK_HDR.pack(t, direction, len(part)))
+                    f.write(part)
+
+#---------------------------------------------------------------------------------------------------
+def load(filename):
+    """
+    Reads a capture file.
+    Returns the list of chunks as (time, direction, data) tuples.
+    If earlier traffic was discarded, the first chunk is a TRIMMED marker.
+    """
+    chunks = []
+    with gzip.open(filename, 'rb') as f:
+        if(f.read(len(FILE_MAGIC)) != FILE_MAGIC):
+            raise ReplayError("Not a capture file: %s" % filename)
+        
+        while(True):
+            hdr = f.read(_CHUNK_HDR.size)
+            if(len(hdr) == 0):
+                break
+            if(len(hdr) != _CHUNK_HDR.size):
+                raise ReplayError("Truncated capture file: %s" % filename)
+            t, direction, length = _CHUNK_HDR.unpack(hdr)
+            data = f.read(length)
+            if(len(data) != length):
+                raise ReplayError("Truncated capture file: %s" % filename)
+            chunks.append((t, direction, data))
+    return(chunks)
+
+#---------------------------------------------------------------------------------------------------
+class CaptureSocket:
+    """
+    Wraps a socket and records everything sent and received through it into a Capture
+    """
+    def __init__(self, sock, capture):
+        self.S = sock
+        self.capture = capture
+    
+    def sendall(self, data):
+        self.S.sendall(data)
+        self.capture.record(TX, data)
+    
+    def send(self, data):
+        n = self.S.send(data)
+        self.capture.record(TX, data[:n])
+        return(n)
+    
+    def recv(self, n):
+        data = self.S.recv(n)
+        self.capture.record(RX, data)
+        return(data)
+    
+    def connect(self, addr):
+        self.S.connect(addr)
+    
+    def settimeout(self, timeout):
+        self.S.settimeout(timeout)
+    
+    def setblocking(self, flag):
+        self.S.setblocking(flag)
+    
+    def close(self):
+        self.S.close()
+
+#---------------------------------------------------------------------------------------------------
+class ReplaySocket:
+    """
+    Socket-like object that plays the device side of a capture back to btLink.
+    
+    Received data is only released once the host has sent everything that preceded it in the
+    capture, so parsing sees the same byte stream in the same order on every run.
+    Gaps between chunks are reproduced, divided by speed. A speed of None replays as fast
+    as possible.
+    
+    If strict is set, the bytes the host sends must match the capture. Otherwise they are only
+    counted, which allows replaying against a modified host.
+    
+    If skip_setup is set, commands that the host sends before the first command of the capture
+    are answered with an empty response instead. This lets a host that opens the link as usual
+    join a capture that does not start at the beginning of a session. By default, this is
+    only done if the capture was trimmed.
+    """
+    def __init__(self, chunks, speed = 1.0, strict = True, skip_setup = None):
+        if(type(chunks) == str):
+            chunks = load(chunks)
+        self.chunks = collections.deque(chunks)
+        self.speed = speed
+        self.strict = strict
+        self.timeout = None
+        
+        trimmed = (len(self.chunks) != 0) and (self.chunks[0][1] == TRIMMED)
+        if(trimmed):
+            self.chunks.popleft()
+        if(skip_setup == None):
+            skip_setup = trimmed
+        
+        # Whether commands are still answered with an empty response. Cleared once the host
+        # sends the first command of the capture
+        self.skipping = skip_setup
+        
+        # Bytes of the current chunk in each direction that were not consumed yet
+        self.pending_tx = b""
+        self.pending_rx = b""
+        
+        # Capture time and real time of the last chunk that was played
+        self.t_cap = None
+        self.t_real = None
+        
+        # Number of bytes sent by the host that did not match the capture
+        self.mismatches = 0
+    
+    #-----------------------------------------------------------------------------------------------
+    def wait_for(self, t):
+        """
+        Waits until the chunk captured at time t is due
+        """
+        if((self.t_cap != None) and self.speed):
+            delay = (t - self.t_cap) / self.speed - (time.perf_counter() - self.t_real)
+            if(delay > 0):
+                time.sleep(delay)
+        self.t_cap = t
+        self.t_real = time.perf_counter()
+    
+    #-----------------------------------------------------------------------------------------------
+    def mismatch(self, n, msg):
+        if(self.strict):
+            raise ReplayError(msg)
+        self.mismatches += n
+    
+    #-----------------------------------------------------------------------------------------------
+    def sendall(self, data):
+        data = bytes(data)
+        if(self.skipping):
+            if((len(self.chunks) != 0) and (self.chunks[0][1] == TX) and
+               self.chunks[0][2].startswith(data[:len(self.chunks[0][2])])):
+                self.skipping = False
+            else:
+                self.pending_rx += b">" * data.count(b"\n")
+                return
+        
+        while(len(data)):
+            if(len(self.pending_tx) == 0):
+                if((len(self.chunks) == 0) or (self.chunks[0][1] != TX) or (len(self.pending_rx) != 0)):
+                    self.mismatch(len(data), "Host sent data that the capture does not have at this point: %r" % data)
+                    return
+                t, _, self.pending_tx = self.chunks.popleft()
+                
+                # The host sets its own pace. Only anchor the replay clock to it
+                self.t_cap = t
+                self.t_real = time.perf_counter()
+            
+            n = min(len(data), len(self.pending_tx))
+            if(data[:n] != self.pending_tx[:n]):
+                self.mismatch(n, "Host sent %r. Capture has %r" % (data[:n], self.pending_tx[:n]))
+            data = data[n:]
+            self.pending_tx = self.pending_tx[n:]
+    
+    #-----------------------------------------------------------------------------------------------
+    def send(self, data):
+        self.sendall(data)
+        return(len(data))
+    
+    #-----------------------------------------------------------------------------------------------
+    def recv(self, n):
+        if(len(self.pending_rx) == 0):
+            # Anything the host should have sent first is skipped, unless the capture is enforced
+            if(len(self.pending_tx) != 0):
+                self.mismatch(len(self.pending_tx), "Host is waiting for a response before sending %r" % self.pending_tx)
+                self.pending_tx = b""
+            while((len(self.chunks) != 0) and (self.chunks[0][1] == TX)):
+                self.mismatch(len(self.chunks[0][2]), "Host is waiting for a response before sending %r" % self.chunks[0][2])
+                self.chunks.popleft()
+            
+            if(len(self.chunks) == 0):
+                # End of capture. Looks like the link was closed
+                return(b"")
+            
+            t, _, self.pending_rx = self.chunks.popleft()
+            self.wait_for(t)
+        
+        data = self.pending_rx[:n]
+        self.pending_rx = self.pending_rx[n:]
+        return(data)
+    
+    #-----------------------------------------------------------------------------------------------
+    def connect(self, addr):
+        pass
+    
+    def settimeout(self, timeout):
+        self.timeout = timeout
+    
+    def setblocking(self, flag):
+        pass
+    
+    def close(self):
+        pass
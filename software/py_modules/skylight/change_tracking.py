@@ -0,0 +1,215 @@
+import weakref
+
+#---------------------------------------------------------------------------------------------------
+def adopt(parent, value):
+    """
+    Makes changes to value, or to anything in it if it is a list or tuple, reach parent
+    """
+    if(isinstance(value, Tracked)):
+        # Same as value.add_parent(parent), which is too slow to call for every reference
+        parents = value.__dict__.get("_parents")
+        if(parents == None):
+            value.start_tracking(False)
+            parents = value._parents
+        parents[id(parent)] = weakref.ref(parent)
+        
+        if((not value._adopted) and (not isinstance(value, Cached))):
+            # Nothing else checks what it references
+            value.adopt_references()
+    elif(isinstance(value, (list, tuple))):
+        for v in value:
+            adopt(parent, v)
+
+#---------------------------------------------------------------------------------------------------
+class Tracked:
+    """
+    Base of objects that tell the objects that reference them when they change, so that those
+    can cache results derived from them. See Cached.
+    
+    Assigning a public attribute is a change. A plain list that is assigned is converted to a
+    TrackedList, so that changing the list in place is a change as well.
+    Attributes whose names start with an underscore hold derived state. Assigning them is not
+    a change, and copies of the object do not get them.
+    
+    Nothing is tracked until the object gets a parent, or until adopt_references() is called.
+    Until then nothing can have been derived from it, so building an object costs nothing extra.
+    """
+    
+    # Public attributes that are not part of the object's contents
+    untracked_attributes = ()
+    
+    def __setattr__(self, name, value):
+        if(("_parents" not in self.__dict__) or (name[0] == "_") or
+           (name in self.untracked_attributes)):
+            object.__setattr__(self, name, value)
+            return
+        
+        if(type(value) == list):
+            value = TrackedList(value)
+        if(isinstance(value, (Tracked, tuple))):
+            adopt(self, value)
+        object.__setattr__(self, name, value)
+        self.changed()
+    
+    #-----------------------------------------------------------------------------------------------
+    def __getstate__(self):
+        # Copies start out with no parents, and nothing cached
+        return({k: v for k, v in self.__dict__.items() if(not k.startswith("_"))})
+    
+    #-----------------------------------------------------------------------------------------------
+    def start_tracking(self, adopted):
+        # All of the tracking state is created here, in the same order for every object, so
+        # that objects of a class keep sharing the layout of their __dict__
+        object.__setattr__(self, "_adopted", adopted)
+        object.__setattr__(self, "_parents", {})
+    
+    #-----------------------------------------------------------------------------------------------
+    def add_parent(self, parent):
+        if("_adopted" not in self.__dict__):
+            self.start_tracking(False)
+        self._parents[id(parent)] = weakref.ref(parent)
+    
+    #-----------------------------------------------------------------------------------------------
+    def changed(self):
+        """
+        Tells the objects that reference this one that it changed
+        """
+        parents = self.__dict__.get("_parents")
+        if(not parents):
+            return
+        for ref in list(parents.values()):
+            parent = ref()
+            if(parent != None):
+                parent.changed()
+    
+    #-----------------------------------------------------------------------------------------------
+    def adopt_references(self):
+        """
+        Makes sure that this object hears about changes to everything it references, including
+        references that were set before tracking started, or by a decoder that fills in
+        __dict__. Only does any work the first time.
+        """
+        if("_adopted" not in self.__dict__):
+            self.start_tracking(False)
+        elif(self._adopted):
+            return
+        object.__setattr__(self, "_adopted", True)
+        
+        for name, value in list(self.__dict__.items()):
+            if((not isinstance(value, (Tracked, list, tuple))) or (name[0] == "_") or
+               (name in self.untracked_attributes)):
+                continue
+            if(type(value) == list):
+                value = TrackedList(value)
+                object.__setattr__(self, name, value)
+            adopt(self, value)
+
+#---------------------------------------------------------------------------------------------------
+class TrackedList(Tracked, list):
+    """
+    List that counts changes to itself, or to any of its items, as changes to the objects that
+    hold it.
+    """
+    def __init__(self, items = ()):
+        self.start_tracking(True)
+        list.__init__(self, items)
+        self.adopt_items(self)
+    
+    def __reduce_ex__(self, protocol):
+        # Copies are plain lists. The object that receives one converts it again
+        return((list, (list(self),)))
+    
+    def adopt_items(self, items):
+        for value in items:
+            adopt(self, value)
+    
+    def __setitem__(self, index, value):
+        list.__setitem__(self, index, value)
+        adopt(self, value)
+        self.changed()
+    
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self.changed()
+    
+    def __iadd__(self, items):
+        list.__iadd__(self, items)
+        self.adopt_items(self)
+        self.changed()
+        return(self)
+    
+    def __imul__(self, n):
+        list.__imul__(self, n)
+        self.changed()
+        return(self)
+    
+    def append(self, value):
+        list.append(self, value)
+        adopt(self, value)
+        self.changed()
+    
+    def extend(self, items):
+        list.extend(self, items)
+        self.adopt_items(self)
+        self.changed()
+    
+    def insert(self, index, value):
+        list.insert(self, index, value)
+        adopt(self, value)
+        self.changed()
+    
+    def pop(self, index = -1):
+        value = list.pop(self, index)
+        self.changed()
+        return(value)
+    
+    def remove(self, value):
+        list.remove(self, value)
+        self.changed()
+    
+    def clear(self):
+        list.clear(self)
+        self.changed()
+    
+    def sort(self, *args, **kwargs):
+        list.sort(self, *args, **kwargs)
+        self.changed()
+    
+    def reverse(self):
+        list.reverse(self)
+        self.changed()
+
+#---------------------------------------------------------------------------------------------------
+class Cached(Tracked):
+    """
+    Tracked object that caches a result derived from its contents, and from everything it
+    references, until any of them changes. An object is clean while it has a cached result.
+    
+    Since a dirty object's parents are always dirty too, a change stops propagating at the
+    first object that is already dirty.
+    """
+    def start_tracking(self, adopted):
+        object.__setattr__(self, "_adopted", adopted)
+        object.__setattr__(self, "_parents", {})
+        object.__setattr__(self, "_cached", None)
+    
+    #-----------------------------------------------------------------------------------------------
+    def get_cached(self):
+        """
+        Returns the result cached by set_cached(), or None if the object changed since
+        """
+        return(self.__dict__.get("_cached"))
+    
+    #-----------------------------------------------------------------------------------------------
+    def set_cached(self, value):
+        """
+        Caches value until the object changes.
+        adopt_references() must have been called since the object was created or copied.
+        """
+        object.__setattr__(self, "_cached", value)
+    
+    #-----------------------------------------------------------------------------------------------
+    def changed(self):
+        if(self.__dict__.get("_cached") != None):
+            object.__setattr__(self, "_cached", None)
+            Tracked.changed(self)
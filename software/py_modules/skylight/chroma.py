@@ -0,0 +1,116 @@
+import sys
+
+try:
+    import numpy
+except ImportError:
+    # Only required for chroma statistics. See require_numpy()
+    numpy = None
+
+# Full scale of a VEML6040 channel. A reading at this value is clipped
+CHROMA_FULL_SCALE = 0xFFFF
+
+# Longest integration time setting. Readings are normalized to it
+CHROMA_MAX_T_I = 5
+
+# Robust z-score above which a sample is rejected as an outlier
+DEFAULT_REJECT_SIGMA = 3.5
+
+# Fraction of the samples that must pass outlier rejection. If fewer do, the samples do not
+# agree on a typical value, and none are rejected
+MIN_KEPT_FRACTION = 0.5
+
+#---------------------------------------------------------------------------------------------------
+def require_numpy():
+    if(numpy == None):
+        print("Missing 3rd party package 'numpy'. Install using:")
+        print("  sudo pip3 install numpy")
+        sys.exit(1)
+
+#---------------------------------------------------------------------------------------------------
+class ChromaStats:
+    """
+    Result of btLink.measure_chroma_stats()
+    
+    Channel values are in R, G, B, W order and normalized to the longest integration time,
+    the same scale that measure_chroma() returns.
+    
+    mean: Mean of the samples that were kept
+    variance: Sample variance of the samples that were kept. Zero if only one was kept
+    saturated: Per channel, True if any sample was clipped at full scale
+    T_i: Integration time setting the samples were taken at
+    n_samples: Number of samples taken
+    n_rejected: Number of samples discarded as outliers
+    """
+    def __init__(self, mean, variance, saturated, T_i, n_samples, n_rejected):
+        self.mean = mean
+        self.variance = variance
+        self.saturated = saturated
+        self.T_i = T_i
+        self.n_samples = n_samples
+        self.n_rejected = n_rejected
+    
+    def __repr__(self):
+        return("ChromaStats(mean=%s, variance=%s, saturated=%s, T_i=%d, n=%d, rejected=%d)" % (
+            self.mean, self.variance, self.saturated, self.T_i, self.n_samples, self.n_rejected
+        ))
+
+#---------------------------------------------------------------------------------------------------
+def parse_chroma_batch(resp_list):
+    """
+    Decodes a list of chroma command responses in one go.
+    Returns an N x 4 array of raw readings
+    """
+    require_numpy()
+    
+    # Each response is four 16-bit hex words separated by spaces
+    raw = bytes.fromhex("".join(resp_list).replace(" ", ""))
+    if(len(raw) != 8 * len(resp_list)):
+        raise ValueError("Malformed chroma response")
+    return(numpy.frombuffer(raw, dtype=">u2").reshape(-1, 4))
+
+#---------------------------------------------------------------------------------------------------
+def reject_outliers(samples, reject_sigma = DEFAULT_REJECT_SIGMA):
+    """
+    Returns a boolean mask of the rows of samples to keep.
+    A row is rejected if any of its channels is further than reject_sigma robust standard
+    deviations (scaled median absolute deviation) from that channel's median.
+    The deviation is floored to one count so that a steady reading with a little
+    quantization noise is not torn apart.
+    """
+    median = numpy.median(samples, axis=0)
+    deviation = numpy.abs(samples - median)
+    scale = numpy.maximum(1.4826 * numpy.median(deviation, axis=0), 1.0)
+    return(numpy.all(deviation <= reject_sigma * scale, axis=1))
+
+#---------------------------------------------------------------------------------------------------
+def analyze_chroma(samples, T_i, reject_sigma = DEFAULT_REJECT_SIGMA):
+    """
+    Reduces an N x 4 array of raw readings taken at T_i into a ChromaStats.
+    If reject_sigma is None, no samples are rejected. Neither are they if outlier rejection
+    would keep less than MIN_KEPT_FRACTION of them.
+    """
+    require_numpy()
+    samples = numpy.asarray(samples, dtype=numpy.float64)
+    
+    saturated = numpy.any(samples >= CHROMA_FULL_SCALE, axis=0)
+    
+    if((reject_sigma != None) and (len(samples) > 2)):
+        keep = reject_outliers(samples, reject_sigma)
+        if(numpy.count_nonzero(keep) >= MIN_KEPT_FRACTION * len(samples)):
+            kept = samples[keep]
+        else:
+            kept = samples
+    else:
+        kept = samples
+    
+    kept = kept * 2**(CHROMA_MAX_T_I - T_i)
+    mean = kept.mean(axis=0)
+    if(len(kept) > 1):
+        variance = kept.var(axis=0, ddof=1)
+    else:
+        variance = numpy.zeros(4)
+    
+    return(ChromaStats(
+        mean.tolist(), variance.tolist(), saturated.tolist(), T_i,
+        len(samples), len(samples) - len(kept)
+    ))
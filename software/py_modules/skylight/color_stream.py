@@ -0,0 +1,156 @@
+import time
+import logging
+import threading
+
+from . import btLink
+
+#---------------------------------------------------------------------------------------------------
+class ColorStream(threading.Thread):
+    """
+    Streams colors to a device from a background thread, for live previews.
+    
+    set_color() never blocks. Only the most recent color is kept, so colors that were
+    superseded before they could be sent are dropped rather than queued.
+    
+    Only one rgbw command is in flight at a time. A command is at most 26 bytes, so it fits in
+    the firmware's 32-byte RX FIFO, but sending more would only queue up colors that are
+    already stale by the time they are shown.
+    
+    The interval between commands follows the link: it is the smoothed round trip time of the
+    rgbw commands times rtt_factor, so that the stream leaves the link idle for part of the
+    time, and slows down as the link gets congested. It is kept between min_interval and
+    max_interval. A failed command doubles the interval.
+    
+    The link is leased from a link_manager.LinkManager for each command, so other users of
+    the link can interleave with the stream.
+    """
+    def __init__(self, manager, addr, min_interval = 0.02, max_interval = 0.5, rtt_factor = 1.5):
+        """
+        manager: link_manager.LinkManager that owns the link
+        addr: Bluetooth address of the device
+        min_interval: Minimum time between two commands in seconds
+        max_interval: Maximum time between two commands in seconds
+        rtt_factor: Interval between two commands, as a multiple of the round trip time
+        """
+        threading.Thread.__init__(self, daemon=True)
+        self.manager = manager
+        self.addr = addr
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.rtt_factor = rtt_factor
+        self.log = logging.getLogger("skylight")
+        
+        self.cond = threading.Condition()
+        self.pending = None
+        self.stopping = False
+        
+        # Set by close() if it stopped waiting for the stream. Nothing is sent after that
+        self.abandoned = False
+        
+        # Smoothed round trip time of an rgbw command in seconds. None until measured
+        self.avg_rtt = None
+        
+        # Current time between two commands in seconds
+        self.interval = min_interval
+        
+        # Statistics
+        self.n_set = 0
+        self.n_sent = 0
+        
+        # Last exception raised by the link. The stream keeps going regardless
+        self.error = None
+    
+    #-----------------------------------------------------------------------------------------------
+    def set_color(self, color):
+        """
+        Queues color to be sent, replacing any color that was not sent yet
+        """
+        with self.cond:
+            self.pending = color
+            self.n_set += 1
+            self.cond.notify()
+    
+    #-----------------------------------------------------------------------------------------------
+    def close(self, flush = True, timeout = 0.5):
+        """
+        Stops the stream.
+        If flush is set, the last color is still sent.
+        Waits at most timeout seconds for the stream to finish, so that a link that is stuck
+        reconnecting does not block the caller. If the stream did not finish by then, it sends
+        nothing more. A command that was already on its way completes under its lease, so it
+        never interleaves with the next user of the link.
+        """
+        with self.cond:
+            if(not flush):
+                self.pending = None
+            self.stopping = True
+            self.cond.notify()
+        if(self.is_alive()):
+            self.join(timeout)
+        
+        with self.cond:
+            self.pending = None
+            self.abandoned = True
+    
+    #-----------------------------------------------------------------------------------------------
+    def get_rate(self):
+        """
+        Returns the current number of colors per second. None if nothing was sent yet
+        """
+        if(self.avg_rtt == None):
+            return(None)
+        return(1 / self.interval)
+    
+    #-----------------------------------------------------------------------------------------------
+    def clamp_interval(self, interval):
+        return(min(max(interval, self.min_interval), self.max_interval))
+    
+    #-----------------------------------------------------------------------------------------------
+    def run(self):
+        t_next = 0
+        while(True):
+            with self.cond:
+                while((self.pending == None) and (not self.stopping)):
+                    self.cond.wait()
+                if(self.pending == None):
+                    break
+                color = self.pending
+                self.pending = None
+            
+            delay = t_next - time.perf_counter()
+            if(delay > 0):
+                time.sleep(delay)
+                
+                # A newer color may have arrived while waiting
+                with self.cond:
+                    if(self.pending != None):
+                        color = self.pending
+                        self.pending = None
+            
+            try:
+                with self.manager.lease(self.addr) as link:
+                    with self.cond:
+                        if(self.abandoned):
+                            # Waited for the lease for longer than close() waited for the stream
+                            return
+                    
+                    # Only the command itself is timed. Not any reconnect the lease did
+                    t_start = time.perf_counter()
+                    link.set_rgbw(color)
+                    rtt = time.perf_counter() - t_start
+            except (OSError, btLink.CMDError) as e:
+                self.log.warning("%s: Color stream: %s" % (self.addr, e))
+                self.error = e
+                
+                # Back off until the link recovers
+                self.interval = self.clamp_interval(self.interval * 2)
+                t_next = time.perf_counter() + self.interval
+                continue
+            self.n_sent += 1
+            
+            if(self.avg_rtt == None):
+                self.avg_rtt = rtt
+            else:
+                self.avg_rtt += (rtt - self.avg_rtt) / 8
+            self.interval = self.clamp_interval(self.avg_rtt * self.rtt_factor)
+            t_next = t_start + self.interval
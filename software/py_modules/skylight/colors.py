@@ -1,7 +1,8 @@
 
 from ..python_modules import encodable_class as ec
+from .change_tracking import Tracked
 
-class Color(ec.EncodableClass):
+class Color(ec.EncodableClass, Tracked):
     
     encode_schema = {}
     
@@ -19,6 +20,13 @@ class Color(ec.EncodableClass):
         if(type(other) != type(self)):
             return(False)
         return(True)
+    
+    def get_struct_key(self):
+        """
+        Returns a hashable value that is equal for two colors if and only if they compare equal.
+        Subclasses that extend __eq__ must extend this too.
+        """
+        return((type(self),))
         
 class Color_raw(Color):
     encode_schema = {
@@ -61,6 +69,9 @@ class Color_raw(Color):
             return(False)
             
         return(True)
+    
+    def get_struct_key(self):
+        return(Color.get_struct_key(self) + (self.r, self.g, self.b, self.w))
         
 class Color_rgb(Color):
     encode_schema = {
@@ -120,3 +131,6 @@ class Color_rgb(Color):
             return(False)
         
         return(True)
+    
+    def get_struct_key(self):
+        return(Color.get_struct_key(self) + (self.r, self.g, self.b))
@@ -0,0 +1,92 @@
+import os
+import json
+import hashlib
+import binascii
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".skylight", "config_cache.json")
+
+#---------------------------------------------------------------------------------------------------
+def image_hash(image):
+    return(hashlib.sha256(image).hexdigest())
+
+#---------------------------------------------------------------------------------------------------
+class ConfigCache:
+    """
+    Persistent record of the last configuration image that was successfully uploaded
+    and verified on each device. Keyed by Bluetooth address.
+    
+    Each entry also holds the build timestamp the firmware stamped into the image header.
+    If the device's running firmware reports a different build timestamp, it was reflashed
+    since and no longer accepts the image, so the entry is stale.
+    """
+    def __init__(self, filename = DEFAULT_CACHE_FILE):
+        self.filename = filename
+        self.entries = {}
+        
+        if(os.path.exists(self.filename)):
+            with open(self.filename, 'r') as f:
+                self.entries = json.load(f)
+    
+    #-----------------------------------------------------------------------------------------------
+    def save(self):
+        dirname = os.path.dirname(self.filename)
+        if(dirname and not os.path.exists(dirname)):
+            os.makedirs(dirname)
+        
+        # Write to a temporary file first so an interrupted save can't corrupt the cache
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys = True)
+        os.replace(tmp_filename, self.filename)
+    
+    #-----------------------------------------------------------------------------------------------
+    def lookup(self, addr, timestamp):
+        """
+        Returns the image last uploaded to the device at addr.
+        timestamp is the one currently in the device's config header.
+        Returns None if there is no entry, or if the entry was stamped with a different
+        timestamp, in which case the EEPROM was written by someone else since.
+        A stale entry is discarded.
+        """
+        entry = self.entries.get(addr)
+        if(entry == None):
+            return(None)
+        
+        if(entry["timestamp"] != timestamp):
+            self.invalidate(addr)
+            return(None)
+        
+        image = binascii.unhexlify(entry["image"])
+        if(image_hash(image) != entry["sha256"]):
+            # Cache file was damaged
+            self.invalidate(addr)
+            return(None)
+        
+        return(image)
+    
+    #-----------------------------------------------------------------------------------------------
+    def matches(self, addr, image, build_timestamp):
+        """
+        Returns True if image is identical to the one that the device is known to hold, and
+        was stamped by the firmware build that is running now.
+        build_timestamp is the one the running firmware reports, not the one in the header
+        """
+        entry = self.entries.get(addr)
+        if(entry == None):
+            return(False)
+        return((entry["timestamp"] == build_timestamp) and (entry["sha256"] == image_hash(image)))
+    
+    #-----------------------------------------------------------------------------------------------
+    def update(self, addr, image, timestamp):
+        self.entries[addr] = {
+            "sha256": image_hash(image),
+            "image": binascii.hexlify(image).decode('ascii'),
+            "timestamp": timestamp
+        }
+        self.save()
+    
+    #-----------------------------------------------------------------------------------------------
+    def invalidate(self, addr):
+        if(addr in self.entries):
+            del self.entries[addr]
+            self.save()
@@ -0,0 +1,186 @@
+import os
+import re
+import json
+import time
+import select
+import logging
+import concurrent.futures
+
+try:
+    import bluetooth
+except ImportError:
+    # Only required when talking to real hardware. See require_pybluez()
+    bluetooth = None
+
+from .btLink import require_pybluez
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".skylight", "discovery_cache.json")
+
+# Devices not seen for this long are forgotten
+MAX_AGE = 30 * 24 * 60 * 60
+
+# Seconds to wait for a known device to answer a name request
+PROBE_TIMEOUT = 2
+
+# Number of known devices that are probed at once
+PROBE_THREADS = 8
+
+# Seconds after which any known devices that have not answered yet are given up on
+PROBE_TOTAL_TIMEOUT = 2 * PROBE_TIMEOUT
+
+#---------------------------------------------------------------------------------------------------
+def is_skylight_name(name):
+    return((name != None) and (re.match(r'SkylightLED-[0-9a-fA-F]{4}', name) != None))
+
+#---------------------------------------------------------------------------------------------------
+class DiscoveryCache:
+    """
+    Persistent record of the Skylight devices that were found, and when each was last seen.
+    Keyed by Bluetooth address.
+    """
+    def __init__(self, filename = DEFAULT_CACHE_FILE):
+        self.filename = filename
+        self.entries = {}
+        
+        if(os.path.exists(self.filename)):
+            with open(self.filename, 'r') as f:
+                self.entries = json.load(f)
+    
+    #-----------------------------------------------------------------------------------------------
+    def save(self):
+        dirname = os.path.dirname(self.filename)
+        if(dirname and not os.path.exists(dirname)):
+            os.makedirs(dirname)
+        
+        # Write to a temporary file first so an interrupted save can't corrupt the cache
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, 'w') as f:
+            json.dump(self.entries, f, indent=2, sort_keys = True)
+        os.replace(tmp_filename, self.filename)
+    
+    #-----------------------------------------------------------------------------------------------
+    def known_devices(self, max_age = MAX_AGE):
+        """
+        Returns list of (address, name) tuples, most recently seen first
+        """
+        now = time.time()
+        devs = []
+        for addr, entry in self.entries.items():
+            if(now - entry["last_seen"] <= max_age):
+                devs.append((entry["last_seen"], addr, entry["name"]))
+        devs.sort(reverse=True)
+        return([(addr, name) for _, addr, name in devs])
+    
+    #-----------------------------------------------------------------------------------------------
+    def seen(self, addr, name):
+        self.entries[addr] = {
+            "name": name,
+            "last_seen": time.time()
+        }
+        self.save()
+
+#---------------------------------------------------------------------------------------------------
+def probe_known(cache):
+    """
+    Asks each device in the cache for its name directly, which is much faster than an inquiry.
+    Devices are probed in parallel, and the whole probe is bounded by PROBE_TOTAL_TIMEOUT no
+    matter how many cached devices are absent.
+    Yields (address, name) tuples of the devices that answered, in the order they answered
+    """
+    known = cache.known_devices()
+    if(len(known) == 0):
+        return
+    
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(len(known), PROBE_THREADS))
+    try:
+        futures = {}
+        for addr, _ in known:
+            futures[executor.submit(bluetooth.lookup_name, addr, timeout = PROBE_TIMEOUT)] = addr
+        
+        try:
+            for future in concurrent.futures.as_completed(futures, timeout = PROBE_TOTAL_TIMEOUT):
+                addr = futures[future]
+                try:
+                    name = future.result()
+                except Exception as e:
+                    logging.getLogger("skylight").debug("Probing %s failed: %s" % (addr, e))
+                    continue
+                
+                if(is_skylight_name(name)):
+                    cache.seen(addr, name)
+                    yield((addr, name))
+        except concurrent.futures.TimeoutError:
+            # Remaining devices are not around
+            pass
+    finally:
+        # Don't wait for name requests that are still in flight
+        executor.shutdown(wait=False, cancel_futures=True)
+
+#---------------------------------------------------------------------------------------------------
+def inquire(duration = 8):
+    """
+    Runs a full device inquiry.
+    Yields (address, name) tuples as soon as each device is found rather than at the end of
+    the inquiry window
+    """
+    found = []
+    
+    class Discoverer(bluetooth.DeviceDiscoverer):
+        def pre_inquiry(self):
+            self.done = False
+        
+        def device_discovered(self, address, device_class, rssi, name):
+            if(type(name) == bytes):
+                name = name.decode("utf-8", errors="replace")
+            found.append((address, name))
+        
+        def inquiry_complete(self):
+            self.done = True
+    
+    D = Discoverer()
+    D.find_devices(lookup_names=True, duration=duration, flush_cache=True)
+    try:
+        while(not D.done):
+            readable, _, _ = select.select([D], [], [])
+            if(D in readable):
+                D.process_event()
+            
+            while(len(found) != 0):
+                yield(found.pop(0))
+    finally:
+        if(not D.done):
+            D.cancel_inquiry()
+
+#---------------------------------------------------------------------------------------------------
+def discover(cache = None, full_inquiry = None):
+    """
+    Discovers any BT devices that have a name that matches "SkylightLED-####"
+    Yields (address, name) tuples as devices are found. Each device is only reported once.
+    
+    Known devices from the cache are probed first. A full inquiry is only done if none
+    of them answered, unless full_inquiry is True (always) or False (never).
+    Devices found by the inquiry are added to the cache.
+    """
+    require_pybluez()
+    log = logging.getLogger("skylight")
+    
+    if(cache == None):
+        cache = DiscoveryCache()
+    
+    reported = set()
+    for addr, name in probe_known(cache):
+        log.debug("Found known device: %s - %s" % (addr, name))
+        reported.add(addr)
+        yield((addr, name))
+    
+    if(full_inquiry == False):
+        return
+    if((full_inquiry == None) and (len(reported) != 0)):
+        return
+    
+    for addr, name in inquire():
+        if(is_skylight_name(name) and (addr not in reported)):
+            log.debug("Found device: %s - %s" % (addr, name))
+            cache.seen(addr, name)
+            reported.add(addr)
+            yield((addr, name))
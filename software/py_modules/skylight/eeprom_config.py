@@ -2,60 +2,276 @@
 import struct
 from ..python_modules import encodable_class as ec
 from . import colors
+from .change_tracking import Tracked, Cached
 
 #===================================================================================================
 # Microcontroller Constants
 #===================================================================================================
 
 MAPPED_EEPROM_START = 0x1000
+EEPROM_SIZE = 2048
 TICKS_PER_SECOND = 64
 
 #===================================================================================================
-class cfgObject(ec.EncodableClass):
+# EEPROM Structures
+#===================================================================================================
+# Layouts are compiled once so that objects can be packed straight into the image
+
+# config_header_t:
+#   uint32_t timestamp
+#   int32_t clock_correction_interval
+#   uintptr_t default_modeset
+#   uintptr_t lighting_alarm_table
+#   uintptr_t modeset_change_table
+HEADER_STRUCT = struct.Struct("<IiHHH")
+
+# Common header of all transitions:
+#   uint8_t ID
+#   uint16_t delay
+TRANSITION_STRUCT = struct.Struct("<BH")
+
+# rgbw_t:
+#   uint16_t r
+#   uint16_t g
+#   uint16_t b
+#   uint16_t w
+RGBW_STRUCT = struct.Struct("<HHHH")
+
+# Item count of lists: uint8_t
+COUNT_STRUCT = struct.Struct("<B")
+
+# Duration in ticks: uint16_t
+DURATION_STRUCT = struct.Struct("<H")
+
+# Waveform transition:
+#   uintptr_t waveform
+#   uint16_t duration_ticks
+WAVEFORM_STRUCT = struct.Struct("<HH")
+
+# mode_entry_t:
+#   uintptr_t on_transition
+#   uintptr_t off_transition
+MODE_ENTRY_STRUCT = struct.Struct("<HH")
+
+# Alarm table entry:
+#   uint8_t dayofweek_mask
+#   uint8_t hour
+#   uint8_t minute
+#   uintptr_t data
+ALARM_ENTRY_STRUCT = struct.Struct("<BBBH")
+
+#===================================================================================================
+class CompileError(Exception):
+    pass
+
+class ImageSizeError(CompileError):
+    pass
+
+#---------------------------------------------------------------------------------------------------
+def describe_object(o):
+    """
+    Returns a short description of a config object for error messages
+    """
+    if(o == None):
+        return("<not set>")
+    if(getattr(o, "name", "")):
+        return("%s '%s'" % (type(o).__name__, o.name))
+    return(type(o).__name__)
+
+#---------------------------------------------------------------------------------------------------
+def get_reference_path(path):
+    """
+    Describes a chain of references for error messages.
+    path is a list of (parent, child number, child) tuples
+    """
+    return(" -> ".join(
+        ["%s: %s" % (parent.get_child_label(n), describe_object(o)) for parent, n, o in path]
+    ))
+
+#===================================================================================================
+# Layout Strategies
+#===================================================================================================
+class LayoutStrategy:
+    """
+    Selects how eeConfig.compile() arranges objects in the EEPROM image.
+    Objects that are equal are always stored once.
+    
+    name: Name the strategy is selected by
+    reuse: Place an object on an identical run of bytes that is already in the image
+        instead of appending a copy of it
+    overlap: Let an object start inside the end of the image if its first bytes match it
+    largest_first: Place the larger children of each object first, so that smaller ones are
+        more likely to find a copy of themselves in the image
+    """
+    def __init__(self, name, reuse = False, overlap = False, largest_first = False):
+        self.name = name
+        self.reuse = reuse
+        self.overlap = overlap
+        self.largest_first = largest_first
+
+# Available strategies, by name.
+# "dfs" appends each object after its children, in reference order. Its images are the same
+# size as those of the original compiler, but objects are not in the same order, so the bytes
+# differ.
+LAYOUT_STRATEGIES = {s.name: s for s in (
+    LayoutStrategy("dfs"),
+    LayoutStrategy("reuse", reuse=True),
+    LayoutStrategy("overlap", reuse=True, overlap=True),
+    LayoutStrategy("largest-first", reuse=True, overlap=True, largest_first=True),
+)}
+
+# Layout that compile() uses unless told otherwise
+DEFAULT_LAYOUT = "dfs"
+
+# Pseudo-strategy that tries all of the above and keeps the smallest image
+LAYOUT_SMALLEST = "smallest"
+
+#---------------------------------------------------------------------------------------------------
+class LayoutReport:
+    """
+    Describes the image produced by the last eeConfig.compile(). See eeConfig.layout_report
+    
+    strategy: Name of the strategy the image was laid out with
+    size: Size of the image in bytes
+    savings: Bytes saved by each optimization, by name:
+        "duplicates": Objects that are referenced more than once, or that are equal to one
+            already placed, are stored once
+        "reuse": Objects placed on an identical run of bytes already in the image
+        "overlap": Objects that start inside the end of the image
+    sizes: Image size reached by each strategy that was tried, by name.
+        None if that strategy did not fit in EEPROM
+    """
+    def __init__(self, strategy):
+        self.strategy = strategy
+        self.size = 0
+        self.savings = {
+            "duplicates": 0,
+            "reuse": 0,
+            "overlap": 0
+        }
+        self.sizes = {}
+    
+    def __str__(self):
+        lines = ["Layout '%s': %d of %d bytes" % (self.strategy, self.size, EEPROM_SIZE)]
+        for name, n_bytes in self.savings.items():
+            lines.append("  %-12s saved %5d bytes" % (name, n_bytes))
+        if(len(self.sizes) > 1):
+            for name, size in self.sizes.items():
+                if(size == None):
+                    lines.append("  Layout '%s' does not fit" % name)
+                else:
+                    lines.append("  Layout '%s' is %d bytes" % (name, size))
+        return("\n".join(lines))
+
+#===================================================================================================
+class cfgObject(ec.EncodableClass, Cached):
     """
     Base class for any object in the configuration EEPROM
     that is referenced indirectly via pointer.
+    
+    Compiling caches the object's struct key and encoding on it. They are reused by the next
+    compile unless the object, or anything it references, was changed since. See Cached.
+    The cached result is (struct key, tree size). See eeConfig.compile_layout()
     """
     
     encode_schema = {
         "name": str
     }
     
+    untracked_attributes = ("ee_address",)
+    
     def __init__(self):
         
         self.name = ""
         
         """
-        Byte address within EEPROM that this object is located
+        Byte address within EEPROM that this object is located.
+        Only kept up to date for objects whose address the image refers to. Objects inside a
+        duplicate that was not compiled again keep the address from an earlier compile.
         """
         self.ee_address = None
+        
+        # Encoding from the last pack_cached_into(), with the addresses of the children it
+        # was derived from. Dropped when the object changes
+        self._binary = None
+    
+    #-----------------------------------------------
+    def changed(self):
+        self._binary = None
+        Cached.changed(self)
+    
+    #-----------------------------------------------
+    def get_children(self):
+        """
+        Returns a list of the cfgObject instances that this object references directly.
+        An entry is None if the reference was never set.
+        If a subclass can reference a child object, it must extend this method
+        as well as get_child_label().
+        """
+        return([])
+    
+    #-----------------------------------------------
+    def get_child_label(self, n):
+        """
+        Says where the reference to child n is held, for error messages
+        """
+        return("child %d" % n)
     
     #-----------------------------------------------
     def get_all_objects(self):
         """
         Recursively get handles to all cfgObject instances referenced
         Include self.
-        If a subclass can reference a child object, it must extend this method.
         """
         obj = [self]
+        for child in self.get_children():
+            if(child):
+                obj += child.get_all_objects()
         return(obj)
     
     #-----------------------------------------------
-    def is_compilable(self):
+    def get_size(self):
         """
-        To compile an object, the addresses of any of its children must be known
-        Check children (if any)
-        If a subclass can reference a child object, it must extend this method.
+        Returns the size of the object's binary representation
         """
-        return(True)
+        raise Exception("Must override this method!")
+    
+    #-----------------------------------------------
+    def pack_into(self, buf, offset):
+        """
+        Writes the object's binary representation into buf at offset.
+        Returns the offset just past it.
+        """
+        raise Exception("Must override this method!")
     
     #-----------------------------------------------
     def to_binary(self):
         """
         Compile object into its binary representation
         """
-        raise Exception("Must override this method!")
+        buf = bytearray(self.get_size())
+        self.pack_into(buf, 0)
+        return(bytes(buf))
+    
+    #-----------------------------------------------
+    def pack_cached_into(self, buf, offset):
+        """
+        Same as pack_into(), but reuses the encoding from the previous call if it still applies.
+        Apart from the object's contents, the encoding only depends on the addresses of its
+        children, so it is reused if the object did not change and they did not move.
+        """
+        addresses = tuple([child.ee_address for child in self.get_children()])
         
+        cache = self.__dict__.get("_binary")
+        if((cache != None) and (cache[0] == addresses)):
+            end = offset + len(cache[1])
+            buf[offset:end] = cache[1]
+            return(end)
+        
+        end = self.pack_into(buf, offset)
+        self._binary = (addresses, bytes(memoryview(buf)[offset:end]))
+        return(end)
+    
     #-----------------------------------------------
     # Utility Methods
     #-----------------------------------------------
@@ -64,7 +280,33 @@ class cfgObject(ec.EncodableClass):
         if(type(other) != type(self)):
             return(False)
         return(True)
+    
+    def get_struct_key(self, keys = None):
+        """
+        Returns a hashable value that is equal for two objects if and only if they compare equal.
+        Used to find duplicate objects with a dictionary lookup.
+        Subclasses that extend __eq__ must extend this too.
         
+        keys: Optional dict of struct keys that were already computed, by id().
+            Keys of children must be obtained with get_shared_struct_key(keys).
+        """
+        return((type(self),))
+    
+    def get_shared_struct_key(self, keys):
+        """
+        Same as get_struct_key(), but each object's key is only computed once.
+        keys is a dict of struct keys that were already computed, by id(). It is updated.
+        The objects must not be modified while keys is in use.
+        """
+        if(keys == None):
+            return(self.get_struct_key())
+        
+        key = keys.get(id(self))
+        if(key == None):
+            key = self.get_struct_key(keys)
+            keys[id(self)] = key
+        return(key)
+
 #===================================================================================================
 # Lighting Transitions
 #===================================================================================================
@@ -86,16 +328,17 @@ class Transition(cfgObject):
         self.delay = 0.0
     
     #-----------------------------------------------
-    def to_binary(self):
+    def get_size(self):
+        return(TRANSITION_STRUCT.size)
+    
+    def pack_into(self, buf, offset):
         
         # Convert delay seconds into ticks
         delay_ticks = int(self.delay * TICKS_PER_SECOND)
         
-        # uint8_t ID
-        # uint16_t delay
-        b = struct.pack("<BH", self.ID, delay_ticks)
-        return(b)
-        
+        TRANSITION_STRUCT.pack_into(buf, offset, self.ID, delay_ticks)
+        return(offset + TRANSITION_STRUCT.size)
+    
     #-----------------------------------------------
     # Utility Methods
     #-----------------------------------------------
@@ -108,6 +351,9 @@ class Transition(cfgObject):
             
         return(True)
     
+    def get_struct_key(self, keys = None):
+        return(cfgObject.get_struct_key(self) + (self.delay,))
+    
 #---------------------------------------------------------------------------------------------------
 class trans_Immediate(Transition):
     ID = 0
@@ -121,21 +367,18 @@ class trans_Immediate(Transition):
         
         """ Color setting after transition completes """
         self.color = colors.Color_rgb(0,0,0)
-        
+    
     #-----------------------------------------------
-    def to_binary(self):
-        rgbw_tuple = self.color.get_rgbw()
-        
-        b = Transition.to_binary(self)
-        
-        # rgbw_t color:
-        #   uint16_t r
-        #   uint16_t g
-        #   uint16_t b
-        #   uint16_t w
-        b += struct.pack("<HHHH", *rgbw_tuple)
-        return(b)
+    def get_size(self):
+        return(Transition.get_size(self) + RGBW_STRUCT.size)
+    
+    def pack_into(self, buf, offset):
+        offset = Transition.pack_into(self, buf, offset)
         
+        # rgbw_t color
+        RGBW_STRUCT.pack_into(buf, offset, *self.color.get_rgbw())
+        return(offset + RGBW_STRUCT.size)
+    
     #-----------------------------------------------
     # Utility Methods
     #-----------------------------------------------
@@ -148,6 +391,9 @@ class trans_Immediate(Transition):
             
         return(True)
     
+    def get_struct_key(self, keys = None):
+        return(Transition.get_struct_key(self) + (self.color.get_struct_key(),))
+    
 #---------------------------------------------------------------------------------------------------
 class trans_Fade(Transition):
     ID = 1
@@ -167,24 +413,22 @@ class trans_Fade(Transition):
         self.duration = 1.0
         
     #-----------------------------------------------
-    def to_binary(self):
+    def get_size(self):
+        return(Transition.get_size(self) + RGBW_STRUCT.size + DURATION_STRUCT.size)
+    
+    def pack_into(self, buf, offset):
         
         # Convert duration seconds into ticks
         duration_ticks = int(self.duration * TICKS_PER_SECOND)
         
-        rgbw_tuple = self.color.get_rgbw()
-        
-        b = Transition.to_binary(self)
+        offset = Transition.pack_into(self, buf, offset)
         
-        # rgbw_t color:
-        #   uint16_t r
-        #   uint16_t g
-        #   uint16_t b
-        #   uint16_t w
+        # rgbw_t color
         # uint16_t duration
-        b += struct.pack("<HHHH", *rgbw_tuple)
-        b += struct.pack("<H", duration_ticks)
-        return(b)
+        RGBW_STRUCT.pack_into(buf, offset, *self.color.get_rgbw())
+        offset += RGBW_STRUCT.size
+        DURATION_STRUCT.pack_into(buf, offset, duration_ticks)
+        return(offset + DURATION_STRUCT.size)
     #-----------------------------------------------
     # Utility Methods
     #-----------------------------------------------
@@ -200,6 +444,9 @@ class trans_Fade(Transition):
             
         return(True)
     
+    def get_struct_key(self, keys = None):
+        return(Transition.get_struct_key(self) + (self.duration, self.color.get_struct_key()))
+    
 
 #---------------------------------------------------------------------------------------------------
 class ColorList(cfgObject):
@@ -217,22 +464,21 @@ class ColorList(cfgObject):
         self.colors = [colors.Color_rgb(0,0,0)]
         
     #-----------------------------------------------
-    def to_binary(self):
+    def get_size(self):
+        return(COUNT_STRUCT.size + len(self.colors) * RGBW_STRUCT.size)
+    
+    def pack_into(self, buf, offset):
         
         # uint8_t n_colors
-        b = struct.pack("<B", len(self.colors))
+        COUNT_STRUCT.pack_into(buf, offset, len(self.colors))
+        offset += COUNT_STRUCT.size
         for color in self.colors:
-            rgbw_tuple = color.get_rgbw()
-            
-            # rgbw_t color:
-            #   uint16_t r
-            #   uint16_t g
-            #   uint16_t b
-            #   uint16_t w
-            b += struct.pack("<HHHH", *rgbw_tuple)
-            
-        return(b)
+            # rgbw_t color
+            RGBW_STRUCT.pack_into(buf, offset, *color.get_rgbw())
+            offset += RGBW_STRUCT.size
         
+        return(offset)
+    
     #-----------------------------------------------
     # Utility Methods
     #-----------------------------------------------
@@ -244,6 +490,9 @@ class ColorList(cfgObject):
             return(False)
         
         return(True)
+    
+    def get_struct_key(self, keys = None):
+        return(cfgObject.get_struct_key(self) + tuple([c.get_struct_key() for c in self.colors]))
 
 #---------------------------------------------------------------------------------------------------
 class trans_Waveform(Transition):
@@ -262,36 +511,30 @@ class trans_Waveform(Transition):
         
         """ Number of ticks the transition takes """
         self.duration = 0.0
-        
-    #-----------------------------------------------
-    def get_all_objects(self):
-        obj = Transition.get_all_objects(self)
-        
-        obj += self.waveform.get_all_objects()
-            
-        return(obj)
     
     #-----------------------------------------------
-    def is_compilable(self):
-        
-        if(self.waveform.ee_address == None):
-            return(False)
-        
-        return(True)
+    def get_children(self):
+        return([self.waveform])
+    
+    def get_child_label(self, n):
+        return("waveform")
     
     #-----------------------------------------------
-    def to_binary(self):
+    def get_size(self):
+        return(Transition.get_size(self) + WAVEFORM_STRUCT.size)
+    
+    def pack_into(self, buf, offset):
         
-        b = Transition.to_binary(self)
+        offset = Transition.pack_into(self, buf, offset)
         
         # Convert duration seconds into ticks
         duration_ticks = int(self.duration * TICKS_PER_SECOND)
         
         # uintptr_t waveform
         # uint16_t duration_ticks
-        b += struct.pack("<HH", self.waveform.ee_address, duration_ticks)
-        return(b)
-        
+        WAVEFORM_STRUCT.pack_into(buf, offset, self.waveform.ee_address, duration_ticks)
+        return(offset + WAVEFORM_STRUCT.size)
+    
     #-----------------------------------------------
     # Utility Methods
     #-----------------------------------------------
@@ -307,6 +550,9 @@ class trans_Waveform(Transition):
         
         return(True)
     
+    def get_struct_key(self, keys = None):
+        return(Transition.get_struct_key(self) + (self.duration, self.waveform.get_shared_struct_key(keys)))
+
 #===================================================================================================
 # ModeSets
 #===================================================================================================
@@ -324,39 +570,33 @@ class ModeSet(cfgObject):
         (on_transition, off_transition)
         """
         self.modes = []
-        
-    #-----------------------------------------------
-    def get_all_objects(self):
-        obj = cfgObject.get_all_objects(self)
-        
-        for mode in self.modes:
-            obj += mode[0].get_all_objects()
-            obj += mode[1].get_all_objects()
-        
-        return(obj)
     
     #-----------------------------------------------
-    def is_compilable(self):
-        
+    def get_children(self):
+        children = []
         for mode in self.modes:
-            if((mode[0].ee_address == None) or (mode[1].ee_address == None)):
-                return(False)
-        
-        return(True)
-        
+            children.extend(mode)
+        return(children)
+    
+    def get_child_label(self, n):
+        return("modes[%d] %s" % (n // 2, ("on", "off")[n % 2]))
+    
     #-----------------------------------------------
-    def to_binary(self):
+    def get_size(self):
+        return(COUNT_STRUCT.size + len(self.modes) * MODE_ENTRY_STRUCT.size)
+    
+    def pack_into(self, buf, offset):
         
         # uint8_t n_modes
-        b = struct.pack("<B", len(self.modes))
+        COUNT_STRUCT.pack_into(buf, offset, len(self.modes))
+        offset += COUNT_STRUCT.size
         for mode in self.modes:
             # mode_entry_t
-            #   uintptr_t on_transition
-            #   uintptr_t off_transition
-            b += struct.pack("<HH", mode[0].ee_address, mode[1].ee_address)
-            
-        return(b)
+            MODE_ENTRY_STRUCT.pack_into(buf, offset, mode[0].ee_address, mode[1].ee_address)
+            offset += MODE_ENTRY_STRUCT.size
         
+        return(offset)
+    
     #-----------------------------------------------
     # Utility Methods
     #-----------------------------------------------
@@ -368,12 +608,16 @@ class ModeSet(cfgObject):
             return(False)
         
         return(True)
+    
+    def get_struct_key(self, keys = None):
+        modes = tuple([(on.get_shared_struct_key(keys), off.get_shared_struct_key(keys)) for on, off in self.modes])
+        return(cfgObject.get_struct_key(self) + modes)
         
 #===================================================================================================
 # Alarm Tables
 #===================================================================================================
 
-class AlarmEntry(ec.EncodableClass):
+class AlarmEntry(ec.EncodableClass, Tracked):
     
     encode_schema = {
         "name":str,
@@ -410,19 +654,15 @@ class AlarmEntry(ec.EncodableClass):
         self.data = None
     
     #-----------------------------------------------
-    def to_binary(self):
+    def pack_into(self, buf, offset):
         # Collapse dow_list into bit mask
         dow_mask = 0
         for dow in self.dow_list:
             dow_mask |= 2**dow
         
-        # uint8_t dayofweek_mask
-        # uint8_t hour
-        # uint8_t minute
-        # uintptr_t data
-        b = struct.pack("<BBBH", dow_mask, self.hour, self.minute, self.data.ee_address)
-        return(b)
-        
+        ALARM_ENTRY_STRUCT.pack_into(buf, offset, dow_mask, self.hour, self.minute, self.data.ee_address)
+        return(offset + ALARM_ENTRY_STRUCT.size)
+    
     #-----------------------------------------------
     # Utility Methods
     #-----------------------------------------------
@@ -444,6 +684,16 @@ class AlarmEntry(ec.EncodableClass):
             return(False)
             
         return(True)
+    
+    def get_struct_key(self, keys = None):
+        """
+        See cfgObject.get_struct_key()
+        """
+        if(self.data == None):
+            data = None
+        else:
+            data = self.data.get_shared_struct_key(keys)
+        return((type(self), frozenset(self.dow_list), self.hour, self.minute, data))
         
 #---------------------------------------------------------------------------------------------------
 class AlarmTable(cfgObject):
@@ -459,37 +709,29 @@ class AlarmTable(cfgObject):
         List of AlarmEntry items
         """
         self.alarms = []
-        
-    #-----------------------------------------------
-    def get_all_objects(self):
-        obj = cfgObject.get_all_objects(self)
-        
-        for alarm in self.alarms:
-            if(alarm.data):
-                obj += alarm.data.get_all_objects()
-        
-        return(obj)
     
     #-----------------------------------------------
-    def is_compilable(self):
-        
-        for alarm in self.alarms:
-            if(alarm.data == None):
-                return(False)
-            elif(alarm.data.ee_address == None):
-                return(False)
-        
-        return(True)
-        
+    def get_children(self):
+        return([alarm.data for alarm in self.alarms])
+    
+    def get_child_label(self, n):
+        if(self.alarms[n].name):
+            return("alarms[%d] '%s'" % (n, self.alarms[n].name))
+        return("alarms[%d]" % n)
+    
     #-----------------------------------------------
-    def to_binary(self):
+    def get_size(self):
+        return(COUNT_STRUCT.size + len(self.alarms) * ALARM_ENTRY_STRUCT.size)
+    
+    def pack_into(self, buf, offset):
         
         # uint8_t n_items
-        b = struct.pack("<B", len(self.alarms))
+        COUNT_STRUCT.pack_into(buf, offset, len(self.alarms))
+        offset += COUNT_STRUCT.size
         for alarm in self.alarms:
-            b += alarm.to_binary()
-            
-        return(b)
+            offset = alarm.pack_into(buf, offset)
+        
+        return(offset)
     #-----------------------------------------------
     # Utility Methods
     #-----------------------------------------------
@@ -501,9 +743,12 @@ class AlarmTable(cfgObject):
             return(False)
         
         return(True)
-        
+    
+    def get_struct_key(self, keys = None):
+        return(cfgObject.get_struct_key(self) + tuple([a.get_struct_key(keys) for a in self.alarms]))
+
 #===================================================================================================
-class eeConfig(ec.EncodableClass):
+class eeConfig(ec.EncodableClass, Cached):
     
     encode_schema = {
         "clock_correction_interval":int,
@@ -512,6 +757,8 @@ class eeConfig(ec.EncodableClass):
         "modeset_change_table":AlarmTable
     }
     
+    untracked_attributes = ("layout_report",)
+    
     def __init__(self):
         
         """
@@ -542,27 +789,34 @@ class eeConfig(ec.EncodableClass):
         t_off = trans_Immediate()
         t_on.color = colors.Color_raw(0x0000,0x0000,0x0000,0xFFFF)
         self.default_modeset.modes = [(t_on, t_off)]
-        
+    
     #-----------------------------------------------
-    def to_binary(self, dummy = False):
-        
-        # uint32_t timestamp
-        # int32_t clock_correction_interval
-        # uintptr_t default_modeset
-        # uintptr_t lighting_alarm_table
-        # uintptr_t modeset_change_table
-        if(dummy):
-            b = struct.pack("<IiHHH", 0, 0, 0, 0, 0)
-        else:
-            b = struct.pack("<IiHHH", 0,
-                                self.clock_correction_interval,
-                                self.default_modeset.ee_address,
-                                self.lighting_alarm_table.ee_address,
-                                self.modeset_change_table.ee_address,
-                            )
-        
-        return(b)
-        
+    def get_size(self):
+        return(HEADER_STRUCT.size)
+    
+    def pack_into(self, buf, offset):
+        
+        # config_header_t
+        HEADER_STRUCT.pack_into(buf, offset, 0,
+                            self.clock_correction_interval,
+                            self.default_modeset.ee_address,
+                            self.lighting_alarm_table.ee_address,
+                            self.modeset_change_table.ee_address,
+                        )
+        return(offset + HEADER_STRUCT.size)
+    
+    def to_binary(self):
+        buf = bytearray(self.get_size())
+        self.pack_into(buf, 0)
+        return(bytes(buf))
+    
+    #-----------------------------------------------
+    def get_children(self):
+        return([self.default_modeset, self.lighting_alarm_table, self.modeset_change_table])
+    
+    def get_child_label(self, n):
+        return(("default_modeset", "lighting_alarm_table", "modeset_change_table")[n])
+    
     #-----------------------------------------------
     def get_all_objects(self):
         obj = self.default_modeset.get_all_objects()
@@ -572,70 +826,226 @@ class eeConfig(ec.EncodableClass):
         return(obj)
 
     #-----------------------------------------------
-    def compile(self):
+    def compile(self, strategy = DEFAULT_LAYOUT):
         """
         Compile the configuration into an EEPROM image
+        strategy: Name of the layout strategy to use. See LAYOUT_STRATEGIES.
+            LAYOUT_SMALLEST tries each of them and keeps the smallest image.
+        
+        Afterwards, self.layout_report describes the result
+        
+        If nothing changed since the last compile with the same strategy, its image is returned
+        """
+        cache = self.get_cached()
+        if((cache != None) and (cache[0] == strategy)):
+            self.layout_report = cache[2]
+            return(cache[1])
+        
+        self.adopt_references()
+        image = self.compile_strategy(strategy)
+        
+        self.set_cached((strategy, image, self.layout_report))
+        return(image)
+    
+    #-----------------------------------------------
+    def compile_strategy(self, strategy):
+        """
+        Same as compile(), without reusing the previous image
+        """
+        if(strategy != LAYOUT_SMALLEST):
+            if(strategy not in LAYOUT_STRATEGIES):
+                raise ValueError("Unknown layout strategy '%s'" % strategy)
+            image = self.compile_layout(LAYOUT_STRATEGIES[strategy])
+            self.layout_report.sizes[strategy] = len(image)
+            return(image)
+        
+        sizes = {}
+        for name, s in LAYOUT_STRATEGIES.items():
+            try:
+                sizes[name] = len(self.compile_layout(s))
+            except ImageSizeError:
+                sizes[name] = None
+        
+        fits = [name for name in sizes if(sizes[name] != None)]
+        if(len(fits) == 0):
+            raise ImageSizeError("Configuration image exceeds 2kB. Will not fit in EEPROM")
+        
+        # On a tie, the earlier, simpler strategy wins
+        best = min(fits, key=lambda name: sizes[name])
+        
+        # Lay out the winner again so that the objects are left at its addresses
+        image = self.compile_layout(LAYOUT_STRATEGIES[best])
+        self.layout_report.sizes = sizes
+        return(image)
+    
+    #-----------------------------------------------
+    def compile_layout(self, strategy):
+        """
+        Compile the configuration into an EEPROM image using the given LayoutStrategy
         """
+        report = LayoutReport(strategy.name)
+        self.layout_report = report
         
-        # Initialize EEPROM address
-        ee_address = MAPPED_EEPROM_START
+        # Objects are about to move. The image that compile() cached no longer matches them
+        self.set_cached(None)
         
-        # Create dummy header for now
-        image = self.to_binary(dummy=True)
-        ee_address += len(image)
+        # Objects are packed directly into an image the size of the EEPROM.
+        # Space for the header is reserved up front. It is written last, once the addresses it
+        # points to are known.
+        image = bytearray(EEPROM_SIZE)
+        offset = self.get_size()
         
-        # Collect a list of all cfgObject instances in the entire configuration
-        uncompiled = self.get_all_objects()
+        # Objects are laid out in one depth-first pass over the configuration.
+        # An object is placed once all of its children have been placed, so their addresses are
+        # known when it is converted to binary.
         
-        # Reset each object's compile state (Make sure their ee_address are all None)
-        for o in uncompiled:
-            o.ee_address = None
+        # Compiled objects are indexed by their structure so that duplicates can be found quickly
+        compiled = {}
         
-        # Loop until all objects have been compiled
-        compiled = []
-        while(len(uncompiled) != 0):
-            still_uncompiled = []
-            for o in uncompiled:
-                if(o.is_compilable()):
-                    # Compile the object
-                    
-                    # First, check if an equivalent copy of the object already exists
-                    for co in compiled:
-                        if(o == co):
-                            # An equivalent object has already been compiled.
-                            # Reuse that object by sharing the reference to it
-                            o.ee_address = co.ee_address
-                            break
-                    else:
-                        # An equivalent does not exist.
-                        # Compile it.
-                        
-                        # Append to EEPROM image and assign the resulting ee_address
-                        b = o.to_binary()
-                        o.ee_address = ee_address
-                        ee_address += len(b)
-                        image += b
-                        
-                        # Save to compiled list for potential reuse
-                        compiled.append(o)
-                    
-                else:
-                    # Not compilable yet. Set aside
-                    still_uncompiled.append(o)
+        # Struct keys, by id(). Each key is only computed once. Objects that did not change since
+        # the last compile use the key they cached then
+        keys = {}
+        
+        # Size of each object plus everything it references, counting each reference
+        # separately, by id(). This is what the image would take if nothing was shared
+        tree_sizes = {}
+        
+        # Bytes taken by the objects that were placed rather than shared
+        placed = 0
+        
+        # Objects that changed since the last compile. Once the image is complete, they cache
+        # their struct key and tree size until they change again
+        changed = []
+        
+        # Objects that were already placed, by id()
+        done = set()
+        
+        # Chain of references to the object being compiled, as (parent, child number, object)
+        path = []
+        
+        # Objects in path, by id()
+        walking = set()
+        
+        def place_shared(o):
+            """
+            Places an object in the image, sharing bytes with what is already there if the
+            strategy allows it. Returns the object's offset in the image
+            """
+            nonlocal offset
+            
+            # Encode it on its own first, to compare against the image
+            b = bytearray(o.get_size())
+            o.pack_cached_into(b, 0)
             
-            # Finished loop through uncompiled list
-            if(not len(still_uncompiled) < len(uncompiled)):
-                # This pass did not accomplish anything!
-                raise Exception("Compile is stuck! Pass did not make any progress")
+            # The header is not written yet, so it is never shared
+            if(strategy.reuse):
+                start = image.find(b, HEADER_STRUCT.size, offset)
+                if(start >= 0):
+                    report.savings["reuse"] += len(b)
+                    return(start)
             
-            uncompiled = still_uncompiled
+            # Longest run at the end of the image that the object can start with
+            n_shared = 0
+            if(strategy.overlap):
+                for n in range(min(len(b) - 1, offset - HEADER_STRUCT.size), 0, -1):
+                    if(image.startswith(b[:n], offset - n, offset)):
+                        n_shared = n
+                        break
+            
+            start = offset - n_shared
+            if(start + len(b) > EEPROM_SIZE):
+                raise ImageSizeError("Configuration image exceeds 2kB. Will not fit in EEPROM")
+            
+            image[offset:start + len(b)] = b[n_shared:]
+            offset = start + len(b)
+            report.savings["overlap"] += n_shared
+            return(start)
+        
+        def compile_object(parent, n, o):
+            nonlocal offset, placed
+            
+            if(id(o) in done):
+                return
+            
+            if(not o):
+                raise CompileError("Compile is stuck! Reference is not set: %s" % (
+                    get_reference_path(path + [(parent, n, o)])
+                ))
+            
+            cache = o.get_cached()
+            if(cache != None):
+                # The object did not change since the last compile, so its struct key is known
+                # without looking at its children. If an equivalent was already placed, the
+                # image never refers to anything it references, so they need not be compiled.
+                keys[id(o)] = cache[0]
+                tree_sizes[id(o)] = cache[1]
+                co = compiled.get(cache[0])
+                if(co):
+                    o.ee_address = co.ee_address
+                    done.add(id(o))
+                    return
+            else:
+                o.adopt_references()
+                changed.append(o)
+            
+            children = o.get_children()
+            if(len(children) != 0):
+                path.append((parent, n, o))
+                if(id(o) in walking):
+                    raise CompileError("Compile is stuck! Reference cycle: %s" % get_reference_path(path))
+                
+                walking.add(id(o))
+                children = list(enumerate(children))
+                if(strategy.largest_first):
+                    children.sort(key=lambda c: c[1].get_size() if(c[1]) else 0, reverse=True)
+                for child_n, child in children:
+                    compile_object(o, child_n, child)
+                walking.remove(id(o))
+                path.pop()
+            
+            if(cache == None):
+                key = o.get_shared_struct_key(keys)
+                tree_sizes[id(o)] = o.get_size() + sum([tree_sizes[id(c)] for _, c in children])
+            else:
+                key = cache[0]
+            
+            # First, check if an equivalent copy of the object already exists
+            co = compiled.get(key)
+            if(co):
+                # An equivalent object has already been compiled.
+                # Reuse that object by sharing the reference to it
+                o.ee_address = co.ee_address
+            else:
+                # An equivalent does not exist.
+                # Compile it.
+                placed += o.get_size()
+                
+                if(strategy.reuse or strategy.overlap):
+                    o.ee_address = MAPPED_EEPROM_START + place_shared(o)
+                else:
+                    if(offset + o.get_size() > EEPROM_SIZE):
+                        raise ImageSizeError("Configuration image exceeds 2kB. Will not fit in EEPROM")
+                    
+                    # Append to EEPROM image and assign the resulting ee_address
+                    # Objects that did not change since the last compile are not encoded again
+                    o.ee_address = MAPPED_EEPROM_START + offset
+                    offset = o.pack_cached_into(image, offset)
+                
+                # Save for potential reuse
+                compiled[key] = o
+            done.add(id(o))
+        
+        for n, o in enumerate(self.get_children()):
+            compile_object(self, n, o)
         
         # Finished compiling objects.
-        # Replace header with actual header
-        hdr = self.to_binary()
-        image = hdr + image[len(hdr):]
+        # Fill in the actual header
+        self.pack_into(image, 0)
         
-        if(len(image) > 2048):
-            raise Exception("Configuration image exceeds 2kB. Will not fit in EEPROM")
+        report.savings["duplicates"] = sum([tree_sizes[id(o)] for o in self.get_children()]) - placed
         
-        return(image)
+        for o in changed:
+            o.set_cached((keys[id(o)], tree_sizes[id(o)]))
+        
+        report.size = offset
+        return(bytes(memoryview(image)[:offset]))
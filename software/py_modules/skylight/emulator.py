@@ -0,0 +1,554 @@
+import os
+import time
+import heapq
+import socket
+import logging
+import datetime
+import threading
+import binascii
+import struct
+import collections
+
+from . import ihex as ihex_file
+from . import btLink
+from .btLink import APP_RX_BUF_SIZE, BL_RX_BUF_SIZE, EE_PAGE_SIZE
+
+# Line buffer size of each firmware's CLI (CLI_STRBUF_SIZE), including the terminator
+APP_STRBUF_SIZE = 96
+BL_STRBUF_SIZE = 64
+
+# Max number of words per command line (CLI_MAX_ARGC)
+APP_MAX_ARGC = 16
+BL_MAX_ARGC = 4
+
+EEPROM_SIZE = 2048
+FLASH_SIZE = 128 * 1024
+
+# Seconds that commands keep the CLI busy on the real hardware.
+# Anything not listed completes instantly.
+DEFAULT_EXEC_TIME = {
+    "cfg_write": 0.011,         # EEPROM page erase + write
+    "cfg_write64": 0.011,
+    "cfg_erase": 0.011,
+    "cfg_reload": 0.002,
+    "flash_page_write": 0.008,  # Self-programming page erase + write. Charged per ihex page
+    "reset": 0.3,               # Bootloader startup delay and RN42 setup
+    "boot": 0.05,
+}
+
+class _CmdFail(Exception):
+    pass
+
+#---------------------------------------------------------------------------------------------------
+class _Session:
+    """
+    One connection to the emulator.
+    The threads that serve it stop once it is stopped, even if another connection was started
+    since, and they never touch the state of the next one.
+    """
+    def __init__(self, write, close):
+        self.write = write
+        self.close = close
+        self.running = True
+
+#---------------------------------------------------------------------------------------------------
+class DeviceEmulator:
+    """
+    Emulates the application and bootloader command line interfaces of a Skylight controller,
+    as seen from the far side of the RN42 Bluetooth link.
+    
+    Timing is modelled on the real hardware:
+        - The link adds rtt/2 of latency in each direction.
+        - Every byte takes 10 bit times on the 8N1 UART between the RN42 and the controller.
+        - Commands keep the CLI busy for their execution time (see DEFAULT_EXEC_TIME).
+          Bytes received in the meantime are held in a UART RX FIFO of the firmware's size.
+          If the FIFO is full, the byte is dropped and counted in overflows.
+    
+    Setting baud to None and rtt to 0 disables all pacing.
+    """
+    def __init__(self, baud = 115200, rtt = 0, exec_time = None, rx_buf_size = None,
+                 bootloader = False, build_timestamp = 0x5B0C0DE0, disabled_commands = ()):
+        """
+        baud: UART bit rate. None disables byte pacing.
+        rtt: Round trip time of the Bluetooth link in seconds
+        exec_time: Dictionary of execution time overrides. See DEFAULT_EXEC_TIME
+        rx_buf_size: Overrides the UART RX FIFO size of both firmware images
+        bootloader: Start in the bootloader rather than the application
+        build_timestamp: Firmware build timestamp that is stamped into the config header
+        disabled_commands: Commands to treat as unknown, to emulate older firmware
+        """
+        if(baud):
+            self.byte_time = 10.0 / baud
+        else:
+            self.byte_time = 0
+        self.rtt = rtt
+        self.exec_time = dict(DEFAULT_EXEC_TIME)
+        if(exec_time != None):
+            self.exec_time.update(exec_time)
+        self.rx_buf_size_override = rx_buf_size
+        self.build_timestamp = build_timestamp
+        self.disabled_commands = disabled_commands
+        self.log = logging.getLogger("skylight")
+        
+        # Device state
+        self.eeprom = bytearray(b"\xFF" * EEPROM_SIZE)
+        self.flash = bytearray(b"\xFF" * FLASH_SIZE)
+        # Pretend an application is installed: Reset vector is a jmp
+        self.flash[0:4] = b"\x0C\x94\x00\x00"
+        self.rgbw = (0, 0, 0, 0)
+        self.led = False
+        self.cfg_loaded = False
+        self.reset_state(bootloader)
+        
+        # Statistics
+        self.overflows = 0
+        self.cmd_log = []
+        
+        # Link timing state
+        self.lock = threading.Condition()
+        self.uart_rx_free = 0
+        self.uart_tx_free = 0
+        self.cli_free = 0
+        self.fifo = collections.deque()
+        self.tx_queue = []
+        self.tx_seq = 0
+        
+        # Connection being served. None until start() is called
+        self.session = None
+    
+    #-----------------------------------------------------------------------------------------------
+    def reset_state(self, bootloader):
+        """
+        Clears everything that lives in RAM
+        """
+        self.bootloader = bootloader
+        self.echo = False
+        self.line = bytearray()
+        self.first_page_buffer = bytearray(b"\xFF" * ihex_file.FLASH_PAGE_SIZE)
+        self.first_page_dirty = False
+        self.open_flash_page = None
+        self.time_set = None
+        self.time_set_at = None
+        self.ref_time = None
+        self.dst = (0, 0)
+    
+    #-----------------------------------------------------------------------------------------------
+    @property
+    def rx_buf_size(self):
+        if(self.rx_buf_size_override != None):
+            return(self.rx_buf_size_override)
+        if(self.bootloader):
+            return(BL_RX_BUF_SIZE)
+        return(APP_RX_BUF_SIZE)
+    
+    #-----------------------------------------------------------------------------------------------
+    # Transports
+    #-----------------------------------------------------------------------------------------------
+    def connect(self):
+        """
+        Starts the emulator on one end of a socketpair.
+        Returns the other end, which can be passed to btLink as its sock.
+        """
+        host_sock, dev_sock = socket.socketpair()
+        self.start(dev_sock.recv, dev_sock.sendall, dev_sock.close)
+        return(host_sock)
+    
+    #-----------------------------------------------------------------------------------------------
+    def open_pty(self):
+        """
+        Starts the emulator on a pseudo-terminal.
+        Returns the path of the terminal device, which serial tools can open.
+        """
+        import tty
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        
+        def write(data):
+            while(len(data)):
+                n = os.write(master, data)
+                data = data[n:]
+        
+        def read(n):
+            try:
+                return(os.read(master, n))
+            except OSError:
+                # Raised once the last handle to the slave side is closed
+                return(b"")
+        
+        self.pty_slave = slave
+        self.start(read, write, lambda: os.close(master))
+        return(os.ttyname(slave))
+    
+    #-----------------------------------------------------------------------------------------------
+    def start(self, read, write, close):
+        """
+        Serves a new connection. Any previous one is stopped first.
+        Like the RN42 dropping a link, this does not reset the device, but whatever was in
+        flight on the previous connection is lost.
+        """
+        self.stop()
+        
+        with self.lock:
+            self.tx_queue = []
+            self.fifo.clear()
+            self.line = bytearray()
+            session = _Session(write, close)
+            self.session = session
+        
+        threading.Thread(target=self.rx_thread, args=(session, read), daemon=True).start()
+        threading.Thread(target=self.tx_thread, args=(session,), daemon=True).start()
+    
+    #-----------------------------------------------------------------------------------------------
+    def stop(self):
+        with self.lock:
+            session = self.session
+            if(session == None):
+                return
+            self.session = None
+            session.running = False
+            self.lock.notify_all()
+        session.close()
+    
+    #-----------------------------------------------------------------------------------------------
+    def rx_thread(self, session, read):
+        while(session.running):
+            try:
+                data = read(1024)
+            except OSError:
+                break
+            if(len(data) == 0):
+                break
+            
+            with self.lock:
+                if(not session.running):
+                    # Arrived as the connection was stopped. The next one must not see it
+                    break
+                self.receive(data, time.perf_counter())
+                self.lock.notify_all()
+        
+        with self.lock:
+            session.running = False
+            self.lock.notify_all()
+    
+    #-----------------------------------------------------------------------------------------------
+    def tx_thread(self, session):
+        while(True):
+            with self.lock:
+                while(session.running):
+                    now = time.perf_counter()
+                    if((len(self.tx_queue) != 0) and (self.tx_queue[0][0] <= now)):
+                        break
+                    if(len(self.tx_queue) != 0):
+                        self.lock.wait(self.tx_queue[0][0] - now)
+                    else:
+                        self.lock.wait()
+                if(not session.running):
+                    return
+                
+                # Send everything that is due in one go
+                data = b""
+                now = time.perf_counter()
+                while((len(self.tx_queue) != 0) and (self.tx_queue[0][0] <= now)):
+                    data += heapq.heappop(self.tx_queue)[2]
+            
+            try:
+                session.write(data)
+            except OSError:
+                return
+    
+    #-----------------------------------------------------------------------------------------------
+    # Link and UART timing model
+    #-----------------------------------------------------------------------------------------------
+    def receive(self, data, now):
+        """
+        Feeds bytes that the host sent at time 'now' through the link and the UART RX FIFO
+        """
+        t_arrive = now + self.rtt/2
+        for c in data:
+            # Byte is serialized onto the UART
+            t_rx = max(t_arrive, self.uart_rx_free) + self.byte_time
+            self.uart_rx_free = t_rx
+            
+            # Drop the bytes that the CLI has consumed by the time this one lands in the FIFO
+            while((len(self.fifo) != 0) and (self.fifo[0] <= t_rx)):
+                self.fifo.popleft()
+            if(len(self.fifo) >= self.rx_buf_size):
+                self.overflows += 1
+                self.log.debug("emulator: RX FIFO overflow. Dropped 0x%02X" % c)
+                continue
+            
+            # CLI picks it up once it is done with the previous command
+            t_consume = max(t_rx, self.cli_free)
+            self.fifo.append(t_consume)
+            self.cli_free = t_consume
+            self.cli_char(c, t_consume)
+    
+    #-----------------------------------------------------------------------------------------------
+    def output(self, data, t):
+        """
+        Schedules bytes that the firmware outputs at time t
+        """
+        t_start = max(t, self.uart_tx_free)
+        self.uart_tx_free = t_start + len(data) * self.byte_time
+        heapq.heappush(self.tx_queue, (self.uart_tx_free + self.rtt/2, self.tx_seq, data))
+        self.tx_seq += 1
+    
+    #-----------------------------------------------------------------------------------------------
+    # CLI
+    #-----------------------------------------------------------------------------------------------
+    def cli_char(self, c, t):
+        if(self.echo):
+            self.output(bytes([c]), t)
+        
+        if(c == ord('\r')):
+            line = self.line.decode("ascii", errors="replace")
+            self.line = bytearray()
+            resp, duration = self.execute(line)
+            self.cli_free = t + duration
+            self.output(resp.encode("ascii") + b"\r\n>", self.cli_free)
+        elif(c == ord('\n')):
+            pass
+        elif(c == 0x08):
+            # Backspace
+            del self.line[-1:]
+        else:
+            if(self.bootloader):
+                strbuf_size = BL_STRBUF_SIZE
+            else:
+                strbuf_size = APP_STRBUF_SIZE
+            if(len(self.line) < strbuf_size - 1):
+                self.line.append(c)
+    
+    #-----------------------------------------------------------------------------------------------
+    def execute(self, line):
+        """
+        Runs a command line.
+        Returns a tuple: (response text, seconds the CLI stays busy)
+        """
+        argv = line.split()
+        if(len(argv) == 0):
+            return(("", 0))
+        
+        self.cmd_log.append(line)
+        if(self.bootloader):
+            handler = getattr(self, "bl_" + argv[0], None)
+            max_argc = BL_MAX_ARGC
+        else:
+            handler = getattr(self, "app_" + argv[0], None)
+            max_argc = APP_MAX_ARGC
+        
+        self.duration = self.exec_time.get(argv[0], 0)
+        if((handler == None) or (argv[0] in self.disabled_commands) or (len(argv) > max_argc)):
+            return(("ERR", self.duration))
+        
+        try:
+            resp = handler(argv)
+        except (_CmdFail, ValueError, ihex_file.IHexError, binascii.Error):
+            return(("ERR", self.duration))
+        return((resp, self.duration))
+    
+    #-----------------------------------------------------------------------------------------------
+    def check_argc(self, argv, argc):
+        if(len(argv) != argc):
+            raise _CmdFail()
+    
+    #-----------------------------------------------------------------------------------------------
+    def get_calendar(self):
+        if(self.time_set == None):
+            return(None)
+        elapsed = time.time() - self.time_set_at
+        return(self.time_set + datetime.timedelta(seconds=int(elapsed)))
+    
+    #-----------------------------------------------------------------------------------------------
+    def format_time(self, T):
+        if(T == None):
+            return("00 0000 00 00 00 00 00")
+        return("%02X %04X %02X %02X %02X %02X %02X" % (
+            T.weekday(), T.year, T.month, T.day, T.hour, T.minute, T.second
+        ))
+    
+    #-----------------------------------------------------------------------------------------------
+    # Application commands
+    #-----------------------------------------------------------------------------------------------
+    def app_id(self, argv):
+        return("APP")
+    
+    def app_echo(self, argv):
+        self.check_argc(argv, 2)
+        if(argv[1][0] == '1'):
+            self.echo = True
+        elif(argv[1][0] == '0'):
+            self.echo = False
+        else:
+            raise _CmdFail()
+        return("")
+    
+    def app_reset(self, argv):
+        # A software reset stays in the bootloader
+        self.reset_state(True)
+        return("")
+    
+    def app_rgbw(self, argv):
+        self.check_argc(argv, 5)
+        self.rgbw = tuple([int(x, 16) & 0xFFFF for x in argv[1:5]])
+        return("")
+    
+    def app_get_time(self, argv):
+        return(self.format_time(self.get_calendar()))
+    
+    def app_get_ref_time(self, argv):
+        return(self.format_time(self.ref_time))
+    
+    def app_get_ttl_clk_correct(self, argv):
+        return("%08X" % 0)
+    
+    def app_status(self, argv):
+        header = struct.unpack("<Ii", self.eeprom[0:8])
+        return("\r\n".join([
+            self.app_get_time(argv),
+            self.app_get_ref_time(argv),
+            self.app_get_ttl_clk_correct(argv),
+            "%08X %08X %08X" % (header[0], header[1] & 0xFFFFFFFF, self.build_timestamp)
+        ]))
+    
+    def app_set_time(self, argv):
+        self.check_argc(argv, 7)
+        T = datetime.datetime(*[int(x, 16) for x in argv[1:7]])
+        self.time_set = T
+        self.time_set_at = time.time()
+        self.ref_time = T
+        return("")
+    
+    def app_set_dst(self, argv):
+        self.check_argc(argv, 3)
+        self.dst = (int(argv[1], 16), int(argv[2], 16))
+        return("")
+    
+    def app_cfg_erase(self, argv):
+        self.cfg_loaded = False
+        self.eeprom[:] = b"\xFF" * EEPROM_SIZE
+        return("")
+    
+    def app_cfg_write(self, argv):
+        self.check_argc(argv, 3)
+        page = int(argv[1], 16)
+        if(page >= EEPROM_SIZE // EE_PAGE_SIZE):
+            raise _CmdFail()
+        if(len(argv[2]) != EE_PAGE_SIZE * 2):
+            raise _CmdFail()
+        data = bytearray(binascii.unhexlify(argv[2]))
+        if(page == 0):
+            # Page 0 is the header. First 4 bytes are replaced with the build timestamp
+            data[0:4] = struct.pack("<I", self.build_timestamp)
+        self.eeprom[page*EE_PAGE_SIZE:(page+1)*EE_PAGE_SIZE] = data
+        return("")
+    
+    def app_cfg_read(self, argv):
+        self.check_argc(argv, 2)
+        page = int(argv[1], 16)
+        if(page >= EEPROM_SIZE // EE_PAGE_SIZE):
+            raise _CmdFail()
+        data = self.eeprom[page*EE_PAGE_SIZE:(page+1)*EE_PAGE_SIZE]
+        return(binascii.hexlify(data).decode("ascii").upper())
+    
+    def app_cfg_write64(self, argv):
+        self.check_argc(argv, 3)
+        page = int(argv[1], 16)
+        if(page >= EEPROM_SIZE // EE_PAGE_SIZE):
+            raise _CmdFail()
+        if(len(argv[2]) != (EE_PAGE_SIZE + 1) // 3 * 4):
+            raise _CmdFail()
+        try:
+            data = btLink.decode_page64(argv[2])
+        except btLink.CMDError:
+            raise _CmdFail()
+        argv = argv[0:2] + [binascii.hexlify(data).decode("ascii")]
+        return(self.app_cfg_write(argv))
+    
+    def app_cfg_read64(self, argv):
+        data = binascii.unhexlify(self.app_cfg_read(argv))
+        return(btLink.encode_page64(data))
+    
+    def app_cfg_unload(self, argv):
+        self.cfg_loaded = False
+        return("")
+    
+    def app_cfg_reload(self, argv):
+        self.cfg_loaded = (struct.unpack("<I", self.eeprom[0:4])[0] == self.build_timestamp)
+        return("")
+    
+    def app_chroma(self, argv):
+        self.check_argc(argv, 2)
+        T_i = int(argv[1], 16)
+        if(T_i > 5):
+            raise _CmdFail()
+        
+        # Integration time doubles with each step, starting at 40 ms
+        self.duration += 0.040 * (2**T_i)
+        
+        # Synthesize a reading from the LED output. White light shows up on every channel
+        r, g, b, w = self.rgbw
+        sample = []
+        for level in (r + w//2, g + w//2, b + w//2, r + g + b + w):
+            sample.append(min(0xFFFF, (level * (2**T_i)) // 32))
+        return("%04X %04X %04X %04X " % tuple(sample))
+    
+    #-----------------------------------------------------------------------------------------------
+    # Bootloader commands
+    #-----------------------------------------------------------------------------------------------
+    def bl_id(self, argv):
+        return("BL")
+    
+    def bl_boot(self, argv):
+        if(self.flash[0:2] == b"\xFF\xFF"):
+            # No application to boot
+            raise _CmdFail()
+        self.reset_state(False)
+        self.cfg_loaded = (struct.unpack("<I", self.eeprom[0:4])[0] == self.build_timestamp)
+        return("")
+    
+    def bl_reset(self, argv):
+        self.reset_state(True)
+        return("")
+    
+    def bl_led(self, argv):
+        self.check_argc(argv, 2)
+        if(argv[1][0] == '1'):
+            self.led = True
+        elif(argv[1][0] == '0'):
+            self.led = False
+        else:
+            raise _CmdFail()
+        return("")
+    
+    def bl_ihex(self, argv):
+        self.check_argc(argv, 2)
+        record = ihex_file.Record.from_string(argv[1])
+        page_size = ihex_file.FLASH_PAGE_SIZE
+        
+        if(record.rtype == ihex_file.DATA):
+            addr = record.addr
+            if(addr == 0):
+                # About to write the first page. It is erased, and held back until EOF
+                self.first_page_buffer[:] = b"\xFF" * page_size
+                self.flash[0:page_size] = b"\xFF" * page_size
+                self.duration += self.exec_time["flash_page_write"]
+            
+            if(addr < page_size):
+                self.first_page_buffer[addr:addr+len(record.data)] = record.data
+                self.first_page_dirty = True
+            else:
+                page = addr // page_size
+                if(page != self.open_flash_page):
+                    # Previous page is committed
+                    self.open_flash_page = page
+                    self.duration += self.exec_time["flash_page_write"]
+                self.flash[addr:addr+len(record.data)] = record.data
+        
+        elif(record.rtype == ihex_file.EOF):
+            if(self.first_page_dirty):
+                self.flash[0:page_size] = self.first_page_buffer
+                self.first_page_dirty = False
+                self.duration += self.exec_time["flash_page_write"]
+            self.open_flash_page = None
+        return("")
@@ -8,15 +8,19 @@ from . import colors
 from . import btLink
 from . import gui_btLink
 from . import settings
+from .color_stream import ColorStream
 
 #---------------------------------------------------------------------------------------------------
 class EditColor(tkext.Dialog):
     def __init__(self, parent, C):
         self.C = C
+        self.stream = None
         
         # Start the dialog. This blocks until done.
         tkext.Dialog.__init__(self, parent = parent, title = "Edit Color")
         
+        self.stop_stream()
+        
     #---------------------------------------------------------------
     def create_buttonbox(self, master_fr):
         tkext.Dialog.create_buttonbox(self, master_fr)
@@ -27,6 +31,14 @@ class EditColor(tkext.Dialog):
             command=self.pb_Test
         ).pack(side=tk.LEFT)
         
+        self.live_var = tk.BooleanVar(self.tkWindow)
+        ttk.Checkbutton(
+            master_fr,
+            text="Live",
+            variable=self.live_var,
+            command=self.cb_Live
+        ).pack(side=tk.LEFT)
+        
     #---------------------------------------------------------------
     def create_body(self, master_fr):
         # Construct the contents of the dialog
@@ -112,17 +124,50 @@ class EditColor(tkext.Dialog):
         master_fr.columnconfigure(tk.ALL, pad=5)
         master_fr.rowconfigure(tk.ALL, pad=5)
         
+        # Push slider motion to the live preview
+        for var in (self.R_var, self.G_var, self.B_var, self.W_var):
+            var.trace("w", lambda *args: self.update_stream())
+        
     #---------------------------------------------------------------
-    def pb_Test(self, event=None):
-        C = colors.Color_raw(
+    def get_color(self):
+        return(colors.Color_raw(
             int(self.R_var.get()),
             int(self.G_var.get()),
             int(self.B_var.get()),
             int(self.W_var.get())
-        )
+        ))
         
-        if(gui_btLink.check_bt_connected()):
-            settings.BT_LINK.set_rgbw(C)
+    #---------------------------------------------------------------
+    def pb_Test(self, event=None):
+        C = self.get_color()
+        
+        lease = gui_btLink.lease_link()
+        if(lease):
+            with lease as link:
+                link.set_rgbw(C)
+    
+    #---------------------------------------------------------------
+    def cb_Live(self):
+        if(self.live_var.get()):
+            if(not gui_btLink.check_bt_connected()):
+                self.live_var.set(False)
+                return
+            self.stream = ColorStream(settings.LINK_MGR, settings.S_DATA.bt_addr)
+            self.stream.start()
+            self.update_stream()
+        else:
+            self.stop_stream()
+    
+    #---------------------------------------------------------------
+    def update_stream(self):
+        if(self.stream != None):
+            self.stream.set_color(self.get_color())
+    
+    #---------------------------------------------------------------
+    def stop_stream(self):
+        if(self.stream != None):
+            self.stream.close()
+            self.stream = None
     
     #---------------------------------------------------------------
     # Standard Action hooks
@@ -145,10 +190,5 @@ class EditColor(tkext.Dialog):
         return(True)
     
     def dlg_apply(self):
-        self.C = colors.Color_raw(
-            int(self.R_var.get()),
-            int(self.G_var.get()),
-            int(self.B_var.get()),
-            int(self.W_var.get())
-        )
+        self.C = self.get_color()
         
\ No newline at end of file
@@ -1,17 +1,64 @@
 
+import queue
+import threading
 import tkinter as tk
 from tkinter import ttk
 from ..python_modules import tk_extensions as tkext
+from . import btLink
 from . import settings
 
+# Max number of lines kept in the console. Older lines are discarded
+MAX_SCROLLBACK_LINES = 2000
+
+# Interval in ms at which received text is moved into the console
+FLUSH_INTERVAL = 20
+
+# Socket timeout of the reader thread. Bounds how long it takes to stop
+READER_TIMEOUT = 0.1
+
+#---------------------------------------------------------------------------------------------------
+class TerminalReader(threading.Thread):
+    """
+    Receives from the link and passes the text on through a queue.
+    Tk widgets can only be touched from the Tk thread, which empties the queue.
+    """
+    def __init__(self, sock, rx_queue):
+        threading.Thread.__init__(self, daemon=True)
+        self.S = sock
+        self.rx_queue = rx_queue
+        self.stopping = threading.Event()
+    
+    def run(self):
+        while(not self.stopping.is_set()):
+            try:
+                data = self.S.recv(btLink.RX_CHUNK_SIZE)
+            except OSError as e:
+                if(btLink.is_timeout(e)):
+                    continue
+                self.rx_queue.put("\n[Link error: %s]\n" % e)
+                return
+            if(len(data) == 0):
+                self.rx_queue.put("\n[Link closed]\n")
+                return
+            self.rx_queue.put(data.decode("ascii", "replace"))
+    
+    def stop(self):
+        self.stopping.set()
+        self.join()
+
 #---------------------------------------------------------------------------------------------------
 class Terminal(tkext.Dialog):
     def __init__(self, parent, btlink):
         self.btlink = btlink
+        self.rx_queue = queue.Queue()
+        self.reader = None
         
         # Start the dialog. This blocks until done.
         tkext.Dialog.__init__(self, parent = parent, title = "Terminal")
         
+        if(self.reader != None):
+            self.reader.stop()
+        
         # Reinitialize normal link before exiting
         self.btlink.initialize_link()
         
@@ -38,9 +85,17 @@ class Terminal(tkext.Dialog):
         self.tkWindow.bind("<Key>", self.keypress)
         
         self.btlink.cmd("echo 1\r\n")
-        self.btlink.S.setblocking(False)
         
-        self.timer = tkext.Timer(self.tkWindow, 100, self.get_input)
+        # Anything the link already received belongs to the console
+        if(len(self.btlink.rx_buf)):
+            self.rx_queue.put(self.btlink.rx_buf.decode("ascii", "replace"))
+            self.btlink.rx_buf.clear()
+        
+        self.btlink.S.settimeout(READER_TIMEOUT)
+        self.reader = TerminalReader(self.btlink.S, self.rx_queue)
+        self.reader.start()
+        
+        self.timer = tkext.Timer(self.tkWindow, FLUSH_INTERVAL, self.flush_output)
         self.timer.start()
         
     def keypress(self, event):
@@ -48,22 +103,44 @@ class Terminal(tkext.Dialog):
             return
         
         c = event.char.encode("ascii")
-        self.btlink.S.send(c)
-        
-    def get_input(self):
-        try:
-            rxd = self.btlink.S.recv(1024).decode("ascii")
-        except:
+        self.btlink.S.sendall(c)
+    
+    def flush_output(self):
+        # Collect everything received since the last flush
+        chunks = []
+        while(True):
+            try:
+                chunks.append(self.rx_queue.get_nowait())
+            except queue.Empty:
+                break
+        if(len(chunks) == 0):
             return
+        text = "".join(chunks).replace("\r", "")
+        
+        # Apply backspaces to the batch. Any that reach past its start erase console text
+        n_erase = 0
+        out = ""
+        for i, part in enumerate(text.split("\b")):
+            if(i != 0):
+                if(len(out)):
+                    out = out[:-1]
+                else:
+                    n_erase += 1
+            out += part
+        
+        # Only follow the output if the view is already at the bottom
+        at_bottom = (self.txt_console.yview()[1] == 1.0)
         
         self.txt_console.configure(state=tk.NORMAL)
-        for c in rxd:
-            if(c == '\r'):
-                pass
-            elif(c == '\b'):
-                # backspace
-                self.txt_console.delete("end-2c", tk.END)
-            else:
-                self.txt_console.insert(tk.END, c)
-        self.txt_console.yview_moveto(1.0)
-        self.txt_console.configure(state=tk.DISABLED)
\ No newline at end of file
+        if(n_erase):
+            self.txt_console.delete("end-%dc" % (n_erase + 1), tk.END)
+        self.txt_console.insert(tk.END, out)
+        
+        # Trim scrollback
+        n_lines = int(self.txt_console.index("end-1c").split(".")[0])
+        if(n_lines > MAX_SCROLLBACK_LINES):
+            self.txt_console.delete("1.0", "%d.0" % (n_lines - MAX_SCROLLBACK_LINES + 1))
+        
+        if(at_bottom):
+            self.txt_console.yview_moveto(1.0)
+        self.txt_console.configure(state=tk.DISABLED)
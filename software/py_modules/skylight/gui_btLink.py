@@ -1,12 +1,19 @@
 
 import time
+import logging
+import threading
 import tkinter as tk
 from tkinter import ttk
 from tkinter import messagebox
 
 from ..python_modules import tk_extensions as tkext
 from . import btLink
+from . import discovery
 from . import settings
+from .link_manager import LinkBusy
+
+# Seconds that the Tk thread waits for a link that a job is still using
+LEASE_TIMEOUT = 0.5
 
 #---------------------------------------------------------------------------------------------------
 def check_bt_addr():
@@ -29,8 +36,10 @@ def check_bt_addr():
         def inquiry_job(dlg_if):
             dlg_if.set_status1("Searching for devices...")
             dlg_if.set_progress(50)
-            devs = btLink.discover()
-            return(devs)
+            # Only one device is needed. Stop at the first one found
+            for dev in discovery.discover():
+                return([dev])
+            return([])
         
         job = tkext.ProgressBox(
             job_func = inquiry_job,
@@ -57,7 +66,7 @@ def check_bt_addr():
     
 #---------------------------------------------------------------------------------------------------
 def check_bt_connected():
-    if((settings.BT_LINK == None) or (settings.BT_LINK.connected == False)):
+    if(not settings.LINK_MGR.is_connected(settings.S_DATA.bt_addr)):
         messagebox.showerror(
             title="Not Connected",
             message="Not Connected"
@@ -65,4 +74,148 @@ def check_bt_connected():
         return(False)
     else:
         return(True)
-    
\ No newline at end of file
+
+#---------------------------------------------------------------------------------------------------
+def show_link_busy():
+    messagebox.showerror(
+        title = "Link Busy",
+        message = "The link to %s is still busy with another operation.\nTry again in a moment." % settings.S_DATA.bt_addr
+    )
+
+#---------------------------------------------------------------------------------------------------
+def lease_link():
+    """
+    Gets a lease on the link to the connected device. Meant to be called on the Tk thread.
+    Returns None if not connected, if the link could not be re-established, or if a job
+    (for example one that was cancelled but has not stopped yet) is still using it.
+    """
+    if(not check_bt_connected()):
+        return(None)
+    
+    try:
+        return(settings.LINK_MGR.lease(settings.S_DATA.bt_addr, timeout = LEASE_TIMEOUT))
+    except LinkBusy:
+        show_link_busy()
+        return(None)
+    except OSError as e:
+        messagebox.showerror(
+            title = "Connection Lost",
+            message = "Could not reconnect to %s:\n%s" % (settings.S_DATA.bt_addr, e)
+        )
+        return(None)
+
+#---------------------------------------------------------------------------------------------------
+class Job:
+    """
+    Handle passed to a job that runs on a worker thread behind a progress box.
+    See run_job()
+    """
+    def __init__(self, title, job_func):
+        self.title = title
+        self.job_func = job_func
+        self.dlg_if = None
+        self.t_start = None
+        
+        # Set when the progress box is closed before the job finished
+        self.cancel_event = threading.Event()
+        
+        # Outcome
+        self.completed = False
+        self.result = None
+        self.error = None
+    
+    #-----------------------------------------------------------------------------------------------
+    def set_status(self, text):
+        self.dlg_if.set_status1(text)
+    
+    #-----------------------------------------------------------------------------------------------
+    def progress(self, n_done, n_total, what = "Step"):
+        """
+        Updates the progress bar and shows an estimate of the remaining time
+        """
+        if(n_total == 0):
+            return
+        self.dlg_if.set_progress(100 * n_done / n_total)
+        
+        text = "%s %d of %d" % (what, n_done, n_total)
+        elapsed = time.time() - self.t_start
+        if(n_done and (n_done < n_total)):
+            text += ". About %d s left" % (elapsed * (n_total - n_done) / n_done + 0.5)
+        self.dlg_if.set_status1(text)
+    
+    #-----------------------------------------------------------------------------------------------
+    def cancelled(self):
+        return(self.cancel_event.is_set())
+    
+    #-----------------------------------------------------------------------------------------------
+    def run(self, dlg_if):
+        # Called on the worker thread
+        self.dlg_if = dlg_if
+        self.t_start = time.time()
+        try:
+            self.result = self.job_func(self)
+        except btLink.Cancelled:
+            pass
+        except Exception as e:
+            # Reported once control is back on the Tk thread
+            self.error = e
+        else:
+            self.completed = not self.cancelled()
+        return(True)
+
+#---------------------------------------------------------------------------------------------------
+def run_job(title, job_func):
+    """
+    Runs job_func(job) on a worker thread while a progress box keeps the GUI responsive.
+    job_func reports progress through the Job it is passed. It must not touch any Tk widgets.
+    
+    If the progress box is closed before the job finishes, the job is cancelled. Device
+    operations stop at the next command boundary. Long-running jobs that do not talk to the
+    device should poll job.cancelled().
+    Until then the worker keeps its lease, so code on the Tk thread must take leases through
+    lease_link(), which gives up rather than blocking the GUI.
+    
+    Errors raised by job_func are shown in a message box.
+    Returns the Job. job.completed is True and job.result holds job_func's return value
+    if the job ran to completion.
+    """
+    job = Job(title, job_func)
+    
+    box = tkext.ProgressBox(
+        job_func = job.run,
+        parent = None,
+        title = title
+    )
+    
+    if(box.job_retval == None):
+        # Closed early. The worker stops by itself
+        job.cancel_event.set()
+        logging.getLogger("skylight").info("%s: Cancelled" % title)
+    
+    if(job.error != None):
+        messagebox.showerror(
+            title = "Error!",
+            message = "%s failed:\n%s" % (title, job.error)
+        )
+    
+    return(job)
+
+#---------------------------------------------------------------------------------------------------
+def run_link_job(title, job_func):
+    """
+    Same as run_job(), but job_func(link, job) is called with a lease on the connected device.
+    Cancelling the job cancels the link's commands.
+    Returns None if not connected. Otherwise returns the Job.
+    """
+    if(not check_bt_connected()):
+        return(None)
+    
+    def link_job(job):
+        with settings.LINK_MGR.lease(settings.S_DATA.bt_addr) as link:
+            link.cancel_event = job.cancel_event
+            try:
+                return(job_func(link, job))
+            finally:
+                link.cancel_event = None
+    
+    return(run_job(title, link_job))
@@ -0,0 +1,149 @@
+import binascii
+
+#===================================================================================================
+# Bootloader Constants
+#===================================================================================================
+
+# Flash page size of the atxmega128d4 (APP_SECTION_PAGE_SIZE).
+# The bootloader holds back the first page in a RAM buffer, so no record may cross a page boundary.
+FLASH_PAGE_SIZE = 512
+
+# Largest data payload per record.
+# The bootloader's CLI line buffer (CLI_STRBUF_SIZE) is 64 characters including the terminator.
+# "ihex :LLAAAATT" + data + "CC" leaves room for 23 data bytes. Keep it even so records stay
+# word-aligned for the flash page buffer.
+MAX_DATA_LEN = 22
+
+# Record types
+DATA = 0x00
+EOF = 0x01
+EXT_SEGMENT_ADDR = 0x02
+EXT_LINEAR_ADDR = 0x04
+
+class IHexError(Exception):
+    pass
+
+#===================================================================================================
+class Record:
+    def __init__(self, rtype, addr, data):
+        self.rtype = rtype
+        self.addr = addr
+        self.data = bytes(data)
+    
+    #-----------------------------------------------
+    @classmethod
+    def from_string(cls, line):
+        """
+        Parses and validates a single ":LLAAAATT...CC" record
+        """
+        if((len(line) < 11) or (line[0] != ':')):
+            raise IHexError("Malformed record: %s" % line)
+        
+        try:
+            b = binascii.unhexlify(line[1:])
+        except binascii.Error:
+            raise IHexError("Malformed record: %s" % line)
+        
+        if(len(b) != b[0] + 5):
+            raise IHexError("Record length mismatch: %s" % line)
+        
+        if((sum(b) & 0xFF) != 0):
+            raise IHexError("Record checksum mismatch: %s" % line)
+        
+        return(cls(b[3], (b[1] << 8) | b[2], b[4:-1]))
+    
+    #-----------------------------------------------
+    def to_string(self):
+        b = bytes([len(self.data), self.addr >> 8, self.addr & 0xFF, self.rtype]) + self.data
+        checksum = (-sum(b)) & 0xFF
+        return(":%s%02X" % (binascii.hexlify(b).decode('ascii').upper(), checksum))
+
+#---------------------------------------------------------------------------------------------------
+def read_file(filename):
+    """
+    Reads an Intel-Hex file into a list of Record objects.
+    Every record is validated up front so that a corrupt file is rejected before any of it is
+    sent to a device.
+    """
+    records = []
+    with open(filename, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if(len(line) != 0):
+                records.append(Record.from_string(line))
+    return(records)
+
+#---------------------------------------------------------------------------------------------------
+def coalesce(records, max_data_len = MAX_DATA_LEN, page_size = FLASH_PAGE_SIZE):
+    """
+    Merges runs of contiguous data records into as few records as possible.
+    Records never exceed max_data_len bytes or cross a page boundary.
+    Any other record type is passed through unchanged and ends the current run.
+    Returns a new list of Record objects.
+    """
+    out = []
+    cur = None
+    for r in records:
+        if(r.rtype != DATA):
+            cur = None
+            out.append(r)
+            continue
+        
+        addr = r.addr
+        data = r.data
+        while(len(data) != 0):
+            room = page_size - (addr % page_size)
+            if((cur != None) and (cur.addr + len(cur.data) == addr) and ((addr % page_size) != 0)):
+                # Extend the current record
+                n = min(len(data), max_data_len - len(cur.data), room)
+            else:
+                n = 0
+            
+            if(n == 0):
+                # Start a new record
+                cur = Record(DATA, addr, b"")
+                out.append(cur)
+                n = min(len(data), max_data_len, room)
+            
+            cur.data += data[:n]
+            addr += n
+            data = data[n:]
+    
+    return(out)
+
+#---------------------------------------------------------------------------------------------------
+def resume(records, n_acked, page_size = FLASH_PAGE_SIZE):
+    """
+    Determines what to send in order to resume an upload that was interrupted after the
+    first n_acked records were acknowledged.
+    
+    The bootloader programs flash a page at a time, so resending part of a page could
+    commit it with data missing. The upload is therefore resumed from the first record of
+    the page that the first unacknowledged record belongs to. If an extended address record
+    precedes that point, it is resent first so the bootloader's address offset is correct.
+    
+    The first page only lives in the bootloader's RAM until the EOF record commits it, and
+    is lost if the device was reset in the meantime. Its records are always resent.
+    
+    Returns a tuple: (index of the first record resent from the list, list of records to send)
+    """
+    if(n_acked >= len(records)):
+        return((len(records), []))
+    
+    i = n_acked
+    if(records[i].rtype == DATA):
+        page = records[i].addr // page_size
+        while((i > 0) and (records[i-1].rtype == DATA) and (records[i-1].addr // page_size == page)):
+            i -= 1
+    
+    prefix = []
+    for r in records[:i]:
+        if((r.rtype == DATA) and (r.addr < page_size)):
+            prefix.append(r)
+    
+    for r in reversed(records[:i]):
+        if(r.rtype in (EXT_SEGMENT_ADDR, EXT_LINEAR_ADDR)):
+            prefix.append(r)
+            break
+    
+    return((i, prefix + records[i:]))
@@ -0,0 +1,212 @@
+import time
+import logging
+import threading
+
+from . import btLink
+
+#---------------------------------------------------------------------------------------------------
+class LinkBusy(Exception):
+    """
+    Raised by LinkManager.lease() if another thread kept its lease for longer than the timeout
+    """
+    pass
+
+#---------------------------------------------------------------------------------------------------
+class Lease:
+    """
+    Exclusive use of a managed link.
+    Obtained from LinkManager.lease(). Must be released when done, either by calling release()
+    or by using it as a context manager. The link stays open after it is released.
+    """
+    def __init__(self, manager, entry):
+        self.manager = manager
+        self.entry = entry
+        self.link = entry.link
+    
+    #-----------------------------------------------------------------------------------------------
+    def __enter__(self):
+        return(self.link)
+    
+    #-----------------------------------------------------------------------------------------------
+    def __exit__(self, type, value, traceback):
+        if(isinstance(value, OSError)):
+            # The link is in an unknown state. Drop it so the next lease reconnects
+            self.manager.drop_link(self.entry)
+        self.release()
+    
+    #-----------------------------------------------------------------------------------------------
+    def release(self):
+        if(self.entry != None):
+            self.entry.last_used = time.time()
+            self.entry.lock.release()
+            self.entry = None
+
+#---------------------------------------------------------------------------------------------------
+class _LinkEntry:
+    def __init__(self, addr):
+        self.addr = addr
+        self.link = None
+        self.last_used = 0
+        
+        # Held by whoever has a lease on the link.
+        # Reentrant so that a lease holder can take nested leases on the same device.
+        self.lock = threading.RLock()
+
+#---------------------------------------------------------------------------------------------------
+class LinkManager:
+    """
+    Keeps links to several devices open so that the GUI, the terminal and scripted jobs can
+    share them rather than paying the RFCOMM connect cost each time.
+    
+    Links are handed out as leases. Before a link is reused, it is checked with an 'id'
+    command. A link that fails the check, or that dropped while it was leased, is reconnected
+    transparently with exponential backoff.
+    """
+    def __init__(self, timeout = 10, retries = 3, max_backoff = 30, probe_after = 2,
+                 link_factory = btLink.btLink):
+        """
+        timeout: Socket timeout in seconds, passed to each link
+        retries: Number of times to retry a failed connect before giving up
+        max_backoff: Upper limit of the delay between connect attempts in seconds
+        probe_after: A link that was idle for longer than this many seconds is checked
+            before it is reused
+        link_factory: Callable that creates a link object for an address
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.max_backoff = max_backoff
+        self.probe_after = probe_after
+        self.link_factory = link_factory
+        self.log = logging.getLogger("skylight")
+        
+        self.entries = {}
+        self.entries_lock = threading.Lock()
+    
+    #-----------------------------------------------------------------------------------------------
+    def get_entry(self, addr):
+        with self.entries_lock:
+            if(addr not in self.entries):
+                self.entries[addr] = _LinkEntry(addr)
+            return(self.entries[addr])
+    
+    #-----------------------------------------------------------------------------------------------
+    def is_connected(self, addr):
+        entry = self.entries.get(addr)
+        return((entry != None) and (entry.link != None) and entry.link.connected)
+    
+    #-----------------------------------------------------------------------------------------------
+    def connect(self, addr):
+        """
+        Opens a link to addr if there isn't one already
+        """
+        self.lease(addr).release()
+    
+    #-----------------------------------------------------------------------------------------------
+    def disconnect(self, addr, timeout = None):
+        """
+        Closes the link to addr. Waits until any lease on it is released.
+        If timeout is given, waits at most that many seconds for it, then raises LinkBusy.
+        """
+        entry = self.entries.get(addr)
+        if(entry == None):
+            return
+        
+        if(timeout == None):
+            entry.lock.acquire()
+        elif(not entry.lock.acquire(timeout=timeout)):
+            raise LinkBusy("%s: Link is in use" % addr)
+        try:
+            self.drop_link(entry)
+        finally:
+            entry.lock.release()
+        
+        with self.entries_lock:
+            del self.entries[addr]
+    
+    #-----------------------------------------------------------------------------------------------
+    def close_all(self):
+        for addr in list(self.entries.keys()):
+            self.disconnect(addr)
+    
+    #-----------------------------------------------------------------------------------------------
+    def lease(self, addr, timeout = None):
+        """
+        Returns a Lease on a working link to addr. Blocks while another thread holds a lease on it.
+        If timeout is given, waits at most that many seconds for it, then raises LinkBusy.
+        Connects or reconnects as needed.
+        If the device can not be reached, raises the OSError of the last connect attempt.
+        """
+        entry = self.get_entry(addr)
+        if(timeout == None):
+            entry.lock.acquire()
+        elif(not entry.lock.acquire(timeout=timeout)):
+            raise LinkBusy("%s: Link is in use" % addr)
+        try:
+            if((entry.link != None) and (time.time() - entry.last_used > self.probe_after)):
+                if(not self.probe(entry.link)):
+                    self.log.info("%s: Link is stale. Reconnecting" % addr)
+                    self.drop_link(entry)
+            
+            if(entry.link == None):
+                entry.link = self.open_link(addr)
+        except:
+            entry.lock.release()
+            raise
+        
+        return(Lease(self, entry))
+    
+    #-----------------------------------------------------------------------------------------------
+    def probe(self, link):
+        """
+        Checks that the device still responds.
+        Also updates the link's view of which firmware is running
+        """
+        try:
+            resp = link.cmd("id\r\n")
+        except (OSError, btLink.CMDError):
+            return(False)
+        
+        if(resp == "BL"):
+            link.rx_buf_size = btLink.BL_RX_BUF_SIZE
+        elif(resp == "APP"):
+            link.rx_buf_size = btLink.APP_RX_BUF_SIZE
+        else:
+            return(False)
+        return(True)
+    
+    #-----------------------------------------------------------------------------------------------
+    def open_link(self, addr):
+        n_attempts = 0
+        while(True):
+            link = self.link_factory(addr, self.timeout)
+            try:
+                link.open()
+            except OSError as e:
+                try:
+                    link.close()
+                except OSError:
+                    pass
+                
+                if(n_attempts >= self.retries):
+                    self.log.error("%s: Connect failed (%s). Giving up." % (addr, e))
+                    raise
+                
+                delay = min(2**n_attempts, self.max_backoff)
+                self.log.warning("%s: Connect failed (%s). Retrying in %d s" % (addr, e, delay))
+                time.sleep(delay)
+                n_attempts += 1
+            else:
+                if(not self.probe(link)):
+                    # Connected to something that is not a skylight controller
+                    link.close()
+                    raise ConnectionError("%s: Device did not identify itself" % addr)
+                return(link)
+    
+    #-----------------------------------------------------------------------------------------------
+    def drop_link(self, entry):
+        if(entry.link != None):
+            try:
+                entry.link.close()
+            except OSError:
+                pass
+            entry.link = None
@@ -0,0 +1,152 @@
+import json
+import bisect
+import threading
+
+# Upper bounds of the latency histogram buckets, in seconds.
+# Spans a fast rgbw round trip through to a page write queued behind a full pipeline.
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+
+#---------------------------------------------------------------------------------------------------
+def cmd_verb(cmd_string):
+    """
+    Returns the command name that statistics are grouped by.
+    Accepts str or bytes
+    """
+    if(type(cmd_string) == bytes):
+        cmd_string = cmd_string.decode("ascii")
+    words = cmd_string.split(None, 1)
+    if(len(words) == 0):
+        # Empty line, as sent to flush out partial commands
+        return("blank")
+    return(words[0])
+
+#---------------------------------------------------------------------------------------------------
+class CommandStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.bytes_tx = 0
+        self.bytes_rx = 0
+        self.latency_sum = 0.0
+        
+        # Number of samples in each bucket. The last one counts anything above LATENCY_BUCKETS[-1]
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+    
+    #-----------------------------------------------------------------------------------------------
+    def mean_latency(self):
+        if(self.count == 0):
+            return(None)
+        return(self.latency_sum / self.count)
+    
+    #-----------------------------------------------------------------------------------------------
+    def to_dict(self):
+        return({
+            "count": self.count,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "bytes_tx": self.bytes_tx,
+            "bytes_rx": self.bytes_rx,
+            "latency_sum": self.latency_sum,
+            "latency_buckets": dict(zip([str(b) for b in LATENCY_BUCKETS] + ["+Inf"], self.buckets))
+        })
+
+#---------------------------------------------------------------------------------------------------
+class LinkMetrics:
+    """
+    Per-command statistics collected by btLink.
+    Pass an instance as btLink's metrics argument to enable collection. One instance can be
+    shared by several links to aggregate them.
+    
+    Latency is measured from when the first byte of a command is sent until its prompt is
+    received. For pipelined commands, this includes the time spent queued behind the
+    commands ahead of it.
+    """
+    def __init__(self):
+        self.stats = {}
+        self.lock = threading.Lock()
+    
+    #-----------------------------------------------------------------------------------------------
+    def get_stats(self, verb):
+        # Caller must hold the lock
+        if(verb not in self.stats):
+            self.stats[verb] = CommandStats()
+        return(self.stats[verb])
+    
+    #-----------------------------------------------------------------------------------------------
+    def record(self, verb, n_tx, n_rx, latency, error = False):
+        with self.lock:
+            s = self.get_stats(verb)
+            s.count += 1
+            s.bytes_tx += n_tx
+            s.bytes_rx += n_rx
+            s.latency_sum += latency
+            s.buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+            if(error):
+                s.errors += 1
+    
+    #-----------------------------------------------------------------------------------------------
+    def record_timeout(self, verb, n_tx):
+        with self.lock:
+            s = self.get_stats(verb)
+            s.timeouts += 1
+            s.bytes_tx += n_tx
+    
+    #-----------------------------------------------------------------------------------------------
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+    
+    #-----------------------------------------------------------------------------------------------
+    def snapshot(self):
+        """
+        Returns a dictionary of per-command statistics, keyed by command name
+        """
+        with self.lock:
+            return({verb: s.to_dict() for verb, s in self.stats.items()})
+    
+    #-----------------------------------------------------------------------------------------------
+    def to_json(self):
+        return(json.dumps(self.snapshot(), indent=2, sort_keys = True))
+    
+    #-----------------------------------------------------------------------------------------------
+    def to_prometheus(self, prefix = "skylight_cmd"):
+        """
+        Returns the statistics in the Prometheus text exposition format
+        """
+        lines = []
+        def add_metric(name, mtype, help_text, samples):
+            lines.append("# HELP %s_%s %s" % (prefix, name, help_text))
+            lines.append("# TYPE %s_%s %s" % (prefix, name, mtype))
+            for labels, value in samples:
+                lines.append("%s_%s{%s} %s" % (prefix, name, labels, repr(value)))
+        
+        with self.lock:
+            verbs = sorted(self.stats.keys())
+            stats = [(v, self.stats[v]) for v in verbs]
+            
+            add_metric("total", "counter", "Commands completed",
+                       [('cmd="%s"' % v, s.count) for v, s in stats])
+            add_metric("errors_total", "counter", "Commands that responded with ERR",
+                       [('cmd="%s"' % v, s.errors) for v, s in stats])
+            add_metric("timeouts_total", "counter", "Commands that timed out",
+                       [('cmd="%s"' % v, s.timeouts) for v, s in stats])
+            add_metric("tx_bytes_total", "counter", "Bytes sent",
+                       [('cmd="%s"' % v, s.bytes_tx) for v, s in stats])
+            add_metric("rx_bytes_total", "counter", "Bytes received",
+                       [('cmd="%s"' % v, s.bytes_rx) for v, s in stats])
+            
+            lines.append("# HELP %s_latency_seconds Command latency" % prefix)
+            lines.append("# TYPE %s_latency_seconds histogram" % prefix)
+            for v, s in stats:
+                cumulative = 0
+                for bound, n in zip(LATENCY_BUCKETS + (float("inf"),), s.buckets):
+                    cumulative += n
+                    le = "+Inf" if(bound == float("inf")) else repr(bound)
+                    lines.append('%s_latency_seconds_bucket{cmd="%s",le="%s"} %d' % (prefix, v, le, cumulative))
+                lines.append('%s_latency_seconds_sum{cmd="%s"} %s' % (prefix, v, repr(s.latency_sum)))
+                lines.append('%s_latency_seconds_count{cmd="%s"} %d' % (prefix, v, s.count))
+        
+        return("\n".join(lines) + "\n")
@@ -40,4 +40,8 @@ class Skylight_Settings(ec.EncodableClass):
 # Handle to Skylight_Settings data object
 S_DATA = None
 
-BT_LINK = None
\ No newline at end of file
+# Handle to LinkManager that owns the Bluetooth links
+LINK_MGR = None
+
+# Handle to ConfigCache of images last uploaded to each device
+CFG_CACHE = None
\ No newline at end of file
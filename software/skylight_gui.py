@@ -22,7 +22,10 @@ from py_modules.skylight.gui_Terminal import Terminal
 from py_modules.skylight.colors import Color_raw
 import py_modules.skylight.settings as settings
 import py_modules.skylight.btLink as btLink
+import py_modules.skylight.eeprom_config as eeprom_config
 import py_modules.skylight.gui_btLink as gui_btLink
+from py_modules.skylight.config_cache import ConfigCache
+from py_modules.skylight.link_manager import LinkManager, LinkBusy
 
 #---------------------------------------------------------------------------------------------------
 class skylight_gui(App):
@@ -39,11 +42,15 @@ class skylight_gui(App):
             # create default settings
             settings.S_DATA = settings.Skylight_Settings()
         
+        settings.CFG_CACHE = ConfigCache()
+        settings.LINK_MGR = LinkManager()
+        
         self.color = Color_raw(0,0,0,0)
         
         # Run GUI
         self.gui_main()
         
+        settings.LINK_MGR.close_all()
         settings.S_DATA.save_json("settings.json")
         
     def gui_main(self):
@@ -148,35 +155,69 @@ class skylight_gui(App):
         )
         
     def pb_send_cfg(self):
-        image = settings.S_DATA.cfg.compile()
-        if(gui_btLink.check_bt_connected()):
-            settings.BT_LINK.set_time()
-            settings.BT_LINK.send_config(image)
-            
+        cfg = settings.S_DATA.cfg
+        try:
+            try:
+                image = cfg.compile()
+            except eeprom_config.ImageSizeError:
+                # Does not fit as is. See if a denser layout does
+                image = cfg.compile(eeprom_config.LAYOUT_SMALLEST)
+                self.log.info(str(cfg.layout_report))
+        except eeprom_config.CompileError as e:
+            messagebox.showerror(
+                title = "Error!",
+                message = str(e)
+            )
+            return
+        
+        def send_cfg_job(link, job):
+            job.set_status("Setting time...")
+            link.set_time()
+            job.set_status("Checking device config...")
+            link.send_config(
+                image,
+                cache = settings.CFG_CACHE,
+                progress = lambda n_done, n_total: job.progress(n_done, n_total, "Page")
+            )
+        
+        gui_btLink.run_link_job("Sending Configuration", send_cfg_job)
+    
     def pb_sync_datetime(self):
-        image = settings.S_DATA.cfg.compile()
-        if(gui_btLink.check_bt_connected()):
-            settings.BT_LINK.set_time()
-            
+        def sync_job(link, job):
+            job.set_status("Setting time...")
+            link.set_time()
+        
+        gui_btLink.run_link_job("Synchronizing Time", sync_job)
+    
     def pb_set_color(self):
         dlg = EditColor(self.fr, self.color)
         if(dlg.result):
             self.color = dlg.C
-            if(gui_btLink.check_bt_connected()):
-                settings.BT_LINK.set_rgbw(self.color)
+            lease = gui_btLink.lease_link()
+            if(lease):
+                with lease as link:
+                    link.set_rgbw(self.color)
 
     def pb_terminal(self):
-        if(gui_btLink.check_bt_connected()):
-            Terminal(self.fr, settings.BT_LINK)
+        lease = gui_btLink.lease_link()
+        if(lease):
+            with lease as link:
+                Terminal(self.fr, link)
             
     def pb_update_clk_correction(self):
-        if(gui_btLink.check_bt_connected()):
-            # Query hardware
-            ref_time = settings.BT_LINK.get_ref_time()
-            corrected_minutes = settings.BT_LINK.get_ttl_clk_correct()
+        def status_job(link, job):
+            job.set_status("Reading device status...")
+            return(link.get_status())
+        
+        # Query hardware
+        job = gui_btLink.run_link_job("Reading Clock", status_job)
+        if(job and job.completed):
+            status = job.result
             
-            actual_time = datetime.datetime.now()
-            hw_time = settings.BT_LINK.get_time()
+            ref_time = status.ref_time
+            corrected_minutes = status.ttl_clk_correct
+            actual_time = status.host_time
+            hw_time = status.time
             
             if(hw_time == None):
                 messagebox.showerror(
@@ -235,25 +276,33 @@ class skylight_gui(App):
             
     def pb_tgl_connect_click(self):
         
-        if((settings.BT_LINK == None) or (settings.BT_LINK.connected == False)):
+        if((settings.S_DATA.bt_addr == None) or (not settings.LINK_MGR.is_connected(settings.S_DATA.bt_addr))):
             # Connect
             
             if(gui_btLink.check_bt_addr()):
+                addr = settings.S_DATA.bt_addr
                 
-                if(settings.BT_LINK == None):
-                    settings.BT_LINK = btLink.btLink(settings.S_DATA.bt_addr)
+                def connect_job(job):
+                    job.set_status("Connecting to %s..." % addr)
+                    settings.LINK_MGR.connect(addr)
+                    if(job.cancelled()):
+                        # Gave up waiting. Don't leave a link open that the GUI doesn't know about
+                        settings.LINK_MGR.disconnect(addr)
                 
-                try:
-                    settings.BT_LINK.open()
-                except:
-                    print("BT connect error")
-                    settings.BT_LINK = None
+                job = gui_btLink.run_job("Connecting", connect_job)
+                if(not job.completed):
+                    if(job.error != None):
+                        self.log.error("BT connect error: %s" % job.error)
                     return
                 
                 self.pb_tgl_connect.configure(text="Disconnect")
         else:
             # Disconnect
-            settings.BT_LINK.close()
+            try:
+                settings.LINK_MGR.disconnect(settings.S_DATA.bt_addr, timeout = gui_btLink.LEASE_TIMEOUT)
+            except LinkBusy:
+                gui_btLink.show_link_busy()
+                return
             
             self.pb_tgl_connect.configure(text="Connect")
     
@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+
+from py_modules.skylight import btLink
+from py_modules.skylight import capture
+from py_modules.skylight.emulator import DeviceEmulator
+
+#---------------------------------------------------------------------------------------------------
+def run_session(S):
+    """
+    Returns the responses of a session that takes a few hundred bytes of traffic
+    """
+    responses = []
+    for i in range(20):
+        responses.append(S.cmd("rgbw %x %x %x %x\r\n" % (i, i, i, i)))
+    responses.append(S.get_time())
+    return(responses)
+
+#---------------------------------------------------------------------------------------------------
+class TestCapture(unittest.TestCase):
+    def record(self, max_bytes):
+        E = DeviceEmulator(baud = None)
+        C = capture.Capture(max_bytes)
+        with btLink.btLink(None, sock=E.connect(), capture=C) as S:
+            responses = run_session(S)
+        E.stop()
+        
+        fd, filename = tempfile.mkstemp(suffix=".cap")
+        os.close(fd)
+        self.addCleanup(os.remove, filename)
+        C.save(filename)
+        return(C, filename, responses)
+    
+    def replay(self, filename):
+        R = capture.ReplaySocket(filename, speed=None)
+        with btLink.btLink(None, sock=R) as S:
+            responses = run_session(S)
+        self.assertEqual(len(R.chunks), 0)
+        return(responses)
+    
+    def test_replay(self):
+        C, filename, responses = self.record(capture.DEFAULT_MAX_BYTES)
+        self.assertFalse(C.trimmed)
+        self.assertEqual(self.replay(filename), responses)
+    
+    def test_replay_wrapped(self):
+        C, filename, responses = self.record(300)
+        self.assertTrue(C.trimmed)
+        
+        chunks = capture.load(filename)
+        self.assertEqual(chunks[0][1], capture.TRIMMED)
+        self.assertEqual(chunks[1][1], capture.TX)
+        self.assertTrue(chunks[1][2].startswith(b"rgbw "))
+        
+        # Commands that were discarded get empty responses. The rest replay as captured
+        replayed = self.replay(filename)
+        n_kept = sum([(chunk[1] == capture.TX) for chunk in chunks])
+        self.assertEqual(replayed[-n_kept:], responses[-n_kept:])
+    
+    def test_trimmed_at_exchanges(self):
+        C = capture.Capture(10)
+        C.record(capture.TX, b"id\r\n")
+        C.record(capture.RX, b"APP\r\n")
+        C.record(capture.RX, b">")
+        C.record(capture.TX, b"get_time\r\n")
+        
+        # The exchange in progress is kept, even though it is over budget
+        self.assertTrue(C.trimmed)
+        self.assertEqual(C.n_bytes, 10)
+        C.record(capture.RX, b"0 0 0>")
+        self.assertEqual(C.n_bytes, 16)
+
+if __name__ == '__main__':
+    unittest.main()
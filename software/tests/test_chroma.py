@@ -0,0 +1,70 @@
+import unittest
+
+from py_modules.skylight import chroma
+from py_modules.skylight import btLink
+
+#---------------------------------------------------------------------------------------------------
+class TestAnalyzeChroma(unittest.TestCase):
+    def test_outlier_rejected(self):
+        samples = [[10, 20, 30, 40]] * 7 + [[900, 20, 30, 40]]
+        stats = chroma.analyze_chroma(samples, chroma.CHROMA_MAX_T_I)
+        self.assertEqual(stats.n_rejected, 1)
+        self.assertEqual(stats.mean, [10, 20, 30, 40])
+    
+    def test_no_majority(self):
+        # Every sample is an outlier in one channel. Rejecting them all would leave nothing
+        samples = [[0, 0, 0, 100], [0, 0, 100, 0], [0, 100, 0, 0], [100, 0, 0, 0]]
+        stats = chroma.analyze_chroma(samples, chroma.CHROMA_MAX_T_I)
+        self.assertEqual(stats.n_rejected, 0)
+        self.assertEqual(stats.mean, [25, 25, 25, 25])
+    
+    def test_normalized_to_max_T_i(self):
+        stats = chroma.analyze_chroma([[1, 2, 3, 4]], chroma.CHROMA_MAX_T_I - 2)
+        self.assertEqual(stats.mean, [4, 8, 12, 16])
+        self.assertEqual(stats.variance, [0, 0, 0, 0])
+
+#---------------------------------------------------------------------------------------------------
+class TestChromaTiSearch(unittest.TestCase):
+    def run_search(self, get_sample):
+        search = btLink.chroma_T_i_search()
+        T_i, delay = next(search)
+        tried = []
+        while(True):
+            tried.append(T_i)
+            try:
+                T_i, delay = search.send(get_sample(T_i))
+            except StopIteration as e:
+                return(tried, e.value)
+    
+    def test_in_range(self):
+        tried, result = self.run_search(lambda T_i: [0x9000, 0, 0, 0])
+        self.assertEqual(tried, [3])
+        self.assertEqual(result, (3, [0x9000, 0, 0, 0]))
+    
+    def test_dim(self):
+        # Brightness doubles with each step of T_i
+        tried, result = self.run_search(lambda T_i: [0x400 << T_i, 0, 0, 0])
+        self.assertEqual(tried, [3, 4, 5])
+        self.assertEqual(result, (5, [0x8000, 0, 0, 0]))
+    
+    def test_out_of_retries(self):
+        # Never settles. The result is the last sample, with the T_i it was taken at
+        tried, result = self.run_search(lambda T_i: [0xFFFF if(T_i % 2) else 0, 0, 0, 0])
+        self.assertEqual(len(tried), 4)
+        self.assertEqual(result, (tried[-1], [0xFFFF if(tried[-1] % 2) else 0, 0, 0, 0]))
+
+#---------------------------------------------------------------------------------------------------
+class TestAverageChroma(unittest.TestCase):
+    def test_same_without_numpy(self):
+        samples = [[1, 2, 3, 4], [3, 4, 5, 6], [0xFFFF, 0, 7, 9]]
+        result = btLink.average_chroma(samples, 3)
+        
+        numpy = chroma.numpy
+        chroma.numpy = None
+        try:
+            self.assertEqual(btLink.average_chroma(samples, 3), result)
+        finally:
+            chroma.numpy = numpy
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+from py_modules.skylight import btLink
+from py_modules.skylight.color_stream import ColorStream
+from py_modules.skylight.emulator import DeviceEmulator
+from py_modules.skylight.link_manager import LinkManager
+
+#---------------------------------------------------------------------------------------------------
+class RawColor:
+    def __init__(self, *rgbw):
+        self.rgbw = rgbw
+    
+    def get_rgbw(self):
+        return(self.rgbw)
+
+#---------------------------------------------------------------------------------------------------
+class TestColorStream(unittest.TestCase):
+    def setUp(self):
+        self.E = DeviceEmulator(baud = None)
+        self.addCleanup(self.E.stop)
+        self.manager = LinkManager(
+            link_factory = lambda addr, timeout: btLink.btLink(addr, timeout, sock=self.E.connect())
+        )
+        self.addCleanup(self.manager.close_all)
+    
+    def test_flush(self):
+        stream = ColorStream(self.manager, "emulator")
+        stream.start()
+        stream.set_color(RawColor(1, 2, 3, 4))
+        stream.close()
+        self.assertFalse(stream.is_alive())
+        self.assertEqual(self.E.rgbw, (1, 2, 3, 4))
+    
+    def test_nothing_sent_after_close(self):
+        lease = self.manager.lease("emulator")
+        stream = ColorStream(self.manager, "emulator")
+        stream.start()
+        stream.set_color(RawColor(1, 2, 3, 4))
+        
+        # The stream is still waiting for the lease when close() gives up on it
+        stream.close(timeout = 0.1)
+        self.assertTrue(stream.is_alive())
+        lease.release()
+        
+        stream.join(1)
+        self.assertFalse(stream.is_alive())
+        self.assertEqual(self.E.rgbw, (0, 0, 0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
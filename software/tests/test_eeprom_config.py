@@ -0,0 +1,81 @@
+import copy
+import random
+import unittest
+
+from py_modules.skylight import eeprom_config as eecfg
+from py_modules.skylight.colors import Color_raw
+
+#---------------------------------------------------------------------------------------------------
+def random_color(rnd):
+    # Few distinct values, so that many objects end up equal
+    return(Color_raw(rnd.choice([0, 0xFFFF]), rnd.choice([0, 0xFFFF]), 0, 0))
+
+def random_transition(rnd, pool):
+    if(pool and (rnd.random() < 0.3)):
+        return(rnd.choice(pool))
+    
+    if(rnd.random() < 0.5):
+        t = eecfg.trans_Immediate()
+    else:
+        t = eecfg.trans_Fade()
+        t.duration = rnd.choice([1.0, 5.0])
+    t.color = random_color(rnd)
+    pool.append(t)
+    return(t)
+
+def random_config(rnd):
+    pool = []
+    cfg = eecfg.eeConfig()
+    cfg.default_modeset.modes = [
+        (random_transition(rnd, pool), random_transition(rnd, pool)) for i in range(rnd.randrange(1, 4))
+    ]
+    for i in range(rnd.randrange(0, 4)):
+        ms = eecfg.ModeSet()
+        ms.modes = [(random_transition(rnd, pool), random_transition(rnd, pool))]
+        alarm = eecfg.AlarmEntry()
+        alarm.dow_list = [i]
+        alarm.data = ms
+        cfg.modeset_change_table.alarms.append(alarm)
+    return(cfg, pool)
+
+def random_edit(rnd, cfg, pool):
+    t = rnd.choice(pool)
+    k = rnd.randrange(5)
+    if(k == 0):
+        t.color = random_color(rnd)
+    elif(k == 1):
+        # Changed in place
+        t.color.r = rnd.choice([0, 0xFFFF])
+    elif(k == 2):
+        t.delay = rnd.choice([0.0, 1.5])
+    elif(k == 3):
+        cfg.default_modeset.modes.append((t, rnd.choice(pool)))
+    elif(len(cfg.default_modeset.modes) > 1):
+        cfg.default_modeset.modes.pop(0)
+
+#---------------------------------------------------------------------------------------------------
+class TestIncrementalCompile(unittest.TestCase):
+    def test_recompile_matches_fresh_compile(self):
+        """
+        After each edit, compiling again gives the same image as compiling a copy of the
+        config that was never compiled before
+        """
+        for seed in range(300):
+            rnd = random.Random(seed)
+            cfg, pool = random_config(rnd)
+            strategy = rnd.choice(list(eecfg.LAYOUT_STRATEGIES) + [eecfg.LAYOUT_SMALLEST])
+            cfg.compile(strategy)
+            for step in range(10):
+                random_edit(rnd, cfg, pool)
+                self.assertEqual(
+                    cfg.compile(strategy), copy.deepcopy(cfg).compile(strategy),
+                    "seed %d, step %d" % (seed, step)
+                )
+    
+    def test_recompile_unchanged(self):
+        cfg, pool = random_config(random.Random(0))
+        image = cfg.compile()
+        self.assertEqual(cfg.compile(), image)
+
+if __name__ == '__main__':
+    unittest.main()
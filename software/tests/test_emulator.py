@@ -0,0 +1,28 @@
+import unittest
+
+from py_modules.skylight import btLink
+from py_modules.skylight.emulator import DeviceEmulator
+
+#---------------------------------------------------------------------------------------------------
+class TestReconnect(unittest.TestCase):
+    def test_reconnect_right_away(self):
+        E = DeviceEmulator(baud = None, rtt = 0.2)
+        self.addCleanup(E.stop)
+        
+        S = btLink.btLink(None, sock=E.connect())
+        S.open()
+        
+        # Cut the link while a response is still on its way, and half way through a line
+        S.S.sendall(b"get_time\r\nrgbw 1")
+        E.stop()
+        S.close()
+        
+        S = btLink.btLink(None, sock=E.connect())
+        S.open()
+        self.assertEqual(S.cmd("id\r\n"), "APP")
+        self.assertEqual(S.cmd("rgbw 1 2 3 4\r\n"), "")
+        self.assertEqual(E.rgbw, (1, 2, 3, 4))
+        S.close()
+
+if __name__ == '__main__':
+    unittest.main()